@@ -0,0 +1,177 @@
+# cancellation.py
+# -*- coding: utf-8 -*-
+"""
+生成流程的取消与截止时间：
+界面为每次生成创建一个 CancellationToken（可带整体截止时间），经 build_chapter_prompt、generate_chapter_draft、
+finalize_chapter 等入口的 cancel_token 参数放入当前上下文；LLM 适配器、重试等待、限流排队都会检查它，
+取消或超时后尽快中断进行中的请求并抛出 OperationCancelled。
+"""
+import time
+import asyncio
+import inspect
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+
+class OperationCancelled(BaseException):
+    """
+    生成被用户取消。
+    与 asyncio.CancelledError 一样继承 BaseException，避免被流程中宽泛的 except Exception 当作普通错误吞掉或重试。
+    """
+
+
+class DeadlineExceeded(OperationCancelled):
+    """超过了整体截止时间"""
+
+
+class CancellationToken:
+    """
+    可在任意线程调用 cancel() 的取消令牌；deadline 为从创建起的最长秒数。
+    parent 被取消时本令牌同时被取消（如批量生成中每章一个令牌，共享批量任务的取消）。
+    """
+    def __init__(self, deadline: Optional[float] = None, parent: "CancellationToken" = None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._detach = lambda: None
+        self.deadline_at = time.monotonic() + deadline if deadline else None
+        if parent is not None:
+            if parent.deadline_at is not None:
+                self.deadline_at = min(self.deadline_at or parent.deadline_at, parent.deadline_at)
+            self._detach = parent.add_callback(self.cancel)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set() or self.expired
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline_at is not None and time.monotonic() >= self.deadline_at
+
+    def remaining(self) -> Optional[float]:
+        """距截止时间的秒数，无截止时间返回 None"""
+        if self.deadline_at is None:
+            return None
+        return max(0.0, self.deadline_at - time.monotonic())
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = list(self._callbacks)
+            self._callbacks.clear()
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """取消时调用 callback（已取消则立即调用）；返回用于注销的函数"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                def remove():
+                    with self._lock:
+                        if callback in self._callbacks:
+                            self._callbacks.remove(callback)
+                return remove
+        callback()
+        return lambda: None
+
+    def detach(self):
+        """任务结束后从父令牌注销，避免长期存在的父令牌（如整批任务）累积已结束子令牌的回调"""
+        self._detach()
+
+    def check(self):
+        """已取消或已超时时抛出对应异常"""
+        if self._event.is_set():
+            raise OperationCancelled("Generation cancelled")
+        if self.expired:
+            raise DeadlineExceeded("Generation deadline exceeded")
+
+    def wait(self, seconds: Optional[float]) -> bool:
+        """最多等待 seconds 秒（不超过截止时间），期间被取消则提前返回 True"""
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = remaining if seconds is None else min(seconds, remaining)
+        return self._event.wait(seconds) or self.expired
+
+
+_current_token = ContextVar("cancel_token", default=None)
+
+def current_token() -> Optional[CancellationToken]:
+    return _current_token.get()
+
+def check_cancelled():
+    """检查当前上下文的令牌，已取消时抛出 OperationCancelled"""
+    token = _current_token.get()
+    if token is not None:
+        token.check()
+
+def sleep(seconds: float):
+    """可被取消的 time.sleep"""
+    token = _current_token.get()
+    if token is None:
+        time.sleep(seconds)
+        return
+    token.check()
+    token.wait(seconds)
+    token.check()
+
+async def asleep(seconds: float):
+    """可被取消的 asyncio.sleep"""
+    token = _current_token.get()
+    if token is None:
+        await asyncio.sleep(seconds)
+        return
+    token.check()
+    loop = asyncio.get_running_loop()
+    woken = asyncio.Event()
+    remove = token.add_callback(lambda: loop.call_soon_threadsafe(woken.set))
+    try:
+        remaining = token.remaining()
+        timeout = seconds if remaining is None else min(seconds, remaining)
+        try:
+            await asyncio.wait_for(woken.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    finally:
+        remove()
+    token.check()
+
+@contextmanager
+def cancellation_scope(token: Optional[CancellationToken]):
+    """在此范围内发起的 LLM 调用都受 token 控制；token 为 None 时沿用外层的令牌"""
+    if token is None:
+        yield _current_token.get()
+        return
+    reset = _current_token.set(token)
+    try:
+        token.check()
+        yield token
+    finally:
+        _current_token.reset(reset)
+
+def with_cancellation(token_arg: str = "cancel_token"):
+    """装饰器：按被装饰函数的 token_arg 参数建立 cancellation_scope，同步与异步函数均可使用"""
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def resolve(args, kwargs):
+            return signature.bind_partial(*args, **kwargs).arguments.get(token_arg)
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with cancellation_scope(resolve(args, kwargs)):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with cancellation_scope(resolve(args, kwargs)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
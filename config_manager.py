@@ -85,6 +85,17 @@ def create_config(config_file: str) -> dict:
         "final_chapter_llm": "GPT 5",
         "consistency_review_llm": "DeepSeek V3"
     },
+    "stage_llms": {
+        "summary": "",
+        "keyword_search": "",
+        "knowledge_filter": "",
+        "draft": "",
+        "global_summary": "",
+        "character_state": "",
+        "enrich": "",
+        "consistency": ""
+    },
+    "chapter_deadline_minutes": 0,
     "proxy_setting": {
         "proxy_url": "127.0.0.1",
         "proxy_port": "",
@@ -94,6 +105,24 @@ def create_config(config_file: str) -> dict:
         "webdav_url": "",
         "webdav_username": "",
         "webdav_password": ""
+    },
+    "llm_cache": {
+        "enabled": False,
+        "cache_dir": ".llm_cache",
+        "max_size_mb": 200,
+        "ttl_hours": 168,
+        "stages": {
+            "summary": {"enabled": True},
+            "keyword_search": {"enabled": True},
+            "knowledge_filter": {"enabled": True},
+            "draft": {"enabled": False}
+        }
+    },
+    "embedding_cache": {
+        "enabled": True,
+        "cache_dir": ".embedding_cache",
+        "max_size_mb": 500,
+        "dtype": "float32"
     }
 }
     save_config(config, config_file)
@@ -1,6 +1,6 @@
 # consistency_checker.py
 # -*- coding: utf-8 -*-
-from llm_adapters import create_llm_adapter
+from llm_adapters import create_llm_adapter, resolve_stage_llm
 
 # ============== 增加对“剧情要点/未解决冲突”进行检查的可选引导 ==============
 CONSISTENCY_PROMPT = """\
@@ -49,15 +49,9 @@ def check_consistency(
         chapter_text=chapter_text
     )
 
-    llm_adapter = create_llm_adapter(
-        interface_format=interface_format,
-        base_url=base_url,
-        model_name=model_name,
-        api_key=api_key,
-        temperature=temperature,
-        max_tokens=max_tokens,
-        timeout=timeout
-    )
+    llm_adapter = create_llm_adapter(**resolve_stage_llm(
+        "consistency", interface_format, base_url, model_name, api_key, temperature, max_tokens, timeout
+    ))
 
     # 调试日志
     print("\n[ConsistencyChecker] Prompt >>>", prompt)
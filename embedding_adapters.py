@@ -1,12 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import time
+import random
+import asyncio
 import logging
+import weakref
+import threading
+import contextvars
 from abc import ABC, abstractmethod
-from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
 
 import requests
-from langchain_openai import AzureOpenAIEmbeddings, OpenAIEmbeddings
+
+from embedding_cache import get_embedding_cache
+from rate_limiter import estimate_tokens, rate_limit_key
+
+
+class EmbeddingBatchError(Exception):
+    """
+    一次 embed_documents 中有批次请求失败：vectors 为与输入等长的结果（失败的条目为空向量），
+    cause 为首个失败批次的原始异常，调用方据此判断是否值得重试（如 401/400 不重试）。
+    """
+    def __init__(self, vectors: List[List[float]], cause: Exception):
+        failed = sum(1 for vector in vectors if not vector)
+        super().__init__(f"{failed} of {len(vectors)} texts failed to embed: {cause}")
+        self.vectors = vectors
+        self.cause = cause
 
 
 class BaseEmbeddingAdapter(ABC):
@@ -22,6 +45,18 @@ class BaseEmbeddingAdapter(ABC):
         """对单个查询文本进行 embedding"""
         pass
 
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """一次请求 embedding 多个查询文本；默认与文档共用 embed_documents，区分查询/文档的接口可覆盖"""
+        return self.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """异步 embedding 一组文本，默认在线程池中执行同步实现"""
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """异步 embedding 单个查询文本，默认在线程池中执行同步实现"""
+        return await asyncio.to_thread(self.embed_query, text)
+
 
 class OpenAIEmbeddingAdapter(BaseEmbeddingAdapter):
     """
@@ -29,6 +64,7 @@ class OpenAIEmbeddingAdapter(BaseEmbeddingAdapter):
     """
 
     def __init__(self, api_key: str, base_url: str, model_name: str):
+        from langchain_openai import OpenAIEmbeddings
         self._embedding = OpenAIEmbeddings(
             model=model_name,
             openai_api_base=base_url,
@@ -41,6 +77,12 @@ class OpenAIEmbeddingAdapter(BaseEmbeddingAdapter):
     def embed_query(self, text: str) -> List[float]:
         return self._embedding.embed_query(text)
 
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._embedding.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self._embedding.aembed_query(text)
+
 
 class AzureOpenAIEmbeddingAdapter(BaseEmbeddingAdapter):
     """
@@ -49,6 +91,7 @@ class AzureOpenAIEmbeddingAdapter(BaseEmbeddingAdapter):
 
     def __init__(self, api_key: str, base_url: str, model_name: str):
         # 注意：Azure OpenAI 的 base_url 通常包含部署名称，这里假设用户已正确配置
+        from langchain_openai import AzureOpenAIEmbeddings
         self._embedding = AzureOpenAIEmbeddings(
             model=model_name,
             azure_endpoint=base_url,
@@ -61,6 +104,12 @@ class AzureOpenAIEmbeddingAdapter(BaseEmbeddingAdapter):
     def embed_query(self, text: str) -> List[float]:
         return self._embedding.embed_query(text)
 
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._embedding.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self._embedding.aembed_query(text)
+
 
 class OllamaEmbeddingAdapter(BaseEmbeddingAdapter):
     """
@@ -78,42 +127,283 @@ class OllamaEmbeddingAdapter(BaseEmbeddingAdapter):
     def embed_query(self, text: str) -> List[float]:
         return self._embedding.embed_query(text)
 
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._embedding.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self._embedding.aembed_query(text)
 
-class MLStudioEmbeddingAdapter(BaseEmbeddingAdapter):
+
+# 批量请求的默认上限：每批条数与估算 token 数，以及同一接口同时在途的批次数，
+# 可在 embedding_configs 中以 batch_size / batch_tokens / max_concurrency 覆盖
+DEFAULT_EMBEDDING_BATCH_SIZE = 64
+DEFAULT_EMBEDDING_BATCH_TOKENS = 8000
+DEFAULT_EMBEDDING_CONCURRENCY = 4
+
+_batch_limits = {}
+_batch_limits_lock = threading.Lock()
+_provider_semaphores = {}
+
+# embedding_configs 中可按配置填写的可选项
+_EMBEDDING_OPTION_KEYS = ("batch_size", "batch_tokens", "max_concurrency", "backend", "quantize", "threads")
+
+def configure_embedding_limits(embedding_configs: dict):
     """
-    基于 ML Studio（本地部署）的适配器
+    根据 config.json 的 embedding_configs 读取可选的 batch_size、batch_tokens、max_concurrency，
+    以及 Local 接口的 backend（torch / onnx）、quantize（int8 量化）、threads（CPU 线程数）
+    """
+    limits = {}
+    for name, conf in (embedding_configs or {}).items():
+        options = {k: conf[k] for k in _EMBEDDING_OPTION_KEYS if conf.get(k) not in (None, "")}
+        if not options:
+            continue
+        key = rate_limit_key(conf.get("interface_format", ""), conf.get("base_url", ""), conf.get("model_name", ""))
+        limits[key] = options
+        logging.info(f"Embedding limits for '{name}': {limits[key]}")
+    with _batch_limits_lock:
+        _batch_limits.clear()
+        _batch_limits.update(limits)
+        _provider_semaphores.clear()
+
+def _get_embedding_options(interface_format: str, base_url: str, model_name: str) -> dict:
+    with _batch_limits_lock:
+        return dict(_batch_limits.get(rate_limit_key(interface_format, base_url, model_name), {}))
+
+def _provider_slots(provider_key, default_limit: int = DEFAULT_EMBEDDING_CONCURRENCY) -> tuple:
+    """返回该接口的并发上限与共享信号量，同一接口的多个导入任务合计不超过上限"""
+    with _batch_limits_lock:
+        limit = int(_batch_limits.get(provider_key, {}).get("max_concurrency") or default_limit)
+        semaphore = _provider_semaphores.get(provider_key)
+        if semaphore is None:
+            semaphore = _provider_semaphores[provider_key] = threading.BoundedSemaphore(limit)
+        return limit, semaphore
+
+def iter_embedding_batches(
+    embedding_adapter: "BaseEmbeddingAdapter",
+    texts: List[str],
+    embed_func: Optional[Callable[[List[str]], List[List[float]]]] = None,
+    batch_size: Optional[int] = None
+) -> Iterator[Tuple[int, List[str], List[List[float]]]]:
     """
+    并发 embedding：把 texts 按 batch_size 分批，同一接口最多 max_concurrency 批同时在途，
+    按原顺序逐批产出 (起始下标, 该批文本, 向量)。调用方可边产出边写入向量库，
+    任何时刻只有有限个批次的结果留在内存中。
+    embed_func 默认为 embedding_adapter.embed_documents（可传入带重试的封装）。
+    工作线程在调用方的上下文副本中执行，取消令牌与用量统计对其中的请求与重试等待同样有效。
+    """
+    embed_func = embed_func or embedding_adapter.embed_documents
+    batch_size = int(batch_size or getattr(embedding_adapter, "batch_size", None) or DEFAULT_EMBEDDING_BATCH_SIZE)
+    limit, semaphore = _provider_slots(
+        getattr(embedding_adapter, "provider_key", None),
+        getattr(embedding_adapter, "default_concurrency", None) or DEFAULT_EMBEDDING_CONCURRENCY
+    )
+
+    def run(batch):
+        with semaphore:
+            return embed_func(batch)
+
+    pending = deque()
+    pool = ThreadPoolExecutor(max_workers=limit, thread_name_prefix="embedding")
+    try:
+        for start in range(0, len(texts), batch_size):
+            # 最多预先提交 2 倍并发数的批次，保证工作线程不空闲的同时限制内存占用
+            while len(pending) >= limit * 2:
+                head_start, future = pending.popleft()
+                yield head_start, texts[head_start:head_start + batch_size], future.result()
+            pending.append((start, pool.submit(contextvars.copy_context().run, run, texts[start:start + batch_size])))
+        while pending:
+            head_start, future = pending.popleft()
+            yield head_start, texts[head_start:head_start + batch_size], future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def _get_http_session(base_url: str) -> requests.Session:
+    """按 base_url 复用带连接池的 requests.Session，避免每次请求重新建立 TCP/TLS 连接"""
+    with _http_sessions_lock:
+        session = _http_sessions.get(base_url)
+        if session is None:
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            pool = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount("http://", pool)
+            session.mount("https://", pool)
+            _http_sessions[base_url] = session
+        return session
+
+_async_http_sessions = weakref.WeakKeyDictionary()
+
+def _get_async_http_session(base_url: str):
+    """按事件循环与 base_url 复用 aiohttp.ClientSession：异步连接池绑定在创建它的事件循环上，不能跨循环复用"""
+    import aiohttp
+    loop = asyncio.get_running_loop()
+    with _http_sessions_lock:
+        sessions = _async_http_sessions.setdefault(loop, {})
+        session = sessions.get(base_url)
+        if session is None or session.closed:
+            session = sessions[base_url] = aiohttp.ClientSession()
+        return session
+
+async def close_async_http_sessions():
+    """关闭当前事件循环上复用的 aiohttp 会话；在事件循环结束前调用"""
+    loop = asyncio.get_running_loop()
+    with _http_sessions_lock:
+        sessions = _async_http_sessions.pop(loop, {})
+    for session in sessions.values():
+        await session.close()
+
+
+class BatchedHTTPEmbeddingAdapter(BaseEmbeddingAdapter):
+    """
+    OpenAI 兼容 /embeddings 接口的批量适配器：
+    把文本按条数与估算 token 数分批，每批一次请求（input 为列表），按返回的 index 映射回原顺序。
+    某一批失败时其余批次照常请求，最后抛出 EmbeddingBatchError，携带成功批次的向量与失败的原始异常。
+    """
+    provider_name = "Embedding"
+    default_batch_size = DEFAULT_EMBEDDING_BATCH_SIZE
 
-    def __init__(self, api_key: str, base_url: str, model_name: str):
+    def __init__(self, interface_format: str, api_key: str, base_url: str, endpoint: str, model_name: str):
         self.api_key = api_key
-        self.base_url = f"{base_url.rstrip('/')}/v1/embeddings"
+        self.base_url = endpoint
         self.model_name = model_name
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
-
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        return [self._embed_single(text) for text in texts]
-
-    def embed_query(self, query: str) -> List[float]:
-        return self._embed_single(query)
-
-    def _embed_single(self, text: str) -> List[float]:
+        limits = _get_embedding_options(interface_format, base_url, model_name)
+        self.batch_size = int(limits.get("batch_size") or self.default_batch_size)
+        self.batch_tokens = int(limits.get("batch_tokens") or DEFAULT_EMBEDDING_BATCH_TOKENS)
+        self.max_concurrency = int(limits.get("max_concurrency") or DEFAULT_EMBEDDING_CONCURRENCY)
+
+    def _batches(self, texts: List[str]) -> List[List[int]]:
+        """返回每批文本在 texts 中的下标；空文本不发送"""
+        batches, batch, tokens = [], [], 0
+        for index, text in enumerate(texts):
+            if not text or not text.strip():
+                continue
+            size = estimate_tokens(text)
+            if batch and (len(batch) >= self.batch_size or tokens + size > self.batch_tokens):
+                batches.append(batch)
+                batch, tokens = [], 0
+            batch.append(index)
+            tokens += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def _parse(data: dict, count: int) -> List[List[float]]:
+        vectors = [[] for _ in range(count)]
+        for position, item in enumerate(data["data"]):
+            vectors[item.get("index", position)] = item["embedding"]
+        return vectors
+
+    def _log_http_error(self, e: requests.exceptions.RequestException):
+        logging.error(f"{self.provider_name} API request failed: {e}")
+
+    def _post(self, inputs: List[str]) -> List[List[float]]:
         payload = {
             "model": self.model_name,
-            "input": text
+            "input": inputs
         }
         try:
-            response = requests.post(self.base_url, json=payload, headers=self.headers)
+            response = _get_http_session(self.base_url).post(self.base_url, json=payload, headers=self.headers)
             response.raise_for_status()
-            data = response.json()
-            return data['data'][0]['embedding']
         except requests.exceptions.RequestException as e:
-            logging.error(f"ML Studio API request failed: {e}")
-        except (KeyError, IndexError) as e:
-            logging.error(f"Failed to parse ML Studio API response: {e}")
-        return []
+            self._log_http_error(e)
+            raise
+        try:
+            return self._parse(response.json(), len(inputs))
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            logging.error(f"Failed to parse {self.provider_name} API response: {e}")
+            raise ValueError(f"Invalid {self.provider_name} API response: {e}") from e
+
+    async def _apost(self, inputs: List[str]) -> List[List[float]]:
+        import aiohttp
+        payload = {
+            "model": self.model_name,
+            "input": inputs
+        }
+        try:
+            session = _get_async_http_session(self.base_url)
+            async with session.post(self.base_url, json=payload, headers=self.headers) as response:
+                if response.status >= 400:
+                    logging.error(f"{self.provider_name} API error detail: {await response.text()}")
+                response.raise_for_status()
+                data = await response.json()
+        except aiohttp.ClientError as e:
+            logging.error(f"{self.provider_name} API request failed: {e}")
+            raise
+        try:
+            return self._parse(data, len(inputs))
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            logging.error(f"Failed to parse {self.provider_name} API response: {e}")
+            raise ValueError(f"Invalid {self.provider_name} API response: {e}") from e
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = [[] for _ in texts]
+        error = None
+        for batch in self._batches(texts):
+            try:
+                batch_vectors = self._post([texts[i] for i in batch])
+            except Exception as e:
+                error = error or e
+                continue
+            for index, vector in zip(batch, batch_vectors):
+                vectors[index] = vector
+        if error is not None:
+            raise EmbeddingBatchError(vectors, error)
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        try:
+            return self.embed_documents([text])[0]
+        except EmbeddingBatchError as e:
+            raise e.cause
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = [[] for _ in texts]
+        batches = self._batches(texts)
+        # 与同步路径一样最多 max_concurrency 批同时在途
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def post(batch):
+            async with semaphore:
+                return await self._apost([texts[i] for i in batch])
+
+        results = await asyncio.gather(*(post(batch) for batch in batches), return_exceptions=True)
+        error = None
+        for batch, batch_vectors in zip(batches, results):
+            if isinstance(batch_vectors, BaseException):
+                if not isinstance(batch_vectors, Exception):
+                    raise batch_vectors
+                error = error or batch_vectors
+                continue
+            for index, vector in zip(batch, batch_vectors):
+                vectors[index] = vector
+        if error is not None:
+            raise EmbeddingBatchError(vectors, error)
+        return vectors
+
+    async def aembed_query(self, text: str) -> List[float]:
+        try:
+            return (await self.aembed_documents([text]))[0]
+        except EmbeddingBatchError as e:
+            raise e.cause
+
+
+class MLStudioEmbeddingAdapter(BatchedHTTPEmbeddingAdapter):
+    """
+    基于 ML Studio（本地部署）的适配器
+    """
+    provider_name = "ML Studio"
+
+    def __init__(self, api_key: str, base_url: str, model_name: str):
+        super().__init__("ML Studio", api_key, base_url, f"{base_url.rstrip('/')}/v1/embeddings", model_name)
 
 
 class GeminiEmbeddingAdapter(BaseEmbeddingAdapter):
@@ -136,6 +426,21 @@ class GeminiEmbeddingAdapter(BaseEmbeddingAdapter):
         result = genai.embed_content(model=self.model_name, content=text, task_type="retrieval_query")
         return result['embedding']
 
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        import google.generativeai as genai
+        result = genai.embed_content(model=self.model_name, content=texts, task_type="retrieval_query")
+        return result['embedding']
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        import google.generativeai as genai
+        result = await genai.embed_content_async(model=self.model_name, content=texts, task_type="retrieval_document")
+        return result['embedding']
+
+    async def aembed_query(self, text: str) -> List[float]:
+        import google.generativeai as genai
+        result = await genai.embed_content_async(model=self.model_name, content=text, task_type="retrieval_query")
+        return result['embedding']
+
 
 class SiliconFlowEmbeddingAdapter(BaseEmbeddingAdapter):
     """
@@ -143,6 +448,7 @@ class SiliconFlowEmbeddingAdapter(BaseEmbeddingAdapter):
     """
 
     def __init__(self, api_key: str, base_url: str, model_name: str):
+        from langchain_openai import OpenAIEmbeddings
         self._embedding = OpenAIEmbeddings(
             model=model_name,
             openai_api_base=base_url,
@@ -155,49 +461,238 @@ class SiliconFlowEmbeddingAdapter(BaseEmbeddingAdapter):
     def embed_query(self, text: str) -> List[float]:
         return self._embedding.embed_query(text)
 
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._embedding.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self._embedding.aembed_query(text)
 
-class DashScopeEmbeddingAdapter(BaseEmbeddingAdapter):
+
+class DashScopeEmbeddingAdapter(BatchedHTTPEmbeddingAdapter):
     """
     基于阿里百炼 DashScope 的适配器
     专门处理 DashScope 的 OpenAI 兼容接口
     """
+    provider_name = "DashScope"
+    # text-embedding-v3/v4 每次请求最多 10 条
+    default_batch_size = 10
 
     def __init__(self, api_key: str, base_url: str, model_name: str):
-        self.api_key = api_key
-        self.base_url = f"{base_url.rstrip('/')}/embeddings"
-        self.model_name = model_name
-        self.headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
+        super().__init__("DashScope", api_key, base_url, f"{base_url.rstrip('/')}/embeddings", model_name)
+
+    def _log_http_error(self, e: requests.exceptions.RequestException):
+        logging.error(f"DashScope API request failed: {e}")
+        if hasattr(e, 'response') and e.response is not None:
+            try:
+                error_detail = e.response.json()
+                logging.error(f"DashScope API error detail: {error_detail}")
+            except:
+                logging.error(f"DashScope API response text: {e.response.text}")
+
+
+DEFAULT_LOCAL_EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+# 本地导出的 int8 量化 ONNX 模型的存放目录
+LOCAL_EMBEDDING_MODEL_DIR = ".embedding_models"
+
+_local_models = {}
+_local_models_lock = threading.Lock()
+
+def _onnx_model_kwargs(threads: Optional[int]) -> dict:
+    import onnxruntime
+    session_options = onnxruntime.SessionOptions()
+    if threads:
+        session_options.intra_op_num_threads = threads
+    return {"provider": "CPUExecutionProvider", "session_options": session_options}
+
+def _load_local_model(model_name: str, backend: str, quantize: bool, threads: Optional[int]):
+    """加载 sentence-transformers 模型，同一进程内按参数只加载一次"""
+    key = (model_name, backend, quantize, threads)
+    with _local_models_lock:
+        model = _local_models.get(key)
+        if model is not None:
+            return model
+        from sentence_transformers import SentenceTransformer
+        if backend != "onnx":
+            if threads:
+                import torch
+                torch.set_num_threads(threads)
+            model = SentenceTransformer(model_name, device="cpu")
+        elif not quantize:
+            model = SentenceTransformer(model_name, device="cpu", backend="onnx", model_kwargs=_onnx_model_kwargs(threads))
+        else:
+            model = _load_quantized_onnx_model(model_name, threads)
+        _local_models[key] = model
+        logging.info(f"Local embedding model loaded: {model_name} (backend={backend}, quantize={quantize}, threads={threads})")
+        return model
+
+def _load_quantized_onnx_model(model_name: str, threads: Optional[int]):
+    """加载 int8 动态量化的 ONNX 模型；首次使用时从原模型导出到 LOCAL_EMBEDDING_MODEL_DIR"""
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+    file_name = "onnx/model_qint8_avx2.onnx"
+    local_dir = os.path.join(LOCAL_EMBEDDING_MODEL_DIR, model_name.replace("/", "__"))
+    if not os.path.exists(os.path.join(local_dir, file_name)):
+        base_model = SentenceTransformer(model_name, device="cpu", backend="onnx")
+        base_model.save(local_dir)
+        export_dynamic_quantized_onnx_model(base_model, "avx2", local_dir)
+    model_kwargs = dict(_onnx_model_kwargs(threads), file_name=file_name)
+    return SentenceTransformer(local_dir, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+
+
+class LocalEmbeddingAdapter(BaseEmbeddingAdapter):
+    """
+    本地 CPU 推理（interface_format 为 "Local"）：sentence-transformers 模型，可选 ONNX 与 int8 量化，不发出网络请求。
+    model_name 为 HuggingFace 模型名（首次使用时下载）或本地模型目录。
+    """
+    # 单个模型的推理已占满 CPU 线程，并发执行多批只会互相争抢
+    default_concurrency = 1
+
+    def __init__(self, model_name: str, base_url: str = ""):
+        self.model_name = model_name or DEFAULT_LOCAL_EMBEDDING_MODEL
+        options = _get_embedding_options("Local", base_url, model_name)
+        self.backend = str(options.get("backend") or "torch").lower()
+        self.quantize = bool(options.get("quantize", False))
+        self.threads = int(options["threads"]) if options.get("threads") else None
+        self.batch_size = int(options.get("batch_size") or 32)
+
+    def _model(self):
+        return _load_local_model(self.model_name, self.backend, self.quantize, self.threads)
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        return [self._embed_single(text) for text in texts]
+        if not texts:
+            return []
+        vectors = self._model().encode(
+            list(texts),
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        return vectors.tolist()
 
     def embed_query(self, text: str) -> List[float]:
-        return self._embed_single(text)
+        return self.embed_documents([text])[0]
 
-    def _embed_single(self, text: str) -> List[float]:
-        payload = {
-            "model": self.model_name,
-            "input": text
-        }
-        try:
-            response = requests.post(self.base_url, json=payload, headers=self.headers)
-            response.raise_for_status()
-            data = response.json()
-            return data['data'][0]['embedding']
-        except requests.exceptions.RequestException as e:
-            logging.error(f"DashScope API request failed: {e}")
-            if hasattr(e, 'response') and e.response is not None:
-                try:
-                    error_detail = e.response.json()
-                    logging.error(f"DashScope API error detail: {error_detail}")
-                except:
-                    logging.error(f"DashScope API response text: {e.response.text}")
-        except (KeyError, IndexError) as e:
-            logging.error(f"Failed to parse DashScope API response: {e}")
-        return []
+
+class MockEmbeddingAdapter(BaseEmbeddingAdapter):
+    """
+    离线模拟 embedding（interface_format 为 "mock"）：按文本内容生成确定性向量，不发出网络请求。
+    维度、延迟与错误率见 mock_backend。
+    """
+
+    def __init__(self, model_name: str):
+        from mock_backend import get_mock_options
+        self.model_name = model_name or "mock-embedding"
+        self._rng = random.Random(get_mock_options()["seed"])
+
+    def _check_error(self, options: dict):
+        from mock_backend import MockBackendError
+        if options["error_rate"] and self._rng.random() < float(options["error_rate"]):
+            raise MockBackendError("Mock embedding backend injected error (503).")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        from mock_backend import get_mock_options, mock_embedding
+        options = get_mock_options()
+        time.sleep(float(options["embedding_latency"]))
+        self._check_error(options)
+        return [mock_embedding(text, int(options["embedding_dim"])) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        from mock_backend import get_mock_options, mock_embedding
+        options = get_mock_options()
+        await asyncio.sleep(float(options["embedding_latency"]))
+        self._check_error(options)
+        return [mock_embedding(text, int(options["embedding_dim"])) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+class CachedEmbeddingAdapter(BaseEmbeddingAdapter):
+    """
+    包在任意 BaseEmbeddingAdapter 外层：先查缓存，只把未命中（且去重后）的文本交给内层适配器，
+    再按原顺序拼回结果。
+    """
+    def __init__(self, inner, cache, namespace: str):
+        self.inner = inner
+        self.cache = cache
+        self.namespace = namespace
+
+    def unwrap(self):
+        return self.inner
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def _lookup(self, texts: List[str]):
+        cached = self.cache.get_many(f"{self.namespace}|doc", texts)
+        missing = list(dict.fromkeys(text for text in texts if text not in cached))
+        return cached, missing
+
+    def _store(self, cached: dict, missing: List[str], vectors: List[List[float]]) -> None:
+        if len(vectors) != len(missing):
+            logging.warning(f"Embedding adapter returned {len(vectors)} vectors for {len(missing)} texts, skip caching.")
+            vectors = list(vectors) + [[]] * (len(missing) - len(vectors))
+        fresh = dict(zip(missing, vectors))
+        self.cache.set_many(f"{self.namespace}|doc", fresh)
+        cached.update(fresh)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        cached, missing = self._lookup(texts)
+        if missing:
+            logging.info(f"[embedding_cache] {len(texts) - len(missing)} cached, embedding {len(missing)} new texts.")
+            try:
+                vectors = self.inner.embed_documents(missing)
+            except EmbeddingBatchError as e:
+                # 成功的部分照常缓存，失败信息按原顺序转交调用方
+                self._store(cached, missing, e.vectors)
+                raise EmbeddingBatchError([cached.get(text, []) for text in texts], e.cause) from e.cause
+            self._store(cached, missing, vectors)
+        return [cached.get(text, []) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        namespace = f"{self.namespace}|query"
+        cached = self.cache.get_many(namespace, [text])
+        if text in cached:
+            return cached[text]
+        vector = self.inner.embed_query(text)
+        self.cache.set_many(namespace, {text: vector})
+        return vector
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        namespace = f"{self.namespace}|query"
+        cached = self.cache.get_many(namespace, texts)
+        missing = list(dict.fromkeys(text for text in texts if text not in cached))
+        if missing:
+            vectors = self.inner.embed_queries(missing)
+            if len(vectors) == len(missing):
+                fresh = dict(zip(missing, vectors))
+                self.cache.set_many(namespace, fresh)
+                cached.update(fresh)
+        return [cached.get(text, []) for text in texts]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        cached, missing = await asyncio.to_thread(self._lookup, texts)
+        if missing:
+            logging.info(f"[embedding_cache] {len(texts) - len(missing)} cached, embedding {len(missing)} new texts.")
+            try:
+                vectors = await self.inner.aembed_documents(missing)
+            except EmbeddingBatchError as e:
+                await asyncio.to_thread(self._store, cached, missing, e.vectors)
+                raise EmbeddingBatchError([cached.get(text, []) for text in texts], e.cause) from e.cause
+            await asyncio.to_thread(self._store, cached, missing, vectors)
+        return [cached.get(text, []) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        namespace = f"{self.namespace}|query"
+        cached = await asyncio.to_thread(self.cache.get_many, namespace, [text])
+        if text in cached:
+            return cached[text]
+        vector = await self.inner.aembed_query(text)
+        await asyncio.to_thread(self.cache.set_many, namespace, {text: vector})
+        return vector
 
 
 def create_embedding_adapter(
@@ -207,8 +702,24 @@ def create_embedding_adapter(
     model_name: str
 ) -> BaseEmbeddingAdapter:
     """
-    工厂函数：根据 interface_format 返回不同的 embedding 适配器实例
+    工厂函数：根据 interface_format 返回不同的 embedding 适配器实例；
+    启用了 embedding_cache 时外层包上 CachedEmbeddingAdapter
     """
+    adapter = _build_embedding_adapter(interface_format, api_key, base_url, model_name)
+    # 用于查找该接口的批量与并发上限（见 configure_embedding_limits）
+    adapter.provider_key = rate_limit_key(interface_format, base_url, model_name)
+    cache = get_embedding_cache()
+    if cache is None:
+        return adapter
+    namespace = f"{interface_format.strip().lower()}|{(base_url or '').rstrip('/')}|{model_name}"
+    return CachedEmbeddingAdapter(adapter, cache, namespace)
+
+def _build_embedding_adapter(
+    interface_format: str,
+    api_key: str,
+    base_url: str,
+    model_name: str
+) -> BaseEmbeddingAdapter:
     fmt = interface_format.strip().lower()
     if fmt == "openai":
         return OpenAIEmbeddingAdapter(api_key, base_url, model_name)
@@ -224,5 +735,9 @@ def create_embedding_adapter(
         return SiliconFlowEmbeddingAdapter(api_key, base_url, model_name)
     elif fmt == "dashscope":
         return DashScopeEmbeddingAdapter(api_key, base_url, model_name)
+    elif fmt == "local":
+        return LocalEmbeddingAdapter(model_name, base_url)
+    elif fmt == "mock":
+        return MockEmbeddingAdapter(model_name)
     else:
         raise ValueError(f"Unknown embedding interface_format: {interface_format}")
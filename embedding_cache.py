@@ -0,0 +1,179 @@
+# embedding_cache.py
+# -*- coding: utf-8 -*-
+"""
+Embedding 向量持久化缓存（按 接口格式 + base_url + 模型 + sha256(文本) 寻址，SQLite 存储，LRU 淘汰）
+create_embedding_adapter 返回的适配器外层包一层 embedding_adapters.CachedEmbeddingAdapter，
+重新导入知识库、清空后重建向量库、重新定稿改动不大的章节时，只有新出现的文本才会请求 embedding 接口。
+向量以 float32（或 float16）二进制存储。
+"""
+import os
+import time
+import struct
+import logging
+import hashlib
+import sqlite3
+import threading
+from array import array
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# SQLite 单条语句的参数个数有上限，批量查询时分批
+_QUERY_BATCH = 500
+
+
+def _pack(vector: List[float], dtype: str) -> bytes:
+    if dtype == "float16":
+        return struct.pack(f"<{len(vector)}e", *vector)
+    data = array("f", vector)
+    if data.itemsize != 4:
+        raise ValueError("array('f') is not 32-bit on this platform")
+    return data.tobytes()
+
+def _unpack(blob: bytes, dtype: str) -> List[float]:
+    if dtype == "float16":
+        return list(struct.unpack(f"<{len(blob) // 2}e", blob))
+    data = array("f")
+    data.frombytes(blob)
+    return data.tolist()
+
+
+class EmbeddingCache:
+    """
+    基于 SQLite 的内容寻址 embedding 缓存。
+    - 键：sha256(命名空间 + 文本)，命名空间为 接口格式|base_url|模型|doc 或 query
+      （部分接口对文档与查询使用不同的 task_type，两者分开缓存）
+    - 总大小超过 max_bytes 时按最近访问时间淘汰
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = 500 * 1024 * 1024, dtype: str = "float32"):
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"Unsupported embedding cache dtype: {dtype}")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, "embeddings.sqlite3")
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "writes": 0}
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, namespace TEXT, dtype TEXT, vector BLOB, size INTEGER, "
+                "created_at REAL, last_access REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings(last_access)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(namespace: str, text: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{namespace}\n{digest}".encode("utf-8")).hexdigest()
+
+    def _count(self, field: str, amount: int = 1):
+        with self._lock:
+            self._stats[field] += amount
+
+    def get_many(self, namespace: str, texts: List[str]) -> Dict[str, List[float]]:
+        """返回 {文本: 向量}，只包含命中的文本"""
+        keys = {self.make_key(namespace, text): text for text in texts}
+        found = {}
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                key_list = list(keys)
+                for start in range(0, len(key_list), _QUERY_BATCH):
+                    batch = key_list[start:start + _QUERY_BATCH]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = conn.execute(
+                        f"SELECT key, dtype, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                    ).fetchall()
+                    for key, dtype, blob in rows:
+                        found[keys[key]] = _unpack(blob, dtype)
+                    hit_keys = [key for key, _, _ in rows]
+                    if hit_keys:
+                        conn.execute(
+                            f"UPDATE embeddings SET last_access = ? WHERE key IN ({','.join('?' * len(hit_keys))})",
+                            [now] + hit_keys
+                        )
+        except sqlite3.Error as e:
+            logging.warning(f"Embedding cache read failed: {e}")
+            return {}
+        self._count("hits", len(found))
+        self._count("misses", len(keys) - len(found))
+        return found
+
+    def set_many(self, namespace: str, items: Dict[str, List[float]]):
+        """写入 {文本: 向量}；空向量（embedding 失败时的返回值）不写入"""
+        now = time.time()
+        rows = []
+        for text, vector in items.items():
+            if not vector:
+                continue
+            blob = _pack(vector, self.dtype)
+            rows.append((self.make_key(namespace, text), namespace, self.dtype, blob, len(blob), now, now))
+        if not rows:
+            return
+        try:
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, namespace, dtype, vector, size, created_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                self._evict(conn)
+        except sqlite3.Error as e:
+            logging.warning(f"Embedding cache write failed: {e}")
+            return
+        self._count("writes", len(rows))
+
+    def _evict(self, conn):
+        """总大小超出上限时，按最近访问时间从旧到新淘汰"""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute("SELECT key, size FROM embeddings ORDER BY last_access ASC").fetchall():
+            conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM embeddings")
+
+    def stats(self) -> dict:
+        """返回命中/未命中/写入的文本条数"""
+        with self._lock:
+            return dict(self._stats)
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+
+def configure_embedding_cache(cache_config: dict) -> Optional[EmbeddingCache]:
+    """
+    根据 config.json 中的 embedding_cache 配置启用/关闭全局缓存，例如：
+    {"enabled": true, "cache_dir": ".embedding_cache", "max_size_mb": 500, "dtype": "float32"}
+    embedding 结果是确定的，未配置时默认开启；dtype 为 float16 时占用减半，检索精度略有损失。
+    """
+    global _embedding_cache
+    cache_config = cache_config or {}
+    if not cache_config.get("enabled", True):
+        _embedding_cache = None
+        return None
+    _embedding_cache = EmbeddingCache(
+        cache_dir=cache_config.get("cache_dir", ".embedding_cache"),
+        max_bytes=int(float(cache_config.get("max_size_mb", 500)) * 1024 * 1024),
+        dtype=cache_config.get("dtype", "float32")
+    )
+    logging.info(f"Embedding cache enabled at {_embedding_cache.db_path}.")
+    return _embedding_cache
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """返回当前启用的全局缓存；未启用时为 None"""
+    return _embedding_cache
@@ -1,17 +1,26 @@
 # llm_adapters.py
 # -*- coding: utf-8 -*-
+import asyncio
+import atexit
+import bisect
+import hashlib
+import contextvars
 import logging
-from typing import Optional
-from langchain_openai import ChatOpenAI, AzureChatOpenAI
-# from google import genai
-import google.generativeai as genai
-# from google.genai import types
-from google.generativeai import types
-from azure.ai.inference import ChatCompletionsClient
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.inference.models import SystemMessage, UserMessage
-from openai import OpenAI
-import requests
+import queue
+import socket
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterator, Optional
+from rate_limiter import get_rate_limiter, estimate_tokens
+from usage_tracker import report_usage, current_usage
+from prompt_layout import build_chat_messages
+import cancellation
+from cancellation import CancellationToken, OperationCancelled, cancellation_scope, current_token
+
+# 各供应商 SDK 在对应适配器首次创建/调用时才导入，避免启动时加载全部依赖
 
 
 def check_base_url(url: str) -> str:
@@ -33,13 +42,236 @@ def check_base_url(url: str) -> str:
             url = url.rstrip('/') + '/v1'
     return url
 
+def _running_loop():
+    """返回当前线程正在运行的事件循环，没有时返回 None"""
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+def _close_client(client, owner: str = ""):
+    """关闭 SDK 客户端：langchain 的 ChatOpenAI 关闭其 root_client，其余调用自身的 close()"""
+    for target in (getattr(client, "root_client", None), client):
+        close_func = getattr(target, "close", None)
+        if callable(close_func):
+            try:
+                close_func()
+            except Exception as e:
+                logging.warning(f"Failed to close client of {owner}: {e}")
+            return
+
+def _shutdown_sockets(client):
+    """
+    shutdown 客户端（openai SDK 或 langchain ChatOpenAI）底层 httpx 连接池中所有连接的套接字。
+    仅 close() 不会唤醒另一线程中阻塞在读取上的请求，shutdown 会让读取立即返回，请求随之出错结束。
+    """
+    http_client = getattr(getattr(client, "root_client", client), "_client", None)
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    for connection in list(getattr(pool, "connections", None) or []):
+        stream = getattr(getattr(connection, "_connection", None), "_network_stream", None)
+        sock = stream.get_extra_info("socket") if stream is not None else None
+        if sock is None:
+            continue
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def _interrupt_client(client, owner: str = ""):
+    """断开一个借出客户端上进行中的请求并关闭它（requests 会话等无法 shutdown 的只能关闭）"""
+    _shutdown_sockets(client)
+    _close_client(client, owner)
+
+# 每个适配器保留的空闲独占客户端数（可中断调用借用，保留连接复用）
+MAX_IDLE_CLIENTS = 4
+_idle_clients_lock = threading.Lock()
+
+class _InterruptibleCall:
+    """
+    一次在工作线程中执行、可被中断的同步调用。
+    调用期间适配器经 _call_client() 借用独占客户端；abort() 断开这些客户端的连接，
+    阻塞在网络读取上的工作线程随即出错退出。正常结束后客户端归还给适配器继续复用。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases = []
+        self.aborted = False
+
+    def lease(self, adapter: "BaseLLMAdapter"):
+        client = adapter._checkout_client()
+        if client is None:
+            return None
+        with self._lock:
+            aborted = self.aborted
+            if not aborted:
+                self._leases.append((adapter, client))
+        if aborted:
+            _interrupt_client(client, type(adapter).__name__)
+        return client
+
+    def abort(self):
+        with self._lock:
+            if self.aborted:
+                return
+            self.aborted = True
+            leases, self._leases = self._leases, []
+        for adapter, client in leases:
+            _interrupt_client(client, type(adapter).__name__)
+
+    @contextmanager
+    def active(self):
+        """在工作线程中进入本次调用：其间的 _call_client() 借用独占客户端，退出时归还"""
+        reset = _interruptible_call.set(self)
+        try:
+            yield
+        finally:
+            _interruptible_call.reset(reset)
+            with self._lock:
+                leases, self._leases = self._leases, []
+            for adapter, client in leases:
+                adapter._checkin_client(client)
+
+_interruptible_call = contextvars.ContextVar("llm_interruptible_call", default=None)
+
+def _report_langchain_usage(message):
+    """上报 langchain 消息（或流式分片）中的 token 用量、缓存命中与结束原因"""
+    usage = getattr(message, "usage_metadata", None) or {}
+    metadata = getattr(message, "response_metadata", None) or {}
+    report_usage(
+        usage.get("input_tokens"),
+        usage.get("output_tokens"),
+        metadata.get("finish_reason"),
+        (usage.get("input_token_details") or {}).get("cache_read")
+    )
+
+def _report_openai_usage(response):
+    """上报 OpenAI 兼容接口（含 Azure AI Inference）响应或流式分片中的用量与结束原因"""
+    usage = getattr(response, "usage", None)
+    choices = getattr(response, "choices", None)
+    # OpenAI 在 prompt_tokens_details.cached_tokens 中返回缓存命中数，DeepSeek 使用 prompt_cache_hit_tokens
+    cached = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    report_usage(
+        getattr(usage, "prompt_tokens", None),
+        getattr(usage, "completion_tokens", None),
+        choices[0].finish_reason if choices else None,
+        cached
+    )
+
+def _report_gemini_usage(response):
+    """上报 Gemini 响应中的用量；流式分片里的用量是累计值，直接覆盖即可"""
+    usage = getattr(response, "usage_metadata", None)
+    candidates = getattr(response, "candidates", None)
+    report_usage(
+        getattr(usage, "prompt_token_count", None),
+        getattr(usage, "candidates_token_count", None),
+        candidates[0].finish_reason if candidates else None,
+        getattr(usage, "cached_content_token_count", None)
+    )
+
 class BaseLLMAdapter:
     """
     统一的 LLM 接口基类，为不同后端（OpenAI、Ollama、ML Studio、Gemini等）提供一致的方法签名。
+    调用失败时适配器记录日志后抛出原异常，由 novel_generator.common 中的重试策略按错误类型决定是否重试。
     """
     def invoke(self, prompt: str) -> str:
         raise NotImplementedError("Subclasses must implement .invoke(prompt) method.")
 
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        """
+        流式调用：逐段产出模型返回的文本。
+        默认退化为一次性返回 invoke 的完整结果，子类应覆盖为原生流式实现。
+        """
+        result = self.invoke(prompt)
+        if result:
+            yield result
+
+    async def ainvoke(self, prompt: str) -> str:
+        """
+        异步调用。默认在线程池中执行 invoke，子类应覆盖为基于异步客户端的原生实现。
+        """
+        return await asyncio.to_thread(self.invoke, prompt)
+
+    def unwrap(self) -> "BaseLLMAdapter":
+        """返回最内层的实际供应商适配器（包装类会覆盖此方法）"""
+        return self
+
+    def _get_async_client(self, factory):
+        """按事件循环缓存异步客户端：异步连接池绑定在创建它的事件循环上，不能跨循环复用。"""
+        loop = asyncio.get_running_loop()
+        clients = self.__dict__.setdefault("_async_clients", weakref.WeakKeyDictionary())
+        client = clients.get(loop)
+        if client is None:
+            client = factory()
+            clients[loop] = client
+        return client
+
+    def _close_async_clients(self):
+        """关闭按事件循环缓存的异步客户端：其 close() 是协程，需回到创建它的事件循环上执行"""
+        clients = self.__dict__.pop("_async_clients", None)
+        for loop, client in list(clients.items()) if clients else []:
+            close_func = getattr(client, "close", None)
+            # 已关闭的循环无法再执行协程，其连接随循环一起失效
+            if not callable(close_func) or loop.is_closed():
+                continue
+            try:
+                if not loop.is_running():
+                    loop.run_until_complete(close_func())
+                elif _running_loop() is loop:
+                    loop.create_task(close_func())
+                else:
+                    asyncio.run_coroutine_threadsafe(close_func(), loop).result(timeout=5)
+            except Exception as e:
+                logging.warning(f"Failed to close async client of {type(self).__name__}: {e}")
+
+    def _build_client(self):
+        """
+        创建一份底层 SDK 客户端（自带独立的连接池）。
+        可中断的调用（见 CancellableAdapter）从空闲客户端中借一份独占使用，取消时只断开它的连接；
+        返回 None 表示不支持，调用直接使用共享的 self._client。
+        """
+        return None
+
+    def _call_client(self):
+        """本次同步调用应使用的客户端：在可中断的调用中为借出的独占客户端，否则为共享客户端"""
+        call = _interruptible_call.get()
+        if call is not None:
+            client = call.lease(self)
+            if client is not None:
+                return client
+        return getattr(self, "_client", None)
+
+    def _checkout_client(self):
+        with _idle_clients_lock:
+            idle = self.__dict__.setdefault("_idle_clients", [])
+            if idle:
+                return idle.pop()
+        return self._build_client()
+
+    def _checkin_client(self, client):
+        with _idle_clients_lock:
+            idle = self.__dict__.setdefault("_idle_clients", [])
+            if len(idle) < MAX_IDLE_CLIENTS:
+                idle.append(client)
+                return
+        _close_client(client, type(self).__name__)
+
+    def close(self):
+        """
+        释放底层 HTTP 连接池。langchain 的 ChatOpenAI 持有 root_client，
+        OpenAI / ChatCompletionsClient 本身带 close()，Gemini 无需处理；
+        可中断调用借用的空闲客户端与 ainvoke 使用的异步客户端一并关闭。
+        """
+        self._close_async_clients()
+        with _idle_clients_lock:
+            idle = self.__dict__.pop("_idle_clients", [])
+        for client in idle:
+            _close_client(client, type(self).__name__)
+        client = getattr(self, "_client", None)
+        if client is not None:
+            _close_client(client, type(self).__name__)
+
 class DeepSeekAdapter(BaseLLMAdapter):
     """
     适配官方/OpenAI兼容接口（使用 langchain.ChatOpenAI）
@@ -52,7 +284,11 @@ class DeepSeekAdapter(BaseLLMAdapter):
         self.temperature = temperature
         self.timeout = timeout
 
-        self._client = ChatOpenAI(
+        self._client = self._build_client()
+
+    def _build_client(self):
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(
             model=self.model_name,
             api_key=self.api_key,
             base_url=self.base_url,
@@ -62,10 +298,29 @@ class DeepSeekAdapter(BaseLLMAdapter):
         )
 
     def invoke(self, prompt: str) -> str:
-        response = self._client.invoke(prompt)
+        response = self._call_client().invoke(prompt)
+        if not response:
+            logging.warning("No response from DeepSeekAdapter.")
+            return ""
+        _report_langchain_usage(response)
+        return response.content
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        got_content = False
+        for chunk in self._call_client().stream(prompt, stream_usage=True):
+            _report_langchain_usage(chunk)
+            if chunk and chunk.content:
+                got_content = True
+                yield chunk.content
+        if not got_content:
+            logging.warning("No response from DeepSeekAdapter.")
+
+    async def ainvoke(self, prompt: str) -> str:
+        response = await self._client.ainvoke(prompt)
         if not response:
             logging.warning("No response from DeepSeekAdapter.")
             return ""
+        _report_langchain_usage(response)
         return response.content
 
 class OpenAIAdapter(BaseLLMAdapter):
@@ -80,7 +335,11 @@ class OpenAIAdapter(BaseLLMAdapter):
         self.temperature = temperature
         self.timeout = timeout
 
-        self._client = ChatOpenAI(
+        self._client = self._build_client()
+
+    def _build_client(self):
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(
             model=self.model_name,
             api_key=self.api_key,
             base_url=self.base_url,
@@ -90,10 +349,29 @@ class OpenAIAdapter(BaseLLMAdapter):
         )
 
     def invoke(self, prompt: str) -> str:
-        response = self._client.invoke(prompt)
+        response = self._call_client().invoke(prompt)
+        if not response:
+            logging.warning("No response from OpenAIAdapter.")
+            return ""
+        _report_langchain_usage(response)
+        return response.content
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        got_content = False
+        for chunk in self._call_client().stream(prompt, stream_usage=True):
+            _report_langchain_usage(chunk)
+            if chunk and chunk.content:
+                got_content = True
+                yield chunk.content
+        if not got_content:
+            logging.warning("No response from OpenAIAdapter.")
+
+    async def ainvoke(self, prompt: str) -> str:
+        response = await self._client.ainvoke(prompt)
         if not response:
             logging.warning("No response from OpenAIAdapter.")
             return ""
+        _report_langchain_usage(response)
         return response.content
 
 class GeminiAdapter(BaseLLMAdapter):
@@ -109,6 +387,7 @@ class GeminiAdapter(BaseLLMAdapter):
         self.temperature = temperature
         self.timeout = timeout
 
+        import google.generativeai as genai
         # 配置API密钥
         genai.configure(api_key=self.api_key)
         
@@ -116,6 +395,7 @@ class GeminiAdapter(BaseLLMAdapter):
         self._model = genai.GenerativeModel(model_name=self.model_name)
 
     def invoke(self, prompt: str) -> str:
+        import google.generativeai as genai
         try:
             # 设置生成配置
             generation_config = genai.types.GenerationConfig(
@@ -129,6 +409,7 @@ class GeminiAdapter(BaseLLMAdapter):
                 generation_config=generation_config
             )
             
+            _report_gemini_usage(response)
             if response and response.text:
                 return response.text
             else:
@@ -136,7 +417,49 @@ class GeminiAdapter(BaseLLMAdapter):
                 return ""
         except Exception as e:
             logging.error(f"Gemini API 调用失败: {e}")
-            return ""
+            raise
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        import google.generativeai as genai
+        try:
+            generation_config = genai.types.GenerationConfig(
+                max_output_tokens=self.max_tokens,
+                temperature=self.temperature,
+            )
+            response = self._model.generate_content(
+                prompt,
+                generation_config=generation_config,
+                stream=True
+            )
+            for chunk in response:
+                _report_gemini_usage(chunk)
+                # 被安全策略拦截的分片没有 text，访问会抛异常
+                if chunk.parts:
+                    yield chunk.text
+        except Exception as e:
+            logging.error(f"Gemini API 流式调用失败: {e}")
+            raise
+
+    async def ainvoke(self, prompt: str) -> str:
+        import google.generativeai as genai
+        try:
+            generation_config = genai.types.GenerationConfig(
+                max_output_tokens=self.max_tokens,
+                temperature=self.temperature,
+            )
+            response = await self._model.generate_content_async(
+                prompt,
+                generation_config=generation_config
+            )
+            _report_gemini_usage(response)
+            if response and response.text:
+                return response.text
+            else:
+                logging.warning("No text response from Gemini API.")
+                return ""
+        except Exception as e:
+            logging.error(f"Gemini API 异步调用失败: {e}")
+            raise
 
 class AzureOpenAIAdapter(BaseLLMAdapter):
     """
@@ -158,7 +481,11 @@ class AzureOpenAIAdapter(BaseLLMAdapter):
         self.temperature = temperature
         self.timeout = timeout
 
-        self._client = AzureChatOpenAI(
+        self._client = self._build_client()
+
+    def _build_client(self):
+        from langchain_openai import AzureChatOpenAI
+        return AzureChatOpenAI(
             azure_endpoint=self.azure_endpoint,
             azure_deployment=self.azure_deployment,
             api_version=self.api_version,
@@ -169,10 +496,29 @@ class AzureOpenAIAdapter(BaseLLMAdapter):
         )
 
     def invoke(self, prompt: str) -> str:
-        response = self._client.invoke(prompt)
+        response = self._call_client().invoke(prompt)
         if not response:
             logging.warning("No response from AzureOpenAIAdapter.")
             return ""
+        _report_langchain_usage(response)
+        return response.content
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        got_content = False
+        for chunk in self._call_client().stream(prompt, stream_usage=True):
+            _report_langchain_usage(chunk)
+            if chunk and chunk.content:
+                got_content = True
+                yield chunk.content
+        if not got_content:
+            logging.warning("No response from AzureOpenAIAdapter.")
+
+    async def ainvoke(self, prompt: str) -> str:
+        response = await self._client.ainvoke(prompt)
+        if not response:
+            logging.warning("No response from AzureOpenAIAdapter.")
+            return ""
+        _report_langchain_usage(response)
         return response.content
 
 class OllamaAdapter(BaseLLMAdapter):
@@ -190,7 +536,11 @@ class OllamaAdapter(BaseLLMAdapter):
         if self.api_key == '':
             self.api_key= 'ollama'
 
-        self._client = ChatOpenAI(
+        self._client = self._build_client()
+
+    def _build_client(self):
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(
             model=self.model_name,
             api_key=self.api_key,
             base_url=self.base_url,
@@ -200,10 +550,29 @@ class OllamaAdapter(BaseLLMAdapter):
         )
 
     def invoke(self, prompt: str) -> str:
-        response = self._client.invoke(prompt)
+        response = self._call_client().invoke(prompt)
+        if not response:
+            logging.warning("No response from OllamaAdapter.")
+            return ""
+        _report_langchain_usage(response)
+        return response.content
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        got_content = False
+        for chunk in self._call_client().stream(prompt, stream_usage=True):
+            _report_langchain_usage(chunk)
+            if chunk and chunk.content:
+                got_content = True
+                yield chunk.content
+        if not got_content:
+            logging.warning("No response from OllamaAdapter.")
+
+    async def ainvoke(self, prompt: str) -> str:
+        response = await self._client.ainvoke(prompt)
         if not response:
             logging.warning("No response from OllamaAdapter.")
             return ""
+        _report_langchain_usage(response)
         return response.content
 
 class MLStudioAdapter(BaseLLMAdapter):
@@ -215,7 +584,11 @@ class MLStudioAdapter(BaseLLMAdapter):
         self.temperature = temperature
         self.timeout = timeout
 
-        self._client = ChatOpenAI(
+        self._client = self._build_client()
+
+    def _build_client(self):
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(
             model=self.model_name,
             api_key=self.api_key,
             base_url=self.base_url,
@@ -226,14 +599,37 @@ class MLStudioAdapter(BaseLLMAdapter):
 
     def invoke(self, prompt: str) -> str:
         try:
-            response = self._client.invoke(prompt)
+            response = self._call_client().invoke(prompt)
             if not response:
                 logging.warning("No response from MLStudioAdapter.")
                 return ""
+            _report_langchain_usage(response)
             return response.content
         except Exception as e:
             logging.error(f"ML Studio API 调用超时或失败: {e}")
-            return ""
+            raise
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        try:
+            for chunk in self._call_client().stream(prompt, stream_usage=True):
+                _report_langchain_usage(chunk)
+                if chunk and chunk.content:
+                    yield chunk.content
+        except Exception as e:
+            logging.error(f"ML Studio API 流式调用超时或失败: {e}")
+            raise
+
+    async def ainvoke(self, prompt: str) -> str:
+        try:
+            response = await self._client.ainvoke(prompt)
+            if not response:
+                logging.warning("No response from MLStudioAdapter.")
+                return ""
+            _report_langchain_usage(response)
+            return response.content
+        except Exception as e:
+            logging.error(f"ML Studio API 异步调用超时或失败: {e}")
+            raise
 
 class AzureAIAdapter(BaseLLMAdapter):
     """
@@ -259,7 +655,12 @@ class AzureAIAdapter(BaseLLMAdapter):
         self.temperature = temperature
         self.timeout = timeout
 
-        self._client = ChatCompletionsClient(
+        self._client = self._build_client()
+
+    def _build_client(self):
+        from azure.ai.inference import ChatCompletionsClient
+        from azure.core.credentials import AzureKeyCredential
+        return ChatCompletionsClient(
             endpoint=self.endpoint,
             credential=AzureKeyCredential(self.api_key),
             model=self.model_name,
@@ -269,21 +670,74 @@ class AzureAIAdapter(BaseLLMAdapter):
         )
 
     def invoke(self, prompt: str) -> str:
+        from azure.ai.inference.models import SystemMessage, UserMessage
         try:
-            response = self._client.complete(
+            response = self._call_client().complete(
                 messages=[
                     SystemMessage("You are a helpful assistant."),
                     UserMessage(prompt)
                 ]
             )
             if response and response.choices:
+                _report_openai_usage(response)
                 return response.choices[0].message.content
             else:
                 logging.warning("No response from AzureAIAdapter.")
                 return ""
         except Exception as e:
             logging.error(f"Azure AI Inference API 调用失败: {e}")
-            return ""
+            raise
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        from azure.ai.inference.models import SystemMessage, UserMessage
+        try:
+            response = self._call_client().complete(
+                stream=True,
+                messages=[
+                    SystemMessage("You are a helpful assistant."),
+                    UserMessage(prompt)
+                ]
+            )
+            for update in response:
+                _report_openai_usage(update)
+                if update.choices and update.choices[0].delta.content:
+                    yield update.choices[0].delta.content
+        except Exception as e:
+            logging.error(f"Azure AI Inference API 流式调用失败: {e}")
+            raise
+
+    async def ainvoke(self, prompt: str) -> str:
+        from azure.ai.inference.aio import ChatCompletionsClient as AsyncChatCompletionsClient
+        from azure.ai.inference.models import SystemMessage, UserMessage
+        from azure.core.credentials import AzureKeyCredential
+        client = self._get_async_client(lambda: AsyncChatCompletionsClient(
+            endpoint=self.endpoint,
+            credential=AzureKeyCredential(self.api_key),
+            model=self.model_name,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            timeout=self.timeout
+        ))
+        try:
+            response = await client.complete(
+                messages=[
+                    SystemMessage("You are a helpful assistant."),
+                    UserMessage(prompt)
+                ]
+            )
+            if response and response.choices:
+                _report_openai_usage(response)
+                return response.choices[0].message.content
+            else:
+                logging.warning("No response from AzureAIAdapter.")
+                return ""
+        except Exception as e:
+            logging.error(f"Azure AI Inference API 异步调用失败: {e}")
+            raise
+
+# 固定的系统提示位于每个请求的最前面，保持逐字不变才能命中供应商的前缀缓存
+DEEPSEEK_SYSTEM_PROMPT = "你是DeepSeek，是一个 AI 人工智能助手"
+GROK_SYSTEM_PROMPT = "You are Grok, created by xAI."
 
 # 火山引擎实现
 class VolcanoEngineAIAdapter(BaseLLMAdapter):
@@ -295,28 +749,71 @@ class VolcanoEngineAIAdapter(BaseLLMAdapter):
         self.temperature = temperature
         self.timeout = timeout
 
-        self._client = OpenAI(
-            base_url=base_url,
-            api_key=api_key,
-            timeout=timeout  # 添加超时配置
+        # SDK 直接使用传入的地址（不经 check_base_url 补全）
+        self._sdk_base_url = base_url
+        self._client = self._build_client()
+
+    def _build_client(self):
+        from openai import OpenAI
+        return OpenAI(
+            base_url=self._sdk_base_url,
+            api_key=self.api_key,
+            timeout=self.timeout  # 添加超时配置
         )
+
     def invoke(self, prompt: str) -> str:
         try:
-            response = self._client.chat.completions.create(
+            response = self._call_client().chat.completions.create(
                 model=self.model_name,
-                messages=[
-                    {"role": "system", "content": "你是DeepSeek，是一个 AI 人工智能助手"},
-                    {"role": "user", "content": prompt},
-                ],
+                messages=build_chat_messages(prompt, DEEPSEEK_SYSTEM_PROMPT),
                 timeout=self.timeout  # 添加超时参数
             )
             if not response:
                 logging.warning("No response from DeepSeekAdapter.")
                 return ""
+            _report_openai_usage(response)
             return response.choices[0].message.content
         except Exception as e:
             logging.error(f"火山引擎API调用超时或失败: {e}")
-            return ""
+            raise
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        try:
+            response = self._call_client().chat.completions.create(
+                model=self.model_name,
+                messages=build_chat_messages(prompt, DEEPSEEK_SYSTEM_PROMPT),
+                stream=True,
+                timeout=self.timeout
+            )
+            for chunk in response:
+                _report_openai_usage(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            logging.error(f"火山引擎API流式调用超时或失败: {e}")
+            raise
+
+    async def ainvoke(self, prompt: str) -> str:
+        from openai import AsyncOpenAI
+        client = self._get_async_client(lambda: AsyncOpenAI(
+            base_url=self._client.base_url,  # 与同步客户端保持一致
+            api_key=self.api_key,
+            timeout=self.timeout
+        ))
+        try:
+            response = await client.chat.completions.create(
+                model=self.model_name,
+                messages=build_chat_messages(prompt, DEEPSEEK_SYSTEM_PROMPT),
+                timeout=self.timeout
+            )
+            if not response:
+                logging.warning("No response from DeepSeekAdapter.")
+                return ""
+            _report_openai_usage(response)
+            return response.choices[0].message.content
+        except Exception as e:
+            logging.error(f"火山引擎API异步调用超时或失败: {e}")
+            raise
 
 class SiliconFlowAdapter(BaseLLMAdapter):
     def __init__(self, api_key: str, base_url: str, model_name: str, max_tokens: int, temperature: float = 0.7, timeout: Optional[int] = 600):
@@ -327,28 +824,71 @@ class SiliconFlowAdapter(BaseLLMAdapter):
         self.temperature = temperature
         self.timeout = timeout
 
-        self._client = OpenAI(
-            base_url=base_url,
-            api_key=api_key,
-            timeout=timeout  # 添加超时配置
+        # SDK 直接使用传入的地址（不经 check_base_url 补全）
+        self._sdk_base_url = base_url
+        self._client = self._build_client()
+
+    def _build_client(self):
+        from openai import OpenAI
+        return OpenAI(
+            base_url=self._sdk_base_url,
+            api_key=self.api_key,
+            timeout=self.timeout  # 添加超时配置
         )
+
     def invoke(self, prompt: str) -> str:
         try:
-            response = self._client.chat.completions.create(
+            response = self._call_client().chat.completions.create(
                 model=self.model_name,
-                messages=[
-                    {"role": "system", "content": "你是DeepSeek，是一个 AI 人工智能助手"},
-                    {"role": "user", "content": prompt},
-                ],
+                messages=build_chat_messages(prompt, DEEPSEEK_SYSTEM_PROMPT),
                 timeout=self.timeout  # 添加超时参数
             )
             if not response:
                 logging.warning("No response from DeepSeekAdapter.")
                 return ""
+            _report_openai_usage(response)
             return response.choices[0].message.content
         except Exception as e:
             logging.error(f"硅基流动API调用超时或失败: {e}")
-            return ""
+            raise
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        try:
+            response = self._call_client().chat.completions.create(
+                model=self.model_name,
+                messages=build_chat_messages(prompt, DEEPSEEK_SYSTEM_PROMPT),
+                stream=True,
+                timeout=self.timeout
+            )
+            for chunk in response:
+                _report_openai_usage(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            logging.error(f"硅基流动API流式调用超时或失败: {e}")
+            raise
+
+    async def ainvoke(self, prompt: str) -> str:
+        from openai import AsyncOpenAI
+        client = self._get_async_client(lambda: AsyncOpenAI(
+            base_url=self._client.base_url,  # 与同步客户端保持一致
+            api_key=self.api_key,
+            timeout=self.timeout
+        ))
+        try:
+            response = await client.chat.completions.create(
+                model=self.model_name,
+                messages=build_chat_messages(prompt, DEEPSEEK_SYSTEM_PROMPT),
+                timeout=self.timeout
+            )
+            if not response:
+                logging.warning("No response from DeepSeekAdapter.")
+                return ""
+            _report_openai_usage(response)
+            return response.choices[0].message.content
+        except Exception as e:
+            logging.error(f"硅基流动API异步调用超时或失败: {e}")
+            raise
 # grok實現
 class GrokAdapter(BaseLLMAdapter):
     """
@@ -362,7 +902,11 @@ class GrokAdapter(BaseLLMAdapter):
         self.temperature = temperature
         self.timeout = timeout
 
-        self._client = OpenAI(
+        self._client = self._build_client()
+
+    def _build_client(self):
+        from openai import OpenAI
+        return OpenAI(
             base_url=self.base_url,
             api_key=self.api_key,
             timeout=self.timeout
@@ -370,24 +914,920 @@ class GrokAdapter(BaseLLMAdapter):
 
     def invoke(self, prompt: str) -> str:
         try:
-            response = self._client.chat.completions.create(
+            response = self._call_client().chat.completions.create(
                 model=self.model_name,
-                messages=[
-                    {"role": "system", "content": "You are Grok, created by xAI."},
-                    {"role": "user", "content": prompt},
-                ],
+                messages=build_chat_messages(prompt, GROK_SYSTEM_PROMPT),
                 max_tokens=self.max_tokens,
                 temperature=self.temperature,
                 timeout=self.timeout
             )
             if response and response.choices:
+                _report_openai_usage(response)
                 return response.choices[0].message.content
             else:
                 logging.warning("No response from GrokAdapter.")
                 return ""
         except Exception as e:
             logging.error(f"Grok API 调用失败: {e}")
-            return ""
+            raise
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        try:
+            response = self._call_client().chat.completions.create(
+                model=self.model_name,
+                messages=build_chat_messages(prompt, GROK_SYSTEM_PROMPT),
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+                stream=True,
+                timeout=self.timeout
+            )
+            for chunk in response:
+                _report_openai_usage(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            logging.error(f"Grok API 流式调用失败: {e}")
+            raise
+
+    async def ainvoke(self, prompt: str) -> str:
+        from openai import AsyncOpenAI
+        client = self._get_async_client(lambda: AsyncOpenAI(
+            base_url=self.base_url,
+            api_key=self.api_key,
+            timeout=self.timeout
+        ))
+        try:
+            response = await client.chat.completions.create(
+                model=self.model_name,
+                messages=build_chat_messages(prompt, GROK_SYSTEM_PROMPT),
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+                timeout=self.timeout
+            )
+            if response and response.choices:
+                _report_openai_usage(response)
+                return response.choices[0].message.content
+            else:
+                logging.warning("No response from GrokAdapter.")
+                return ""
+        except Exception as e:
+            logging.error(f"Grok API 异步调用失败: {e}")
+            raise
+
+class _MockConnection:
+    """模拟后端的"连接"：close() 后正在等待的请求立即以连接错误结束，用于模拟中断 HTTP 连接"""
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def sleep(self, seconds: float):
+        if self.closed.wait(max(0.0, seconds)):
+            raise ConnectionError("Mock connection closed")
+
+    def close(self):
+        self.closed.set()
+
+class MockAdapter(BaseLLMAdapter):
+    """
+    离线模拟后端（interface_format 为 "mock"），不发出网络请求，用于压测与计时。
+    延迟、输出速度、错误率与固定回复见 mock_backend（config.json 的 mock_backend 配置）。
+    """
+    def __init__(self, api_key: str, base_url: str, model_name: str, max_tokens: int, temperature: float = 0.7, timeout: Optional[int] = 600):
+        self.base_url = base_url or "mock://local"
+        self.api_key = api_key
+        self.model_name = model_name or "mock"
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.timeout = timeout
+        self._responder = None
+        self._options = None
+        self._lock = threading.Lock()
+        self._client = self._build_client()
+
+    def _build_client(self):
+        return _MockConnection()
+
+    def _get_responder(self):
+        from mock_backend import MockResponder, get_mock_options
+        options = get_mock_options()
+        with self._lock:
+            if self._responder is None or options != self._options:
+                self._responder = MockResponder(options)
+                self._options = options
+            return self._responder
+
+    def _prepare(self, prompt: str):
+        from mock_backend import MockBackendError
+        responder = self._get_responder()
+        if responder.should_fail():
+            raise MockBackendError("Mock backend injected error (503).")
+        text, finish_reason = responder.truncate(responder.respond(prompt), self.max_tokens)
+        return responder, text, finish_reason
+
+    def invoke(self, prompt: str) -> str:
+        responder, text, finish_reason = self._prepare(prompt)
+        self._call_client().sleep(float(responder.options["latency"]) + responder.generation_time(text))
+        report_usage(estimate_tokens(prompt), estimate_tokens(text), finish_reason)
+        return text
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        responder, text, finish_reason = self._prepare(prompt)
+        connection = self._call_client()
+        connection.sleep(float(responder.options["latency"]))
+        for chunk in responder.chunks(text):
+            connection.sleep(responder.chunk_delay(chunk))
+            yield chunk
+        report_usage(estimate_tokens(prompt), estimate_tokens(text), finish_reason)
+
+    async def ainvoke(self, prompt: str) -> str:
+        responder, text, finish_reason = self._prepare(prompt)
+        await asyncio.sleep(float(responder.options["latency"]) + responder.generation_time(text))
+        report_usage(estimate_tokens(prompt), estimate_tokens(text), finish_reason)
+        return text
+
+# ============== 适配器包装 ==============
+class AdapterWrapper(BaseLLMAdapter):
+    """
+    包装另一个适配器的基类：默认透传所有调用，未定义的属性（model_name、base_url 等）从内层适配器读取。
+    """
+    def __init__(self, inner: BaseLLMAdapter):
+        self.inner = inner
+
+    def __getattr__(self, name):
+        if name == "inner":
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    def unwrap(self) -> BaseLLMAdapter:
+        return self.inner.unwrap()
+
+    def invoke(self, prompt: str) -> str:
+        return self.inner.invoke(prompt)
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        yield from self.inner.invoke_stream(prompt)
+
+    async def ainvoke(self, prompt: str) -> str:
+        return await self.inner.ainvoke(prompt)
+
+    def close(self):
+        self.inner.close()
+
+class _LimiterSlot:
+    """
+    一个已占用的并发名额：调用结束时释放；当前令牌被取消时立即释放，
+    不必等被中断的调用真正返回（无法断开连接的 SDK 可能要到超时才返回）。只释放一次。
+    """
+    def __init__(self, limiter):
+        self._limiter = limiter
+        self._lock = threading.Lock()
+        self._released = False
+        token = current_token()
+        self._remove = token.add_callback(self.release) if token is not None else (lambda: None)
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._limiter.release()
+
+    def close(self):
+        self._remove()
+        self.release()
+
+class RateLimitedAdapter(AdapterWrapper):
+    """
+    在调用前经过该配置的本地限流器（rate_limiter.configure_rate_limits 按 llm_configs 建立），
+    同一配置创建的所有适配器共享同一个限流器；未配置限流时直接透传。
+    排队时按提示词长度预估 token，调用结束后再按输出长度补记；排队时间记入当前调用的用量记录。
+    同步调用的名额在当前令牌被取消时立即归还。
+    """
+    def __init__(self, inner: BaseLLMAdapter, interface_format: str, base_url: str, model_name: str):
+        super().__init__(inner)
+        self._limit_key = (interface_format, base_url, model_name)
+
+    def _limiter(self):
+        return get_rate_limiter(*self._limit_key)
+
+    @staticmethod
+    def _record_queue_wait(waited: float):
+        # 适配器在线程间共享，排队时间只能记在各自调用的记录上
+        record = current_usage()
+        if record is not None:
+            record.queue_wait += waited
+
+    def invoke(self, prompt: str) -> str:
+        limiter = self._limiter()
+        if limiter is None:
+            return self.inner.invoke(prompt)
+        self._record_queue_wait(limiter.acquire(estimate_tokens(prompt)))
+        slot = _LimiterSlot(limiter)
+        try:
+            result = self.inner.invoke(prompt)
+        finally:
+            slot.close()
+        limiter.record_completion(estimate_tokens(result))
+        return result
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        limiter = self._limiter()
+        if limiter is None:
+            yield from self.inner.invoke_stream(prompt)
+            return
+        self._record_queue_wait(limiter.acquire(estimate_tokens(prompt)))
+        slot = _LimiterSlot(limiter)
+        chunks = []
+        try:
+            for chunk in self.inner.invoke_stream(prompt):
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            slot.close()
+            limiter.record_completion(estimate_tokens("".join(chunks)))
+
+    async def ainvoke(self, prompt: str) -> str:
+        limiter = self._limiter()
+        if limiter is None:
+            return await self.inner.ainvoke(prompt)
+        # 限流器基于线程同步原语，排队放到线程池中，避免阻塞事件循环
+        acquiring = asyncio.ensure_future(asyncio.to_thread(limiter.acquire, estimate_tokens(prompt)))
+        try:
+            self._record_queue_wait(await asyncio.shield(acquiring))
+        except asyncio.CancelledError:
+            # 排队的线程无法中断：任务被取消后若仍拿到名额，立即归还
+            acquiring.add_done_callback(
+                lambda f: None if f.cancelled() or f.exception() is not None else limiter.release()
+            )
+            raise
+        try:
+            result = await self.inner.ainvoke(prompt)
+        finally:
+            limiter.release()
+        limiter.record_completion(estimate_tokens(result))
+        return result
+
+# 受取消令牌控制的调用在此线程池中执行，调用方线程可在取消时立即返回
+_call_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-call")
+_STREAM_END = object()
+_WAKE = object()
+
+class CancellableAdapter(AdapterWrapper):
+    """
+    按当前上下文的取消令牌（cancellation.current_token）中断调用：
+    - 同步与流式调用在线程池中执行（同步调用仍是非流式请求），取消或超过截止时间时调用方立即返回，
+      同时断开该调用独占客户端的连接（见 _InterruptibleCall），阻塞在读取上的工作线程随即退出；
+      不支持独占客户端的 SDK（Gemini）无法断开，工作线程要等上游返回；
+    - 异步调用取消对应任务。
+    限流名额在令牌被取消时立即归还（见 RateLimitedAdapter）。未设置令牌时直接透传。
+    """
+    def invoke(self, prompt: str) -> str:
+        token = current_token()
+        if token is None:
+            return self.inner.invoke(prompt)
+        token.check()
+        call = _InterruptibleCall()
+        woken = threading.Event()
+
+        def run():
+            with call.active():
+                return self.inner.invoke(prompt)
+
+        future = _call_executor.submit(contextvars.copy_context().run, run)
+        future.add_done_callback(lambda f: woken.set())
+        remove = token.add_callback(woken.set)
+        try:
+            while not woken.wait(token.remaining()):
+                token.check()
+            token.check()
+            return future.result()
+        finally:
+            remove()
+            if not future.done():
+                call.abort()
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        token = current_token()
+        if token is None:
+            yield from self.inner.invoke_stream(prompt)
+            return
+        token.check()
+        call = _InterruptibleCall()
+        chunks = queue.Queue()
+        stopped = threading.Event()
+
+        def produce():
+            with call.active():
+                stream = self.inner.invoke_stream(prompt)
+                try:
+                    for chunk in stream:
+                        if stopped.is_set():
+                            break
+                        chunks.put(chunk)
+                except BaseException as e:
+                    chunks.put(e)
+                finally:
+                    # 提前结束时关闭生成器，SDK 随之关闭流式响应
+                    stream.close()
+                    chunks.put(_STREAM_END)
+
+        _call_executor.submit(contextvars.copy_context().run, produce)
+        remove = token.add_callback(lambda: chunks.put(_WAKE))
+        finished = False
+        try:
+            while True:
+                try:
+                    item = chunks.get(timeout=token.remaining())
+                except queue.Empty:
+                    token.check()
+                    continue
+                if item is _WAKE:
+                    token.check()
+                    continue
+                if item is _STREAM_END:
+                    finished = True
+                    token.check()
+                    return
+                if isinstance(item, BaseException):
+                    finished = True
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+            remove()
+            if not finished:
+                call.abort()
+
+    async def ainvoke(self, prompt: str) -> str:
+        token = current_token()
+        if token is None:
+            return await self.inner.ainvoke(prompt)
+        token.check()
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(self.inner.ainvoke(prompt))
+        remove = token.add_callback(lambda: loop.call_soon_threadsafe(task.cancel))
+        try:
+            await asyncio.wait({task}, timeout=token.remaining())
+        finally:
+            remove()
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        if task.cancelled():
+            token.check()
+            raise asyncio.CancelledError()
+        return task.result()
+
+# 跟随者等待领头者时检查取消令牌的间隔（秒）
+_FOLLOWER_POLL_SECONDS = 0.2
+
+class _Flight:
+    """一次正在进行的上游调用：领头者写入输出片段，跟随者读取同一份输出"""
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.abandoned = False
+        self.error = None
+        # 领头者的结束原因与缓存命中，跟随者据此判断是否被截断
+        self.finish_reason = None
+        self.cached_tokens = None
+        self.cond = threading.Condition()
+        self._waiters = []
+
+    def append(self, chunk: str):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+
+    def finish(self, error: Exception = None, abandoned: bool = False):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.abandoned = abandoned
+            self.cond.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for notify in waiters:
+            notify()
+
+    def iter_chunks(self) -> Iterator[str]:
+        """依次产出已收到与后续收到的片段，直到调用结束；领头者出错时抛出同一异常"""
+        index = 0
+        while True:
+            with self.cond:
+                while index >= len(self.chunks) and not self.done:
+                    self.cond.wait(_FOLLOWER_POLL_SECONDS)
+                    cancellation.check_cancelled()
+                pending = self.chunks[index:]
+                index = len(self.chunks)
+                finished = self.done
+            yield from pending
+            if finished and index >= len(self.chunks):
+                if self.error is not None:
+                    raise self.error
+                return
+
+    def wait(self):
+        """等待调用结束；跟随者自己的令牌被取消时抛出 OperationCancelled（不影响领头者）"""
+        with self.cond:
+            while not self.done:
+                self.cond.wait(_FOLLOWER_POLL_SECONDS)
+                cancellation.check_cancelled()
+
+    async def await_done(self):
+        """wait 的异步版本：同时等待调用结束与当前令牌被取消，不占用线程"""
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        notify = lambda: loop.call_soon_threadsafe(woken.set)
+        with self.cond:
+            if self.done:
+                return
+            self._waiters.append(notify)
+        token = current_token()
+        remove = token.add_callback(notify) if token is not None else (lambda: None)
+        try:
+            while not self.done:
+                try:
+                    await asyncio.wait_for(woken.wait(), token.remaining() if token is not None else None)
+                except asyncio.TimeoutError:
+                    pass
+                woken.clear()
+                cancellation.check_cancelled()
+        finally:
+            remove()
+            with self.cond:
+                if notify in self._waiters:
+                    self._waiters.remove(notify)
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+class SingleFlightAdapter(AdapterWrapper):
+    """
+    合并并发的相同请求：同一配置、相同提示词的调用正在进行时，后来者不再发起上游请求，
+    而是等待（流式调用则跟随）同一次调用的输出。领头者被放弃（如被取消）时，跟随者各自重新发起；
+    跟随者自己被取消时只退出等待，领头者继续。
+    """
+    def __init__(self, inner: BaseLLMAdapter, config_key: tuple):
+        super().__init__(inner)
+        self._config_key = config_key
+
+    def _flight_key(self, prompt: str) -> tuple:
+        return self._config_key + (hashlib.sha256(str(prompt).encode("utf-8")).hexdigest(),)
+
+    def _join(self, key: tuple):
+        """返回 (flight, 是否为领头者)"""
+        with _flights_lock:
+            flight = _flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = _Flight()
+            _flights[key] = flight
+            return flight, True
+
+    @staticmethod
+    def _leave(key: tuple, flight: _Flight, error: Exception = None, abandoned: bool = False):
+        with _flights_lock:
+            if _flights.get(key) is flight:
+                del _flights[key]
+        flight.finish(error, abandoned)
+
+    @staticmethod
+    def _capture_usage(flight: _Flight):
+        """领头者成功返回后记下本次调用的结束原因与缓存命中"""
+        record = current_usage()
+        if record is not None:
+            flight.finish_reason = record.finish_reason
+            flight.cached_tokens = record.cached_tokens
+
+    @staticmethod
+    def _mark_shared(flight: _Flight):
+        # 跟随者没有产生上游用量，但结束原因与领头者相同（如 length 时需要续写）
+        record = current_usage()
+        if record is not None:
+            record.shared = True
+        report_usage(0, 0, finish_reason=flight.finish_reason, cached_tokens=flight.cached_tokens)
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        key = self._flight_key(prompt)
+        while True:
+            flight, leader = self._join(key)
+            if leader:
+                break
+            logging.info(f"[single-flight] Joined in-flight request for {self._config_key[2]}")
+            chunks = []
+            for chunk in flight.iter_chunks():
+                chunks.append(chunk)
+                yield chunk
+            if not flight.abandoned:
+                self._mark_shared(flight)
+                return
+            if chunks:
+                raise RuntimeError("Shared LLM request was abandoned mid-stream")
+
+        try:
+            for chunk in self.inner.invoke_stream(prompt):
+                flight.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            self._leave(key, flight, abandoned=True)
+            raise
+        except Exception as e:
+            self._leave(key, flight, error=e)
+            raise
+        except BaseException:
+            self._leave(key, flight, abandoned=True)
+            raise
+        self._capture_usage(flight)
+        self._leave(key, flight)
+
+    def invoke(self, prompt: str) -> str:
+        key = self._flight_key(prompt)
+        while True:
+            flight, leader = self._join(key)
+            if leader:
+                break
+            logging.info(f"[single-flight] Joined in-flight request for {self._config_key[2]}")
+            flight.wait()
+            if not flight.abandoned:
+                if flight.error is not None:
+                    raise flight.error
+                self._mark_shared(flight)
+                return "".join(flight.chunks)
+
+        try:
+            result = self.inner.invoke(prompt)
+        except Exception as e:
+            self._leave(key, flight, error=e)
+            raise
+        except BaseException:
+            self._leave(key, flight, abandoned=True)
+            raise
+        flight.append(result or "")
+        self._capture_usage(flight)
+        self._leave(key, flight)
+        return result
+
+    async def ainvoke(self, prompt: str) -> str:
+        key = self._flight_key(prompt)
+        while True:
+            flight, leader = self._join(key)
+            if leader:
+                break
+            logging.info(f"[single-flight] Joined in-flight request for {self._config_key[2]}")
+            await flight.await_done()
+            if not flight.abandoned:
+                if flight.error is not None:
+                    raise flight.error
+                self._mark_shared(flight)
+                return "".join(flight.chunks)
+
+        try:
+            result = await self.inner.ainvoke(prompt)
+        except Exception as e:
+            self._leave(key, flight, error=e)
+            raise
+        except BaseException:
+            # 任务被取消等情况：让跟随者自行重新发起
+            self._leave(key, flight, abandoned=True)
+            raise
+        flight.append(result or "")
+        self._capture_usage(flight)
+        self._leave(key, flight)
+        return result
+
+# ============== 多供应商路由 ==============
+class LatencyHistogram:
+    """
+    单个端点的延迟直方图（对数分桶，单位秒），用于估计延迟分位数。
+    样本累计到 decay_every 个时所有计数减半，使估计跟随供应商近期的表现。
+    """
+    BUCKETS = tuple(0.25 * (1.5 ** i) for i in range(22))
+
+    def __init__(self, min_samples: int = 5, decay_every: int = 200):
+        self.min_samples = min_samples
+        self.decay_every = decay_every
+        self._counts = [0.0] * (len(self.BUCKETS) + 1)
+        self._total = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self._lock = threading.Lock()
+
+    def _add(self, seconds: float):
+        self._counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self._total += 1
+        if self._total >= self.decay_every:
+            self._counts = [count / 2 for count in self._counts]
+            self._total /= 2
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._add(seconds)
+            self.successes += 1
+            self.consecutive_failures = 0
+
+    def record_censored(self, seconds: float):
+        """被取消的请求：实际延迟至少为 seconds，按此计入直方图但不计成功/失败"""
+        with self._lock:
+            self._add(seconds)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+
+    def percentile(self, p: float) -> Optional[float]:
+        """返回分位数所在桶的上界；样本不足时返回 None"""
+        with self._lock:
+            if self._total < self.min_samples:
+                return None
+            target = self._total * p
+            cumulative = 0.0
+            for i, count in enumerate(self._counts):
+                cumulative += count
+                if cumulative >= target:
+                    return self.BUCKETS[i] if i < len(self.BUCKETS) else self.BUCKETS[-1] * 1.5
+            return self.BUCKETS[-1] * 1.5
+
+    def snapshot(self) -> dict:
+        return {
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "successes": self.successes,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures
+        }
+
+# 直方图按端点全局保存，路由实例重建后仍沿用历史延迟数据
+_latency_histograms = {}
+_latency_histograms_lock = threading.Lock()
+
+def _get_latency_histogram(key: tuple) -> LatencyHistogram:
+    with _latency_histograms_lock:
+        histogram = _latency_histograms.get(key)
+        if histogram is None:
+            histogram = LatencyHistogram()
+            _latency_histograms[key] = histogram
+        return histogram
+
+def get_llm_latency_stats() -> dict:
+    """返回各端点的延迟分位数与成功/失败次数"""
+    with _latency_histograms_lock:
+        items = list(_latency_histograms.items())
+    return {"|".join(str(part) for part in key): histogram.snapshot() for key, histogram in items}
+
+# 同步对冲请求使用的线程池；落败的请求经各自的取消令牌中断，随即让出线程
+_router_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-router")
+
+class RouterAdapter(BaseLLMAdapter):
+    """
+    按顺序组合多个供应商适配器：
+    - 主端点在其延迟的 hedge_percentile 分位内未返回时，向下一个端点发出对冲请求，取最先返回的有效结果；
+    - 端点报错或返回空内容时立即切换到下一个端点；
+    - 各端点样本充足后按中位延迟排序，连续失败 unhealthy_after 次的端点排到最后。
+    落败的请求会被取消：异步调用取消对应任务，同步调用取消各端点请求各自的取消令牌（端点适配器随即断开上游流）。
+    流式调用不做对冲，仅在尚未产出任何内容前失败时切换端点。
+    unwrap() 返回主端点的供应商适配器，响应缓存与熔断器按主端点区分，不同路由不共用。
+    """
+    def __init__(self, backends: list, hedge_percentile: float = 0.9, initial_hedge_delay: float = 30.0,
+                 min_hedge_delay: float = 1.0, unhealthy_after: int = 3):
+        if not backends:
+            raise ValueError("RouterAdapter requires at least one backend.")
+        # backends: [(名称, 适配器), ...]，顺序即配置中的优先级
+        self.backends = [
+            (name, adapter, _get_latency_histogram(
+                (type(adapter.unwrap()).__name__, getattr(adapter, "base_url", ""), getattr(adapter, "model_name", ""))
+            ))
+            for name, adapter in backends
+        ]
+        self.hedge_percentile = hedge_percentile
+        self.initial_hedge_delay = initial_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.unhealthy_after = unhealthy_after
+        primary = backends[0][1]
+        self.base_url = getattr(primary, "base_url", "")
+        self.model_name = ",".join(str(getattr(adapter, "model_name", name)) for name, adapter in backends)
+        self.temperature = getattr(primary, "temperature", None)
+        self.max_tokens = getattr(primary, "max_tokens", None)
+        self.last_backend = None
+
+    def unwrap(self) -> BaseLLMAdapter:
+        return self.backends[0][1].unwrap()
+
+    def _ordered_backends(self) -> list:
+        healthy = [b for b in self.backends if b[2].consecutive_failures < self.unhealthy_after]
+        unhealthy = [b for b in self.backends if b[2].consecutive_failures >= self.unhealthy_after]
+        medians = [b[2].percentile(0.5) for b in healthy]
+        if healthy and all(m is not None for m in medians):
+            healthy = [b for _, b in sorted(zip(medians, healthy), key=lambda item: item[0])]
+        return healthy + unhealthy
+
+    def _hedge_delay(self, histogram: LatencyHistogram) -> float:
+        delay = histogram.percentile(self.hedge_percentile)
+        if delay is None:
+            delay = self.initial_hedge_delay
+        return max(self.min_hedge_delay, delay)
+
+    @staticmethod
+    def _invoke_with_token(adapter: BaseLLMAdapter, prompt: str, token: CancellationToken) -> str:
+        with cancellation_scope(token):
+            return adapter.invoke(prompt)
+
+    def invoke(self, prompt: str) -> str:
+        backends = self._ordered_backends()
+        pending = {}
+        tokens = []
+        next_index = 0
+        deadline = None
+        last_error = None
+
+        def launch():
+            nonlocal next_index, deadline
+            name, adapter, histogram = backends[next_index]
+            next_index += 1
+            start = time.monotonic()
+            # 每个端点的请求一个子令牌：调用方取消时一并取消，落败时单独取消
+            token = CancellationToken(parent=current_token())
+            tokens.append(token)
+            # 复制当前上下文，使工作线程中的用量上报仍记入本次调用
+            future = _router_executor.submit(contextvars.copy_context().run, self._invoke_with_token, adapter, prompt, token)
+            future.add_done_callback(lambda f: self._record(histogram, f, start))
+            pending[future] = (name, token)
+            deadline = start + self._hedge_delay(histogram)
+
+        try:
+            launch()
+            while pending:
+                cancellation.check_cancelled()
+                timeout = max(0.0, deadline - time.monotonic()) if next_index < len(backends) else None
+                done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    logging.info(f"[router] No response within hedge delay, hedging to '{backends[next_index][0]}'.")
+                    launch()
+                    continue
+                for future in done:
+                    name, _ = pending.pop(future)
+                    error = future.exception()
+                    if error is None and future.result():
+                        self.last_backend = name
+                        return future.result()
+                    if isinstance(error, OperationCancelled):
+                        cancellation.check_cancelled()
+                    last_error = error or ValueError(f"Empty response from '{name}'.")
+                    logging.warning(f"[router] Backend '{name}' failed: {last_error}")
+                if next_index < len(backends):
+                    launch()
+            raise last_error
+        finally:
+            for future, (_, token) in pending.items():
+                future.cancel()
+                token.cancel()
+            for token in tokens:
+                token.detach()
+
+    @staticmethod
+    def _record(histogram: LatencyHistogram, future, start: float):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if isinstance(error, OperationCancelled):
+            histogram.record_censored(time.monotonic() - start)
+        elif error is None and future.result():
+            histogram.record(time.monotonic() - start)
+        else:
+            histogram.record_failure()
+
+    def invoke_stream(self, prompt: str) -> Iterator[str]:
+        last_error = None
+        for name, adapter, histogram in self._ordered_backends():
+            start = time.monotonic()
+            started = False
+            try:
+                for chunk in adapter.invoke_stream(prompt):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                histogram.record_failure()
+                if started:
+                    raise
+                last_error = e
+                logging.warning(f"[router] Backend '{name}' failed before streaming: {e}")
+                continue
+            if started:
+                histogram.record(time.monotonic() - start)
+                self.last_backend = name
+                return
+            histogram.record_failure()
+            last_error = ValueError(f"Empty response from '{name}'.")
+        raise last_error
+
+    async def _timed_ainvoke(self, adapter: BaseLLMAdapter, histogram: LatencyHistogram, prompt: str) -> str:
+        start = time.monotonic()
+        try:
+            result = await adapter.ainvoke(prompt)
+        except asyncio.CancelledError:
+            histogram.record_censored(time.monotonic() - start)
+            raise
+        except Exception:
+            histogram.record_failure()
+            raise
+        if result:
+            histogram.record(time.monotonic() - start)
+        else:
+            histogram.record_failure()
+        return result
+
+    async def ainvoke(self, prompt: str) -> str:
+        backends = self._ordered_backends()
+        pending = {}
+        next_index = 0
+        deadline = None
+        last_error = None
+
+        def launch():
+            nonlocal next_index, deadline
+            name, adapter, histogram = backends[next_index]
+            next_index += 1
+            task = asyncio.ensure_future(self._timed_ainvoke(adapter, histogram, prompt))
+            pending[task] = name
+            deadline = time.monotonic() + self._hedge_delay(histogram)
+
+        launch()
+        try:
+            while pending:
+                timeout = max(0.0, deadline - time.monotonic()) if next_index < len(backends) else None
+                done, _ = await asyncio.wait(list(pending), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logging.info(f"[router] No response within hedge delay, hedging to '{backends[next_index][0]}'.")
+                    launch()
+                    continue
+                for task in done:
+                    name = pending.pop(task)
+                    error = task.exception()
+                    if error is None and task.result():
+                        self.last_backend = name
+                        return task.result()
+                    last_error = error or ValueError(f"Empty response from '{name}'.")
+                    logging.warning(f"[router] Backend '{name}' failed: {last_error}")
+                if next_index < len(backends):
+                    launch()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def close(self):
+        # 各端点适配器来自适配器池，由 close_all_llm_adapters 统一关闭
+        pass
+
+# ============== 进程级适配器池 ==============
+# 相同配置的适配器（及其 HTTP 连接池）在整个进程内复用，避免每次调用都重新握手。
+_adapter_pool = {}
+_adapter_pool_lock = threading.Lock()
+_adapter_pool_stats = {"created": 0, "reused": 0}
+
+def _adapter_pool_key(interface_format, base_url, model_name, api_key, temperature, max_tokens, timeout) -> tuple:
+    return (
+        interface_format.strip().lower(),
+        (base_url or "").strip(),
+        model_name,
+        api_key,
+        float(temperature),
+        int(max_tokens),
+        timeout
+    )
+
+def get_llm_adapter_pool_stats() -> dict:
+    """返回适配器池的统计信息：新建次数、复用次数、复用率与当前池大小。"""
+    with _adapter_pool_lock:
+        created = _adapter_pool_stats["created"]
+        reused = _adapter_pool_stats["reused"]
+        total = created + reused
+        return {
+            "created": created,
+            "reused": reused,
+            "reuse_rate": (reused / total) if total else 0.0,
+            "pooled": len(_adapter_pool)
+        }
+
+def close_all_llm_adapters():
+    """关闭池中所有适配器的连接并清空池，程序退出时自动调用。"""
+    with _adapter_pool_lock:
+        adapters = list(_adapter_pool.values())
+        _adapter_pool.clear()
+    for adapter in adapters:
+        adapter.close()
+    if adapters:
+        stats = get_llm_adapter_pool_stats()
+        logging.info(
+            f"LLM adapter pool closed: {len(adapters)} adapters, "
+            f"created={stats['created']}, reused={stats['reused']}."
+        )
+
+atexit.register(close_all_llm_adapters)
 
 def create_llm_adapter(
     interface_format: str,
@@ -400,6 +1840,181 @@ def create_llm_adapter(
 ) -> BaseLLMAdapter:
     """
     工厂函数：根据 interface_format 返回不同的适配器实例。
+    相同配置会直接返回池中已有的实例，以复用其 HTTP 连接。
+    若该配置在 llm_configs 中设置了 fallbacks，则返回以它为主端点的 RouterAdapter。
+    返回的适配器会合并同一配置下并发的相同请求（SingleFlightAdapter）。
+    """
+    adapter = _get_pooled_adapter(interface_format, base_url, model_name, api_key, temperature, max_tokens, timeout)
+    flight_key = _adapter_pool_key(interface_format, base_url, model_name, api_key, temperature, max_tokens, timeout)
+    with _llm_routes_lock:
+        route = _llm_routes.get(_route_key(interface_format, base_url, model_name))
+    if route is None:
+        return SingleFlightAdapter(adapter, flight_key)
+    backends = [(model_name, adapter)] + [
+        (name, _adapter_from_config(conf)) for name, conf in route["fallbacks"]
+    ]
+    return SingleFlightAdapter(RouterAdapter(backends, hedge_percentile=route["hedge_percentile"]), flight_key)
+
+def create_router_adapter(llm_configs: list, hedge_percentile: float = 0.9) -> RouterAdapter:
+    """
+    按给定顺序组合多个 llm_configs 条目（字典，需含 interface_format、base_url、model_name 等字段），
+    返回带对冲与故障切换的 RouterAdapter。
+    """
+    backends = [(conf.get("model_name", ""), _adapter_from_config(conf)) for conf in llm_configs]
+    return RouterAdapter(backends, hedge_percentile=hedge_percentile)
+
+def _adapter_from_config(conf: dict) -> BaseLLMAdapter:
+    return _get_pooled_adapter(
+        conf.get("interface_format", "OpenAI"),
+        conf.get("base_url", ""),
+        conf.get("model_name", ""),
+        conf.get("api_key", ""),
+        conf.get("temperature", 0.7),
+        conf.get("max_tokens", 8192),
+        conf.get("timeout", 600)
+    )
+
+_llm_routes = {}
+_llm_routes_lock = threading.Lock()
+
+def _route_key(interface_format: str, base_url: str, model_name: str) -> tuple:
+    return (interface_format.strip().lower(), (base_url or "").strip(), model_name)
+
+def configure_llm_routes(llm_configs: dict):
+    """
+    根据 config.json 的 llm_configs 建立故障切换路由。
+    每个配置可选填 fallbacks（按优先级排列的其它配置名）与 hedge_percentile（对冲触发的延迟分位，默认 0.9）。
+    """
+    routes = {}
+    llm_configs = llm_configs or {}
+    for name, conf in llm_configs.items():
+        fallbacks = [(fb, llm_configs[fb]) for fb in conf.get("fallbacks", []) if fb in llm_configs and fb != name]
+        missing = [fb for fb in conf.get("fallbacks", []) if fb not in llm_configs]
+        if missing:
+            logging.warning(f"Unknown fallbacks for '{name}': {missing}")
+        if not fallbacks:
+            continue
+        key = _route_key(conf.get("interface_format", ""), conf.get("base_url", ""), conf.get("model_name", ""))
+        routes[key] = {"fallbacks": fallbacks, "hedge_percentile": float(conf.get("hedge_percentile", 0.9))}
+        logging.info(f"LLM route for '{name}': fallbacks={[fb for fb, _ in fallbacks]}")
+    with _llm_routes_lock:
+        _llm_routes.clear()
+        _llm_routes.update(routes)
+
+# 各阶段可在 config.json 的 stage_llms 中单独指定所用模型（llm_configs 中的配置名）
+LLM_STAGES = (
+    "summary", "keyword_search", "knowledge_filter", "draft",
+    "global_summary", "character_state", "enrich", "consistency"
+)
+
+_stage_llms = {}
+_stage_llms_lock = threading.Lock()
+
+def configure_stage_llms(stage_llms: dict, llm_configs: dict):
+    """
+    根据 config.json 的 stage_llms（阶段名 -> llm_configs 中的配置名）为各阶段指定模型。
+    未填写的阶段沿用调用方传入的模型（即 choose_configs 中对应角色的模型）。
+    """
+    stages = {}
+    llm_configs = llm_configs or {}
+    for stage, name in (stage_llms or {}).items():
+        if not name:
+            continue
+        if stage not in LLM_STAGES:
+            logging.warning(f"Unknown LLM stage '{stage}' in stage_llms")
+            continue
+        if name not in llm_configs:
+            logging.warning(f"Unknown LLM config '{name}' for stage '{stage}'")
+            continue
+        stages[stage] = llm_configs[name]
+        logging.info(f"LLM for stage '{stage}': {name}")
+    with _stage_llms_lock:
+        _stage_llms.clear()
+        _stage_llms.update(stages)
+
+def resolve_stage_llm(
+    stage: str,
+    interface_format: str,
+    base_url: str,
+    model_name: str,
+    api_key: str,
+    temperature: float,
+    max_tokens: int,
+    timeout: int
+) -> dict:
+    """
+    返回该阶段实际使用的 create_llm_adapter 参数：
+    stage_llms 中为该阶段指定了配置时使用该配置，否则原样返回传入的参数。
+    """
+    with _stage_llms_lock:
+        conf = _stage_llms.get(stage)
+    if conf is None:
+        return {
+            "interface_format": interface_format,
+            "base_url": base_url,
+            "model_name": model_name,
+            "api_key": api_key,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "timeout": timeout
+        }
+    return {
+        "interface_format": conf.get("interface_format", "OpenAI"),
+        "base_url": conf.get("base_url", ""),
+        "model_name": conf.get("model_name", ""),
+        "api_key": conf.get("api_key", ""),
+        "temperature": conf.get("temperature", temperature),
+        "max_tokens": conf.get("max_tokens", max_tokens),
+        "timeout": conf.get("timeout", timeout)
+    }
+
+def _get_pooled_adapter(
+    interface_format: str,
+    base_url: str,
+    model_name: str,
+    api_key: str,
+    temperature: float,
+    max_tokens: int,
+    timeout: int
+) -> BaseLLMAdapter:
+    key = _adapter_pool_key(interface_format, base_url, model_name, api_key, temperature, max_tokens, timeout)
+    with _adapter_pool_lock:
+        adapter = _adapter_pool.get(key)
+        if adapter is not None:
+            _adapter_pool_stats["reused"] += 1
+            return adapter
+
+    adapter = CancellableAdapter(
+        RateLimitedAdapter(
+            _build_llm_adapter(interface_format, base_url, model_name, api_key, temperature, max_tokens, timeout),
+            interface_format, base_url, model_name
+        )
+    )
+    with _adapter_pool_lock:
+        existing = _adapter_pool.get(key)
+        if existing is not None:
+            # 其它线程抢先创建了同配置实例，丢弃本次创建的
+            _adapter_pool_stats["reused"] += 1
+            duplicate, adapter = adapter, existing
+        else:
+            _adapter_pool[key] = adapter
+            _adapter_pool_stats["created"] += 1
+            duplicate = None
+    if duplicate is not None:
+        duplicate.close()
+    return adapter
+
+def _build_llm_adapter(
+    interface_format: str,
+    base_url: str,
+    model_name: str,
+    api_key: str,
+    temperature: float,
+    max_tokens: int,
+    timeout: int
+) -> BaseLLMAdapter:
+    """
+    根据 interface_format 新建适配器实例（不经过适配器池）。
     """
     fmt = interface_format.strip().lower()
     if fmt == "deepseek":
@@ -424,5 +2039,7 @@ def create_llm_adapter(
         return SiliconFlowAdapter(api_key, base_url, model_name, max_tokens, temperature, timeout)
     elif fmt == "grok":
         return GrokAdapter(api_key, base_url, model_name, max_tokens, temperature, timeout)
+    elif fmt == "mock":
+        return MockAdapter(api_key, base_url, model_name, max_tokens, temperature, timeout)
     else:
         raise ValueError(f"Unknown interface_format: {interface_format}")
@@ -0,0 +1,167 @@
+# mock_backend.py
+# -*- coding: utf-8 -*-
+"""
+离线压测用的确定性模拟后端：LLM 与 embedding 的 "mock" 适配器、以及 mock_server.py 共用。
+- 相同提示词、相同 seed 得到相同的输出
+- 可配置首包延迟（latency）、输出速度（tokens_per_second）、错误率（error_rate）
+- 按提示词类型返回格式正确的文本：章节目录提示词返回可被 chapter_directory_parser 解析的蓝图，
+  知识库检索关键词提示词返回 '·' 分隔的关键词行，章节正文按其字数要求生成，其余返回 response_chars 字的文本；
+  也可通过 responses 配置 [{"match": 子串, "text": 模板}] 固定返回内容。
+"""
+import re
+import math
+import random
+import struct
+import hashlib
+from typing import Iterator, List, Optional
+
+from rate_limiter import estimate_tokens
+
+DEFAULT_MOCK_OPTIONS = {
+    "seed": 0,
+    "latency": 0.2,              # 首个 token 前的等待秒数
+    "tokens_per_second": 200.0,  # 0 表示不限速
+    "error_rate": 0.0,           # 每次调用失败的概率
+    "response_chars": 1200,      # 普通提示词的输出字数
+    "embedding_dim": 256,
+    "embedding_latency": 0.01,
+    "responses": []
+}
+
+_mock_options = dict(DEFAULT_MOCK_OPTIONS)
+
+def configure_mock_backend(options: Optional[dict]):
+    """根据 config.json 的 mock_backend 配置更新模拟后端参数（未填写的项使用默认值）"""
+    _mock_options.clear()
+    _mock_options.update(DEFAULT_MOCK_OPTIONS)
+    _mock_options.update(options or {})
+
+def get_mock_options() -> dict:
+    return dict(_mock_options)
+
+
+class MockBackendError(RuntimeError):
+    """按 error_rate 注入的模拟错误，带 503 状态码，会被重试策略视为可重试错误"""
+    status_code = 503
+
+
+_WORDS = (
+    "夜色", "城市", "古老", "秘密", "少年", "命运", "剑光", "誓言", "雾气", "远方",
+    "记忆", "火焰", "钟声", "裂缝", "星辰", "低语", "废墟", "信使", "迷宫", "潮汐"
+)
+_TITLES = ("暗流", "初遇", "试炼", "背叛", "回响", "余烬", "破晓", "迷途", "归途", "风暴")
+_ROLES = ("角色", "事件", "主题", "伏笔")
+_PURPOSES = ("推进", "转折", "揭示", "铺垫")
+_SUSPENSE = ("紧凑", "渐进", "爆发", "舒缓")
+
+
+class MockResponder:
+    """根据提示词生成确定性的模拟回复"""
+    def __init__(self, options: Optional[dict] = None):
+        self.options = dict(DEFAULT_MOCK_OPTIONS)
+        self.options.update(options or {})
+        # 错误注入按调用次序而非提示词取随机数，否则同一提示词会一直失败
+        self._error_rng = random.Random(self.options["seed"])
+
+    def _rng(self, prompt: str, salt: str = "") -> random.Random:
+        digest = hashlib.sha256(f"{self.options['seed']}|{salt}|{prompt}".encode("utf-8")).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    def should_fail(self) -> bool:
+        rate = float(self.options.get("error_rate") or 0.0)
+        return rate > 0 and self._error_rng.random() < rate
+
+    def respond(self, prompt: str) -> str:
+        for rule in self.options.get("responses") or []:
+            if rule.get("match") and rule["match"] in prompt:
+                return rule.get("text", "").format(prompt_chars=len(prompt))
+        if "节奏分布" in prompt and "本章简述" in prompt:
+            return self._blueprint(prompt)
+        if "检索关键词" in prompt:
+            return self._keywords(prompt)
+        # 章节正文提示词按其中的字数要求生成，便于计时与真实篇幅一致
+        target = re.search(r"字数要求[：:]?\s*(\d+)字", prompt)
+        chars = int(target.group(1)) if target else int(self.options.get("response_chars", 1200))
+        return self._prose(prompt, chars)
+
+    def _blueprint(self, prompt: str) -> str:
+        match = re.search(r"现在请设计第(\d+)章到第(\d+)", prompt)
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+        else:
+            total = re.search(r"设计(\d+)章的节奏分布", prompt)
+            start, end = 1, int(total.group(1)) if total else 10
+        rng = self._rng(prompt, "blueprint")
+        blocks = []
+        for n in range(start, end + 1):
+            blocks.append("\n".join([
+                f"第{n}章 - {rng.choice(_TITLES)}{rng.choice(_WORDS)}",
+                f"本章定位：{rng.choice(_ROLES)}",
+                f"核心作用：{rng.choice(_PURPOSES)}",
+                f"悬念密度：{rng.choice(_SUSPENSE)}",
+                f"伏笔操作：埋设({rng.choice(_WORDS)})→强化({rng.choice(_WORDS)})",
+                f"认知颠覆：{'★' * (n % 5 + 1)}{'☆' * (4 - n % 5)}",
+                f"本章简述：{''.join(rng.choice(_WORDS) for _ in range(6))}"
+            ]))
+        return "\n\n".join(blocks)
+
+    def _keywords(self, prompt: str) -> str:
+        rng = self._rng(prompt, "keywords")
+        return "\n".join(
+            "·".join(rng.sample(_WORDS, 2)) for _ in range(rng.randint(3, 5))
+        )
+
+    def _prose(self, prompt: str, chars: int) -> str:
+        rng = self._rng(prompt, "prose")
+        parts = []
+        length = 0
+        while length < chars:
+            sentence = "".join(rng.choice(_WORDS) for _ in range(rng.randint(4, 9))) + "。"
+            if rng.random() < 0.2:
+                sentence += "\n"
+            parts.append(sentence)
+            length += len(sentence)
+        return "".join(parts)[:chars]
+
+    def truncate(self, text: str, max_tokens: Optional[int]):
+        """超出 max_tokens 时截断，返回 (文本, 结束原因)"""
+        if not max_tokens or estimate_tokens(text) <= max_tokens:
+            return text, "stop"
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if estimate_tokens(text[:mid]) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        return text[:low], "length"
+
+    def chunks(self, text: str, size: int = 8) -> Iterator[str]:
+        for i in range(0, len(text), size):
+            yield text[i:i + size]
+
+    def chunk_delay(self, chunk: str) -> float:
+        tps = float(self.options.get("tokens_per_second") or 0.0)
+        return estimate_tokens(chunk) / tps if tps > 0 else 0.0
+
+    def generation_time(self, text: str) -> float:
+        tps = float(self.options.get("tokens_per_second") or 0.0)
+        return estimate_tokens(text) / tps if tps > 0 else 0.0
+
+
+def mock_embedding(text: str, dim: int = 256) -> List[float]:
+    """
+    确定性的文本向量：字符二元组哈希到 dim 维后归一化，
+    含相同词语的文本余弦相似度更高，足以让检索流程有意义。
+    """
+    vector = [0.0] * dim
+    text = text or ""
+    grams = [text[i:i + 2] for i in range(max(1, len(text) - 1))]
+    for gram in grams:
+        digest = hashlib.md5(gram.encode("utf-8")).digest()
+        index = struct.unpack("<I", digest[:4])[0] % dim
+        sign = 1.0 if digest[4] & 1 else -1.0
+        vector[index] += sign
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
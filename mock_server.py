@@ -0,0 +1,184 @@
+# mock_server.py
+# -*- coding: utf-8 -*-
+"""
+本地 OpenAI 兼容模拟服务，用于在无网络环境下压测完整流程（包括真实的 HTTP 客户端与连接池）。
+提供 /v1/chat/completions（支持 stream）、/v1/embeddings、/v1/models，回复内容与 "mock" 适配器一致。
+
+用法：
+    python mock_server.py --port 8765 --latency 0.5 --tokens-per-second 80 --error-rate 0.05
+然后在配置中把接口格式设为 OpenAI，base_url 设为 http://127.0.0.1:8765/v1，api_key 任意填写。
+"""
+import json
+import time
+import argparse
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mock_backend import DEFAULT_MOCK_OPTIONS, MockResponder, mock_embedding
+from rate_limiter import estimate_tokens
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    responder: MockResponder = None
+    responder_lock = threading.Lock()
+
+    def log_message(self, fmt, *args):
+        logging.info("[mock_server] " + fmt % args)
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 503:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _should_fail(self) -> bool:
+        with self.responder_lock:
+            return self.responder.should_fail()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        try:
+            request = self._read_json()
+        except ValueError:
+            self._send_json(400, {"error": {"message": "Invalid JSON body"}})
+            return
+        if path.endswith("/chat/completions"):
+            self._chat_completions(request)
+        elif path.endswith("/embeddings"):
+            self._embeddings(request)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def _chat_completions(self, request: dict):
+        options = self.responder.options
+        messages = request.get("messages") or []
+        prompt = "\n".join(str(m.get("content", "")) for m in messages)
+        model = request.get("model", "mock")
+        time.sleep(float(options["latency"]))
+        if self._should_fail():
+            self._send_json(503, {"error": {"message": "Mock server injected error", "type": "server_error"}})
+            return
+        text, finish_reason = self.responder.truncate(self.responder.respond(prompt), request.get("max_tokens"))
+        usage = {
+            "prompt_tokens": estimate_tokens(prompt),
+            "completion_tokens": estimate_tokens(text),
+            "total_tokens": estimate_tokens(prompt) + estimate_tokens(text)
+        }
+        created = int(time.time())
+        if not request.get("stream"):
+            time.sleep(self.responder.generation_time(text))
+            self._send_json(200, {
+                "id": f"chatcmpl-mock-{created}",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}],
+                "usage": usage
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send_event(payload):
+            self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        base = {"id": f"chatcmpl-mock-{created}", "object": "chat.completion.chunk", "created": created, "model": model}
+        for chunk in self.responder.chunks(text):
+            time.sleep(self.responder.chunk_delay(chunk))
+            send_event(dict(base, choices=[{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]))
+        send_event(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": finish_reason}]))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send_event(dict(base, choices=[], usage=usage))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _embeddings(self, request: dict):
+        options = self.responder.options
+        inputs = request.get("input")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        time.sleep(float(options["embedding_latency"]))
+        if self._should_fail():
+            self._send_json(503, {"error": {"message": "Mock server injected error", "type": "server_error"}})
+            return
+        dim = int(request.get("dimensions") or options["embedding_dim"])
+        self._send_json(200, {
+            "object": "list",
+            "model": request.get("model", "mock-embedding"),
+            "data": [
+                {"object": "embedding", "index": i, "embedding": mock_embedding(str(text), dim)}
+                for i, text in enumerate(inputs or [])
+            ],
+            "usage": {"prompt_tokens": sum(estimate_tokens(str(t)) for t in inputs or []), "total_tokens": 0}
+        })
+
+
+def serve(host: str = "127.0.0.1", port: int = 8765, options: dict = None) -> ThreadingHTTPServer:
+    """创建模拟服务（不启动循环），调用方执行 serve_forever()；也可在测试代码里放到后台线程运行"""
+    MockOpenAIHandler.responder = MockResponder(options)
+    return ThreadingHTTPServer((host, port), MockOpenAIHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=DEFAULT_MOCK_OPTIONS["seed"])
+    parser.add_argument("--latency", type=float, default=DEFAULT_MOCK_OPTIONS["latency"], help="首个 token 前的等待秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=DEFAULT_MOCK_OPTIONS["tokens_per_second"], help="输出速度，0 为不限速")
+    parser.add_argument("--error-rate", type=float, default=DEFAULT_MOCK_OPTIONS["error_rate"], help="返回 503 的概率")
+    parser.add_argument("--response-chars", type=int, default=DEFAULT_MOCK_OPTIONS["response_chars"])
+    parser.add_argument("--embedding-dim", type=int, default=DEFAULT_MOCK_OPTIONS["embedding_dim"])
+    parser.add_argument("--embedding-latency", type=float, default=DEFAULT_MOCK_OPTIONS["embedding_latency"])
+    parser.add_argument("--responses", default=None, help='固定回复规则 JSON 文件：[{"match": "...", "text": "..."}]')
+    args = parser.parse_args()
+
+    options = {
+        "seed": args.seed,
+        "latency": args.latency,
+        "tokens_per_second": args.tokens_per_second,
+        "error_rate": args.error_rate,
+        "response_chars": args.response_chars,
+        "embedding_dim": args.embedding_dim,
+        "embedding_latency": args.embedding_latency,
+        "responses": []
+    }
+    if args.responses:
+        with open(args.responses, "r", encoding="utf-8") as f:
+            options["responses"] = json.load(f)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    server = serve(args.host, args.port, options)
+    print(f"Mock OpenAI server listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
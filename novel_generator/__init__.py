@@ -1,13 +1,20 @@
 #novel_generator/__init__.py
 from .architecture import Novel_architecture_generate
-from .blueprint import Chapter_blueprint_generate
+from .blueprint import Chapter_blueprint_generate, Chapter_blueprint_generate_async
 from .chapter import (
     get_last_n_chapters_text,
     summarize_recent_chapters,
     get_filtered_knowledge_context,
     build_chapter_prompt,
+    build_chapter_prompt_async,
     generate_chapter_draft
 )
-from .finalization import finalize_chapter, enrich_chapter_text
+from .finalization import (
+    finalize_chapter,
+    finalize_chapter_async,
+    enrich_chapter_text,
+    delete_chapter,
+    sync_chapter_vectors
+)
 from .knowledge import import_knowledge_file
 from .vectorstore_utils import clear_vector_store
\ No newline at end of file
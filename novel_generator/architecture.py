@@ -9,6 +9,7 @@ import logging
 import traceback
 from novel_generator.common import invoke_with_cleaning
 from llm_adapters import create_llm_adapter
+from usage_tracker import with_usage_scope
 from prompt_definitions import (
     core_seed_prompt,
     character_dynamics_prompt,
@@ -52,6 +53,7 @@ def save_partial_architecture_data(filepath: str, data: dict):
     except Exception as e:
         logging.warning(f"Failed to save partial_architecture.json: {e}")
 
+@with_usage_scope()
 def Novel_architecture_generate(
     interface_format: str,
     api_key: str,
@@ -102,7 +104,7 @@ def Novel_architecture_generate(
             word_number=word_number,
             user_guidance=user_guidance  # 修复：添加内容指导
         )
-        core_seed_result = invoke_with_cleaning(llm_adapter, prompt_core)
+        core_seed_result = invoke_with_cleaning(llm_adapter, prompt_core, stage="architecture")
         if not core_seed_result.strip():
             logging.warning("core_seed_prompt generation failed and returned empty.")
             save_partial_architecture_data(filepath, partial_data)
@@ -118,7 +120,7 @@ def Novel_architecture_generate(
             core_seed=partial_data["core_seed_result"].strip(),
             user_guidance=user_guidance
         )
-        character_dynamics_result = invoke_with_cleaning(llm_adapter, prompt_character)
+        character_dynamics_result = invoke_with_cleaning(llm_adapter, prompt_character, stage="architecture")
         if not character_dynamics_result.strip():
             logging.warning("character_dynamics_prompt generation failed.")
             save_partial_architecture_data(filepath, partial_data)
@@ -133,7 +135,7 @@ def Novel_architecture_generate(
         prompt_char_state_init = create_character_state_prompt.format(
             character_dynamics=partial_data["character_dynamics_result"].strip()
         )
-        character_state_init = invoke_with_cleaning(llm_adapter, prompt_char_state_init)
+        character_state_init = invoke_with_cleaning(llm_adapter, prompt_char_state_init, stage="architecture")
         if not character_state_init.strip():
             logging.warning("create_character_state_prompt generation failed.")
             save_partial_architecture_data(filepath, partial_data)
@@ -151,7 +153,7 @@ def Novel_architecture_generate(
             core_seed=partial_data["core_seed_result"].strip(),
             user_guidance=user_guidance  # 修复：添加用户指导
         )
-        world_building_result = invoke_with_cleaning(llm_adapter, prompt_world)
+        world_building_result = invoke_with_cleaning(llm_adapter, prompt_world, stage="architecture")
         if not world_building_result.strip():
             logging.warning("world_building_prompt generation failed.")
             save_partial_architecture_data(filepath, partial_data)
@@ -169,7 +171,7 @@ def Novel_architecture_generate(
             world_building=partial_data["world_building_result"].strip(),
             user_guidance=user_guidance  # 修复：添加用户指导
         )
-        plot_arch_result = invoke_with_cleaning(llm_adapter, prompt_plot)
+        plot_arch_result = invoke_with_cleaning(llm_adapter, prompt_plot, stage="architecture")
         if not plot_arch_result.strip():
             logging.warning("plot_architecture_prompt generation failed.")
             save_partial_architecture_data(filepath, partial_data)
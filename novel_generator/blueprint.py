@@ -6,8 +6,9 @@
 import os
 import re
 import logging
-from novel_generator.common import invoke_with_cleaning
+from novel_generator.common import LLMCall, run_steps, arun_steps
 from llm_adapters import create_llm_adapter
+from usage_tracker import with_usage_scope
 from prompt_definitions import chapter_blueprint_prompt, chunked_chapter_blueprint_prompt
 from utils import read_file, clear_file_content, save_string_to_txt
 logging.basicConfig(
@@ -47,27 +48,19 @@ def limit_chapter_blueprint(blueprint_text: str, limit_chapters: int = 100) -> s
     selected = chapters[-limit_chapters:]
     return "\n\n".join(selected).strip()
 
-def Chapter_blueprint_generate(
+def _blueprint_steps(
     interface_format: str,
     api_key: str,
     base_url: str,
     llm_model: str,
     filepath: str,
     number_of_chapters: int,
-    user_guidance: str = "",  # 新增参数
-    temperature: float = 0.7,
-    max_tokens: int = 4096,
-    timeout: int = 600
-) -> None:
-    """
-    若 Novel_directory.txt 已存在且内容非空，则表示可能是之前的部分生成结果；
-      解析其中已有的章节数，从下一个章节继续分块生成；
-      对于已有章节目录，传入时仅保留最近100章目录，避免prompt过长。
-    否则：
-      - 若章节数 <= chunk_size，直接一次性生成
-      - 若章节数 > chunk_size，进行分块生成
-    生成完成后输出至 Novel_directory.txt。
-    """
+    user_guidance: str,
+    temperature: float,
+    max_tokens: int,
+    timeout: int
+):
+    """Chapter_blueprint_generate 与其异步版本共用的流程（见 common.run_steps）"""
     arch_file = os.path.join(filepath, "Novel_architecture.txt")
     if not os.path.exists(arch_file):
         logging.warning("Novel_architecture.txt not found. Please generate architecture first.")
@@ -92,52 +85,17 @@ def Chapter_blueprint_generate(
     if not os.path.exists(filename_dir):
         open(filename_dir, "w", encoding="utf-8").close()
 
-    existing_blueprint = read_file(filename_dir).strip()
+    final_blueprint = read_file(filename_dir).strip()
     chunk_size = compute_chunk_size(number_of_chapters, max_tokens)
     logging.info(f"Number of chapters = {number_of_chapters}, computed chunk_size = {chunk_size}.")
 
-    if existing_blueprint:
-        logging.info("Detected existing blueprint content. Will resume chunked generation from that point.")
-        pattern = r"第\s*(\d+)\s*章"
-        existing_chapter_numbers = re.findall(pattern, existing_blueprint)
-        existing_chapter_numbers = [int(x) for x in existing_chapter_numbers if x.isdigit()]
-        max_existing_chap = max(existing_chapter_numbers) if existing_chapter_numbers else 0
-        logging.info(f"Existing blueprint indicates up to chapter {max_existing_chap} has been generated.")
-        final_blueprint = existing_blueprint
-        current_start = max_existing_chap + 1
-        while current_start <= number_of_chapters:
-            current_end = min(current_start + chunk_size - 1, number_of_chapters)
-            limited_blueprint = limit_chapter_blueprint(final_blueprint, 100)
-            chunk_prompt = chunked_chapter_blueprint_prompt.format(
-                novel_architecture=architecture_text,
-                chapter_list=limited_blueprint,
-                number_of_chapters=number_of_chapters,
-                n=current_start,
-                m=current_end,
-                user_guidance=user_guidance  # 新增参数
-            )
-            logging.info(f"Generating chapters [{current_start}..{current_end}] in a chunk...")
-            chunk_result = invoke_with_cleaning(llm_adapter, chunk_prompt)
-            if not chunk_result.strip():
-                logging.warning(f"Chunk generation for chapters [{current_start}..{current_end}] is empty.")
-                clear_file_content(filename_dir)
-                save_string_to_txt(final_blueprint.strip(), filename_dir)
-                return
-            final_blueprint += "\n\n" + chunk_result.strip()
-            clear_file_content(filename_dir)
-            save_string_to_txt(final_blueprint.strip(), filename_dir)
-            current_start = current_end + 1
-
-        logging.info("All chapters blueprint have been generated (resumed chunked).")
-        return
-
-    if chunk_size >= number_of_chapters:
+    if not final_blueprint and chunk_size >= number_of_chapters:
         prompt = chapter_blueprint_prompt.format(
             novel_architecture=architecture_text,
             number_of_chapters=number_of_chapters,
             user_guidance=user_guidance  # 新增参数
         )
-        blueprint_text = invoke_with_cleaning(llm_adapter, prompt)
+        blueprint_text = yield LLMCall(llm_adapter, prompt, "blueprint")
         if not blueprint_text.strip():
             logging.warning("Chapter blueprint generation result is empty.")
             return
@@ -147,9 +105,16 @@ def Chapter_blueprint_generate(
         logging.info("Novel_directory.txt (chapter blueprint) has been generated successfully (single-shot).")
         return
 
-    logging.info("Will generate chapter blueprint in chunked mode from scratch.")
-    final_blueprint = ""
     current_start = 1
+    if final_blueprint:
+        logging.info("Detected existing blueprint content. Will resume chunked generation from that point.")
+        existing_chapter_numbers = [int(x) for x in re.findall(r"第\s*(\d+)\s*章", final_blueprint)]
+        current_start = (max(existing_chapter_numbers) if existing_chapter_numbers else 0) + 1
+        logging.info(f"Existing blueprint indicates up to chapter {current_start - 1} has been generated.")
+    else:
+        logging.info("Will generate chapter blueprint in chunked mode from scratch.")
+
+    # 分块之间存在先后依赖，异步版本也按顺序等待
     while current_start <= number_of_chapters:
         current_end = min(current_start + chunk_size - 1, number_of_chapters)
         limited_blueprint = limit_chapter_blueprint(final_blueprint, 100)
@@ -162,7 +127,7 @@ def Chapter_blueprint_generate(
             user_guidance=user_guidance  # 新增参数
         )
         logging.info(f"Generating chapters [{current_start}..{current_end}] in a chunk...")
-        chunk_result = invoke_with_cleaning(llm_adapter, chunk_prompt)
+        chunk_result = yield LLMCall(llm_adapter, chunk_prompt, "blueprint")
         if not chunk_result.strip():
             logging.warning(f"Chunk generation for chapters [{current_start}..{current_end}] is empty.")
             clear_file_content(filename_dir)
@@ -177,3 +142,49 @@ def Chapter_blueprint_generate(
         current_start = current_end + 1
 
     logging.info("Novel_directory.txt (chapter blueprint) has been generated successfully (chunked).")
+
+@with_usage_scope()
+def Chapter_blueprint_generate(
+    interface_format: str,
+    api_key: str,
+    base_url: str,
+    llm_model: str,
+    filepath: str,
+    number_of_chapters: int,
+    user_guidance: str = "",  # 新增参数
+    temperature: float = 0.7,
+    max_tokens: int = 4096,
+    timeout: int = 600
+) -> None:
+    """
+    若 Novel_directory.txt 已存在且内容非空，则表示可能是之前的部分生成结果；
+      解析其中已有的章节数，从下一个章节继续分块生成；
+      对于已有章节目录，传入时仅保留最近100章目录，避免prompt过长。
+    否则：
+      - 若章节数 <= chunk_size，直接一次性生成
+      - 若章节数 > chunk_size，进行分块生成
+    生成完成后输出至 Novel_directory.txt。
+    """
+    run_steps(_blueprint_steps(
+        interface_format, api_key, base_url, llm_model, filepath, number_of_chapters,
+        user_guidance, temperature, max_tokens, timeout
+    ))
+
+@with_usage_scope()
+async def Chapter_blueprint_generate_async(
+    interface_format: str,
+    api_key: str,
+    base_url: str,
+    llm_model: str,
+    filepath: str,
+    number_of_chapters: int,
+    user_guidance: str = "",
+    temperature: float = 0.7,
+    max_tokens: int = 4096,
+    timeout: int = 600
+) -> None:
+    """Chapter_blueprint_generate 的异步版本，行为一致，只是不再独占线程"""
+    await arun_steps(_blueprint_steps(
+        interface_format, api_key, base_url, llm_model, filepath, number_of_chapters,
+        user_guidance, temperature, max_tokens, timeout
+    ))
@@ -6,22 +6,25 @@
 import os
 import json
 import logging
-import re  # 添加re模块导入
-from llm_adapters import create_llm_adapter
+from llm_adapters import create_llm_adapter, resolve_stage_llm
+from usage_tracker import with_usage_scope, last_usage
+from cancellation import with_cancellation, check_cancelled
+from prompt_layout import layered_prompt, STATIC, NOVEL, CHAPTER
+from token_budget import count_tokens, prompt_budget_for, truncate_to_tokens
 from prompt_definitions import (
-    first_chapter_draft_prompt, 
-    next_chapter_draft_prompt, 
+    first_chapter_draft_prompt,
+    next_chapter_draft_static_prompt,
+    next_chapter_draft_context_prompt,
+    next_chapter_draft_chapter_prompt,
     summarize_recent_chapters_prompt,
     knowledge_filter_prompt,
-    knowledge_search_prompt
+    knowledge_search_prompt,
+    chapter_continuation_prompt
 )
 from chapter_directory_parser import get_chapter_info_from_blueprint
-from novel_generator.common import invoke_with_cleaning
+from novel_generator.common import invoke_with_cleaning, merge_continuation, LLMCall, BlockingCall, run_steps, arun_steps
 from utils import read_file, clear_file_content, save_string_to_txt
-from novel_generator.vectorstore_utils import (
-    get_relevant_context_from_vector_store,
-    load_vector_store  # 添加导入
-)
+from novel_generator.vectorstore_utils import get_relevant_hits_for_queries, build_retrieval_filter
 logging.basicConfig(
     filename='app.log',      # 日志文件名
     filemode='a',            # 追加模式（'w' 会覆盖）
@@ -30,6 +33,21 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
+# 提示词各片段的 token 配额；整体还会按 模型上下文窗口 - max_tokens 压缩
+RECENT_CHAPTERS_TOKENS = 6000     # 近期章节摘要所用的前文
+KNOWLEDGE_TEXT_TOKENS = 800       # 知识过滤时每条检索结果
+PREVIOUS_EXCERPT_TOKENS = 1200    # 前章结尾段
+SHORT_SUMMARY_TOKENS = 3000       # 当前章节摘要
+FILTERED_CONTEXT_TOKENS = 3000    # 过滤后的知识库参考
+
+# 草稿被 max_tokens 截断后的自动续写
+MAX_CONTINUATIONS = 3
+CONTINUATION_TAIL_CHARS = 600
+CONTINUATION_OVERLAP_CHARS = 300
+
+# 向量检索时排除最近几章的片段（它们已通过近期摘要与前章结尾进入提示词）
+RECENT_CHAPTERS_EXCLUDED = 3
+
 def get_last_n_chapters_text(chapters_dir: str, current_chapter_num: int, n: int = 3) -> list:
     """
     从目录 chapters_dir 中获取最近 n 章的文本内容，返回文本列表。
@@ -45,49 +63,28 @@ def get_last_n_chapters_text(chapters_dir: str, current_chapter_num: int, n: int
             texts.append("")
     return texts
 
-def summarize_recent_chapters(
-    interface_format: str,
-    api_key: str,
-    base_url: str,
-    model_name: str,
-    temperature: float,
-    max_tokens: int,
+def _build_recent_summary_prompt(
     chapters_text_list: list,
-    novel_number: int,            # 新增参数
-    chapter_info: dict,           # 新增参数
-    next_chapter_info: dict,      # 新增参数
-    timeout: int = 600
-) -> str:  # 修改返回值类型为 str，不再是 tuple
-    """
-    根据前三章内容生成当前章节的精准摘要。
-    如果解析失败，则返回空字符串。
-    """
-    try:
-        combined_text = "\n".join(chapters_text_list).strip()
-        if not combined_text:
-            return ""
-            
-        # 限制组合文本长度
-        max_combined_length = 4000
-        if len(combined_text) > max_combined_length:
-            combined_text = combined_text[-max_combined_length:]
-            
-        llm_adapter = create_llm_adapter(
-            interface_format=interface_format,
-            base_url=base_url,
-            model_name=model_name,
-            api_key=api_key,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            timeout=timeout
-        )
-        
-        # 确保所有参数都有默认值
-        chapter_info = chapter_info or {}
-        next_chapter_info = next_chapter_info or {}
-        
-        prompt = summarize_recent_chapters_prompt.format(
-            combined_text=combined_text,
+    novel_number: int,
+    chapter_info: dict,
+    next_chapter_info: dict,
+    interface_format: str = "",
+    base_url: str = "",
+    model_name: str = "",
+    max_tokens: int = 0
+) -> str:
+    """构造近期章节摘要的提示词；若前文为空则返回空字符串。"""
+    combined_text = "\n".join(chapters_text_list).strip()
+    if not combined_text:
+        return ""
+
+    # 确保所有参数都有默认值
+    chapter_info = chapter_info or {}
+    next_chapter_info = next_chapter_info or {}
+
+    def render(text: str) -> str:
+        return summarize_recent_chapters_prompt.format(
+            combined_text=text,
             novel_number=novel_number,
             chapter_title=chapter_info.get("chapter_title", "未命名"),
             chapter_role=chapter_info.get("chapter_role", "常规章节"),
@@ -105,20 +102,102 @@ def summarize_recent_chapters(
             next_chapter_foreshadowing=next_chapter_info.get("foreshadowing", "无特殊伏笔"),
             next_chapter_plot_twist_level=next_chapter_info.get("plot_twist_level", "★☆☆☆☆")
         )
-        
-        response_text = invoke_with_cleaning(llm_adapter, prompt)
-        summary = extract_summary_from_response(response_text)
-        
-        if not summary:
-            logging.warning("Failed to extract summary, using full response")
-            return response_text[:2000]  # 限制长度
-            
-        return summary[:2000]  # 限制摘要长度
+
+    # 前文按 token 配额保留结尾部分，并保证整个提示词放得进上下文窗口
+    budget = prompt_budget_for(count_tokens(render(""), model_name), interface_format, base_url, model_name, max_tokens)
+    budget.add("combined_text", combined_text, priority=1, quota=RECENT_CHAPTERS_TOKENS, keep="tail")
+    return render(budget.fit()["combined_text"])
+
+def _finish_recent_summary(response_text: str) -> str:
+    """从模型回复中提取摘要并限制长度。"""
+    summary = extract_summary_from_response(response_text)
+    if not summary:
+        logging.warning("Failed to extract summary, using full response")
+        return response_text[:2000]  # 限制长度
+    return summary[:2000]  # 限制摘要长度
+
+def _summarize_recent_chapters_steps(
+    interface_format: str,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    temperature: float,
+    max_tokens: int,
+    chapters_text_list: list,
+    novel_number: int,
+    chapter_info: dict,
+    next_chapter_info: dict,
+    timeout: int
+):
+    """summarize_recent_chapters 与其异步版本共用的流程（见 common.run_steps）"""
+    try:
+        llm_kwargs = resolve_stage_llm(
+            "summary",
+            interface_format=interface_format,
+            base_url=base_url,
+            model_name=model_name,
+            api_key=api_key,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=timeout
+        )
+        prompt = _build_recent_summary_prompt(
+            chapters_text_list, novel_number, chapter_info, next_chapter_info,
+            interface_format=llm_kwargs["interface_format"], base_url=llm_kwargs["base_url"],
+            model_name=llm_kwargs["model_name"], max_tokens=llm_kwargs["max_tokens"]
+        )
+        if not prompt:
+            return ""
+
+        llm_adapter = create_llm_adapter(**llm_kwargs)
+        response_text = yield LLMCall(llm_adapter, prompt, "summary")
+        return _finish_recent_summary(response_text)
         
     except Exception as e:
         logging.error(f"Error in summarize_recent_chapters: {str(e)}")
         return ""
 
+def summarize_recent_chapters(
+    interface_format: str,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    temperature: float,
+    max_tokens: int,
+    chapters_text_list: list,
+    novel_number: int,            # 新增参数
+    chapter_info: dict,           # 新增参数
+    next_chapter_info: dict,      # 新增参数
+    timeout: int = 600
+) -> str:  # 修改返回值类型为 str，不再是 tuple
+    """
+    根据前三章内容生成当前章节的精准摘要。
+    如果解析失败，则返回空字符串。
+    """
+    return run_steps(_summarize_recent_chapters_steps(
+        interface_format, api_key, base_url, model_name, temperature, max_tokens,
+        chapters_text_list, novel_number, chapter_info, next_chapter_info, timeout
+    ))
+
+async def summarize_recent_chapters_async(
+    interface_format: str,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    temperature: float,
+    max_tokens: int,
+    chapters_text_list: list,
+    novel_number: int,
+    chapter_info: dict,
+    next_chapter_info: dict,
+    timeout: int = 600
+) -> str:
+    """summarize_recent_chapters 的异步版本"""
+    return await arun_steps(_summarize_recent_chapters_steps(
+        interface_format, api_key, base_url, model_name, temperature, max_tokens,
+        chapters_text_list, novel_number, chapter_info, next_chapter_info, timeout
+    ))
+
 def extract_summary_from_response(response_text: str) -> str:
     """从响应文本中提取摘要部分"""
     if not response_text:
@@ -177,67 +256,79 @@ def parse_search_keywords(response_text: str) -> list:
         if '·' in line
     ][:5]  # 最多取5组
 
-def apply_content_rules(texts: list, novel_number: int) -> list:
-    """应用内容处理规则"""
-    processed = []
-    for text in texts:
-        if re.search(r'第[\d]+章', text) or re.search(r'chapter_[\d]+', text):
-            chap_nums = list(map(int, re.findall(r'\d+', text)))
-            recent_chap = max(chap_nums) if chap_nums else 0
-            time_distance = novel_number - recent_chap
-            
-            if time_distance <= 2:
-                processed.append(f"[SKIP] 跳过近章内容：{text[:120]}...")
-            elif 3 <= time_distance <= 5:
-                processed.append(f"[MOD40%] {text}（需修改≥40%）")
-            else:
-                processed.append(f"[OK] {text}（可引用核心）")
-        else:
-            processed.append(f"[PRIOR] {text}（优先使用）")
-    return processed
-
-def apply_knowledge_rules(contexts: list, chapter_num: int) -> list:
-    """应用知识库使用规则"""
-    processed = []
-    for text in contexts:
-        # 检测历史章节内容
-        if "第" in text and "章" in text:
-            # 提取章节号判断时间远近
-            chap_nums = [int(s) for s in text.split() if s.isdigit()]
-            recent_chap = max(chap_nums) if chap_nums else 0
-            time_distance = chapter_num - recent_chap
-            
-            # 相似度处理规则
-            if time_distance <= 3:  # 近三章内容
-                processed.append(f"[历史章节限制] 跳过近期内容: {text[:50]}...")
-                continue
-                
-            # 允许引用但需要转换
-            processed.append(f"[历史参考] {text} (需进行30%以上改写)")
-        else:
-            # 第三方知识优先处理
-            processed.append(f"[外部知识] {text}")
-    return processed
+def label_retrieved_segment(text: str, metadata: dict, novel_number: int = None) -> str:
+    """按检索结果的来源元数据标注使用规则：知识库优先使用，历史章节按与本章的距离决定改写要求"""
+    source = metadata.get("source")
+    if source == "knowledge":
+        return f"[PRIOR] {text}（优先使用）"
+    if source == "chapter" and "chapter" in metadata:
+        chapter_number = metadata["chapter"]
+        if novel_number is None:
+            return f"[OK] {text}（第{chapter_number}章内容，可引用核心）"
+        time_distance = novel_number - chapter_number
+        if time_distance <= 5:
+            return f"[MOD40%] {text}（第{chapter_number}章内容，需修改≥40%）"
+        return f"[OK] {text}（第{chapter_number}章内容，可引用核心）"
+    # 旧版本写入的片段无法判断来源与章节
+    return text
 
-def get_filtered_knowledge_context(
+def _build_knowledge_filter_prompt(
+    chapter_info: dict,
+    retrieved_texts: list,
+    interface_format: str = "",
+    base_url: str = "",
+    model_name: str = "",
+    max_tokens: int = 0
+) -> str:
+    """由（已按来源标注的）检索结果构造知识过滤提示词"""
+    # 使用格式化函数处理章节信息
+    formatted_chapter_info = (
+        f"当前章节定位：{chapter_info.get('chapter_role', '')}\n"
+        f"核心目标：{chapter_info.get('chapter_purpose', '')}\n"
+        f"关键要素：{chapter_info.get('characters_involved', '')} | "
+        f"{chapter_info.get('key_items', '')} | "
+        f"{chapter_info.get('scene_location', '')}"
+    )
+
+    # 每条检索文本按 token 配额截断；总量超出上下文窗口时先压缩排在后面的结果
+    template_tokens = count_tokens(knowledge_filter_prompt.format(chapter_info=formatted_chapter_info, retrieved_texts=""), model_name)
+    budget = prompt_budget_for(template_tokens, interface_format, base_url, model_name, max_tokens)
+    for i, text in enumerate(retrieved_texts, 1):
+        budget.add(f"text{i}", text, priority=-i, quota=KNOWLEDGE_TEXT_TOKENS)
+    fitted = budget.fit()
+    cut_names = {cut["section"] for cut in budget.cuts}
+
+    formatted_texts = []
+    for i in range(1, len(retrieved_texts) + 1):
+        text = fitted[f"text{i}"]
+        if not text:
+            continue
+        if f"text{i}" in cut_names:
+            text += "..."
+        formatted_texts.append(f"[预处理结果{i}]\n{text}")
+
+    return knowledge_filter_prompt.format(
+        chapter_info=formatted_chapter_info,
+        retrieved_texts="\n\n".join(formatted_texts) if formatted_texts else "（无检索结果）"
+    )
+
+def _filtered_knowledge_context_steps(
     api_key: str,
     base_url: str,
     model_name: str,
     interface_format: str,
-    embedding_adapter,
-    filepath: str,
     chapter_info: dict,
     retrieved_texts: list,
-    max_tokens: int = 2048,
-    timeout: int = 600
-) -> str:
-    """优化后的知识过滤处理"""
+    max_tokens: int,
+    timeout: int
+):
+    """get_filtered_knowledge_context 与其异步版本共用的流程（见 common.run_steps）"""
     if not retrieved_texts:
         return "（无相关知识库内容）"
 
     try:
-        processed_texts = apply_knowledge_rules(retrieved_texts, chapter_info.get('chapter_number', 0))
-        llm_adapter = create_llm_adapter(
+        llm_kwargs = resolve_stage_llm(
+            "knowledge_filter",
             interface_format=interface_format,
             base_url=base_url,
             model_name=model_name,
@@ -246,126 +337,322 @@ def get_filtered_knowledge_context(
             max_tokens=max_tokens,
             timeout=timeout
         )
-        
-        # 限制检索文本长度并格式化
-        formatted_texts = []
-        max_text_length = 600
-        for i, text in enumerate(processed_texts, 1):
-            if len(text) > max_text_length:
-                text = text[:max_text_length] + "..."
-            formatted_texts.append(f"[预处理结果{i}]\n{text}")
-
-        # 使用格式化函数处理章节信息
-        formatted_chapter_info = (
-            f"当前章节定位：{chapter_info.get('chapter_role', '')}\n"
-            f"核心目标：{chapter_info.get('chapter_purpose', '')}\n"
-            f"关键要素：{chapter_info.get('characters_involved', '')} | "
-            f"{chapter_info.get('key_items', '')} | "
-            f"{chapter_info.get('scene_location', '')}"
+        llm_adapter = create_llm_adapter(**llm_kwargs)
+        prompt = _build_knowledge_filter_prompt(
+            chapter_info, retrieved_texts,
+            interface_format=llm_kwargs["interface_format"], base_url=llm_kwargs["base_url"],
+            model_name=llm_kwargs["model_name"], max_tokens=llm_kwargs["max_tokens"]
         )
-
-        prompt = knowledge_filter_prompt.format(
-            chapter_info=formatted_chapter_info,
-            retrieved_texts="\n\n".join(formatted_texts) if formatted_texts else "（无检索结果）"
-        )
-        
-        filtered_content = invoke_with_cleaning(llm_adapter, prompt)
+        filtered_content = yield LLMCall(llm_adapter, prompt, "knowledge_filter")
         return filtered_content if filtered_content else "（知识内容过滤失败）"
         
     except Exception as e:
         logging.error(f"Error in knowledge filtering: {str(e)}")
         return "（内容过滤过程出错）"
 
-def build_chapter_prompt(
+def get_filtered_knowledge_context(
     api_key: str,
     base_url: str,
     model_name: str,
+    interface_format: str,
+    embedding_adapter,
     filepath: str,
-    novel_number: int,
-    word_number: int,
-    temperature: float,
-    user_guidance: str,
-    characters_involved: str,
-    key_items: str,
-    scene_location: str,
-    time_constraint: str,
-    embedding_api_key: str,
-    embedding_url: str,
-    embedding_interface_format: str,
-    embedding_model_name: str,
-    embedding_retrieval_k: int = 2,
-    interface_format: str = "openai",
+    chapter_info: dict,
+    retrieved_texts: list,
     max_tokens: int = 2048,
     timeout: int = 600
 ) -> str:
-    """
-    构造当前章节的请求提示词（完整实现版）
-    修改重点：
-    1. 优化知识库检索流程
-    2. 新增内容重复检测机制
-    3. 集成提示词应用规则
-    """
+    """优化后的知识过滤处理"""
+    return run_steps(_filtered_knowledge_context_steps(
+        api_key, base_url, model_name, interface_format, chapter_info, retrieved_texts, max_tokens, timeout
+    ))
+
+async def get_filtered_knowledge_context_async(
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    interface_format: str,
+    embedding_adapter,
+    filepath: str,
+    chapter_info: dict,
+    retrieved_texts: list,
+    max_tokens: int = 2048,
+    timeout: int = 600
+) -> str:
+    """get_filtered_knowledge_context 的异步版本"""
+    return await arun_steps(_filtered_knowledge_context_steps(
+        api_key, base_url, model_name, interface_format, chapter_info, retrieved_texts, max_tokens, timeout
+    ))
+
+def _load_chapter_prompt_context(filepath: str, novel_number: int) -> dict:
+    """读取构造章节提示词所需的基础文件与本章、下一章的蓝图信息"""
     # 读取基础文件
     arch_file = os.path.join(filepath, "Novel_architecture.txt")
-    novel_architecture_text = read_file(arch_file)
     directory_file = os.path.join(filepath, "Novel_directory.txt")
-    blueprint_text = read_file(directory_file)
     global_summary_file = os.path.join(filepath, "global_summary.txt")
-    global_summary_text = read_file(global_summary_file)
     character_state_file = os.path.join(filepath, "character_state.txt")
-    character_state_text = read_file(character_state_file)
-    
-    # 获取章节信息
-    chapter_info = get_chapter_info_from_blueprint(blueprint_text, novel_number)
-    chapter_title = chapter_info["chapter_title"]
-    chapter_role = chapter_info["chapter_role"]
-    chapter_purpose = chapter_info["chapter_purpose"]
-    suspense_level = chapter_info["suspense_level"]
-    foreshadowing = chapter_info["foreshadowing"]
-    plot_twist_level = chapter_info["plot_twist_level"]
-    chapter_summary = chapter_info["chapter_summary"]
-
-    # 获取下一章节信息
-    next_chapter_number = novel_number + 1
-    next_chapter_info = get_chapter_info_from_blueprint(blueprint_text, next_chapter_number)
-    next_chapter_title = next_chapter_info.get("chapter_title", "（未命名）")
-    next_chapter_role = next_chapter_info.get("chapter_role", "过渡章节")
-    next_chapter_purpose = next_chapter_info.get("chapter_purpose", "承上启下")
-    next_chapter_suspense = next_chapter_info.get("suspense_level", "中等")
-    next_chapter_foreshadow = next_chapter_info.get("foreshadowing", "无特殊伏笔")
-    next_chapter_twist = next_chapter_info.get("plot_twist_level", "★☆☆☆☆")
-    next_chapter_summary = next_chapter_info.get("chapter_summary", "衔接过渡内容")
+    blueprint_text = read_file(directory_file)
 
     # 创建章节目录
     chapters_dir = os.path.join(filepath, "chapters")
     os.makedirs(chapters_dir, exist_ok=True)
 
-    # 第一章特殊处理
-    if novel_number == 1:
+    return {
+        "novel_architecture_text": read_file(arch_file),
+        "global_summary_text": read_file(global_summary_file),
+        "character_state_text": read_file(character_state_file),
+        "chapter_info": get_chapter_info_from_blueprint(blueprint_text, novel_number),
+        "next_chapter_info": get_chapter_info_from_blueprint(blueprint_text, novel_number + 1),
+        "chapters_dir": chapters_dir
+    }
+
+def _format_first_chapter_prompt(
+    ctx: dict,
+    novel_number: int,
+    word_number: int,
+    user_guidance: str,
+    characters_involved: str,
+    key_items: str,
+    scene_location: str,
+    time_constraint: str,
+    interface_format: str = "",
+    base_url: str = "",
+    model_name: str = "",
+    max_tokens: int = 0
+) -> str:
+    chapter_info = ctx["chapter_info"]
+
+    def render(novel_setting: str) -> str:
         return first_chapter_draft_prompt.format(
             novel_number=novel_number,
             word_number=word_number,
-            chapter_title=chapter_title,
-            chapter_role=chapter_role,
-            chapter_purpose=chapter_purpose,
-            suspense_level=suspense_level,
-            foreshadowing=foreshadowing,
-            plot_twist_level=plot_twist_level,
-            chapter_summary=chapter_summary,
+            chapter_title=chapter_info["chapter_title"],
+            chapter_role=chapter_info["chapter_role"],
+            chapter_purpose=chapter_info["chapter_purpose"],
+            suspense_level=chapter_info["suspense_level"],
+            foreshadowing=chapter_info["foreshadowing"],
+            plot_twist_level=chapter_info["plot_twist_level"],
+            chapter_summary=chapter_info["chapter_summary"],
             characters_involved=characters_involved,
             key_items=key_items,
             scene_location=scene_location,
             time_constraint=time_constraint,
             user_guidance=user_guidance,
-            novel_setting=novel_architecture_text
+            novel_setting=novel_setting
+        )
+
+    budget = prompt_budget_for(count_tokens(render(""), model_name), interface_format, base_url, model_name, max_tokens)
+    budget.add("novel_setting", ctx["novel_architecture_text"], priority=1)
+    # 第一章只生成一次，没有跨章节共享的前缀；整段作为本章内容，续写时仍作为前缀复用
+    return layered_prompt((CHAPTER, render(budget.fit()["novel_setting"])))
+
+def _get_previous_excerpt(recent_texts: list) -> str:
+    """获取前一章正文，结尾段在 _format_next_chapter_prompt 中按 token 配额截取"""
+    for text in reversed(recent_texts):
+        if text.strip():
+            return text
+    return ""
+
+def _build_knowledge_search_prompt(
+    ctx: dict,
+    novel_number: int,
+    short_summary: str,
+    user_guidance: str,
+    characters_involved: str,
+    key_items: str,
+    scene_location: str,
+    time_constraint: str
+) -> str:
+    chapter_info = ctx["chapter_info"]
+    return knowledge_search_prompt.format(
+        chapter_number=novel_number,
+        chapter_title=chapter_info["chapter_title"],
+        characters_involved=characters_involved,
+        key_items=key_items,
+        scene_location=scene_location,
+        chapter_role=chapter_info["chapter_role"],
+        chapter_purpose=chapter_info["chapter_purpose"],
+        foreshadowing=chapter_info["foreshadowing"],
+        short_summary=short_summary,
+        user_guidance=user_guidance,
+        time_constraint=time_constraint
+    )
+
+def _retrieve_keyword_contexts(embedding_adapter, filepath: str, keyword_groups: list, embedding_retrieval_k: int, novel_number: int = None, max_tokens: int = 1500) -> list:
+    """
+    按关键词组执行向量检索（一次批量请求，结果按片段去重），并按关键词类型打上 TECHNIQUE/SETTING/GENERAL 标签。
+    最近 RECENT_CHAPTERS_EXCLUDED 章的片段在检索时即被排除；其余片段按元数据标注使用规则（见 label_retrieved_segment）。
+    """
+    all_contexts = []
+    hits = get_relevant_hits_for_queries(
+        embedding_adapter=embedding_adapter,
+        queries=keyword_groups,
+        filepath=filepath,
+        k=embedding_retrieval_k,
+        where=build_retrieval_filter(current_chapter=novel_number, exclude_recent=RECENT_CHAPTERS_EXCLUDED)
+    )
+    for group, group_hits in zip(keyword_groups, hits):
+        if not group_hits:
+            continue
+        context = truncate_to_tokens(
+            "\n".join(label_retrieved_segment(text, metadata, novel_number) for text, metadata in group_hits),
+            max_tokens
+        )
+        if any(kw in group.lower() for kw in ["技法", "手法", "模板"]):
+            all_contexts.append(f"[TECHNIQUE] {context}")
+        elif any(kw in group.lower() for kw in ["设定", "技术", "世界观"]):
+            all_contexts.append(f"[SETTING] {context}")
+        else:
+            all_contexts.append(f"[GENERAL] {context}")
+    return all_contexts
+
+def _build_filter_chapter_info(
+    ctx: dict,
+    novel_number: int,
+    characters_involved: str,
+    key_items: str,
+    scene_location: str,
+    time_constraint: str
+) -> dict:
+    chapter_info = ctx["chapter_info"]
+    return {
+        "chapter_number": novel_number,
+        "chapter_title": chapter_info["chapter_title"],
+        "chapter_role": chapter_info["chapter_role"],
+        "chapter_purpose": chapter_info["chapter_purpose"],
+        "characters_involved": characters_involved,
+        "key_items": key_items,
+        "scene_location": scene_location,
+        "foreshadowing": chapter_info["foreshadowing"],  # 修复拼写错误
+        "suspense_level": chapter_info["suspense_level"],
+        "plot_twist_level": chapter_info["plot_twist_level"],
+        "chapter_summary": chapter_info["chapter_summary"],
+        "time_constraint": time_constraint
+    }
+
+def _format_next_chapter_prompt(
+    ctx: dict,
+    novel_number: int,
+    word_number: int,
+    user_guidance: str,
+    characters_involved: str,
+    key_items: str,
+    scene_location: str,
+    time_constraint: str,
+    short_summary: str,
+    previous_excerpt: str,
+    filtered_context: str,
+    interface_format: str = "",
+    base_url: str = "",
+    model_name: str = "",
+    max_tokens: int = 0
+) -> str:
+    chapter_info = ctx["chapter_info"]
+    next_chapter_info = ctx["next_chapter_info"]
+
+    def render_chapter_part(sections: dict) -> str:
+        return next_chapter_draft_chapter_prompt.format(
+            user_guidance=sections["user_guidance"],
+            previous_chapter_excerpt=sections["previous_excerpt"],
+            short_summary=sections["short_summary"],
+            novel_number=novel_number,
+            chapter_title=chapter_info["chapter_title"],
+            chapter_role=chapter_info["chapter_role"],
+            chapter_purpose=chapter_info["chapter_purpose"],
+            suspense_level=chapter_info["suspense_level"],
+            foreshadowing=chapter_info["foreshadowing"],
+            plot_twist_level=chapter_info["plot_twist_level"],
+            chapter_summary=chapter_info["chapter_summary"],
+            word_number=word_number,
+            characters_involved=characters_involved,
+            key_items=key_items,
+            scene_location=scene_location,
+            time_constraint=time_constraint,
+            next_chapter_number=novel_number + 1,
+            next_chapter_title=next_chapter_info.get("chapter_title", "（未命名）"),
+            next_chapter_role=next_chapter_info.get("chapter_role", "过渡章节"),
+            next_chapter_purpose=next_chapter_info.get("chapter_purpose", "承上启下"),
+            next_chapter_suspense_level=next_chapter_info.get("suspense_level", "中等"),
+            next_chapter_foreshadowing=next_chapter_info.get("foreshadowing", "无特殊伏笔"),
+            next_chapter_plot_twist_level=next_chapter_info.get("plot_twist_level", "★☆☆☆☆"),
+            next_chapter_summary=next_chapter_info.get("chapter_summary", "衔接过渡内容"),
+            filtered_context=sections["filtered_context"]
+        )
+
+    def render_context_part(sections: dict) -> str:
+        return next_chapter_draft_context_prompt.format(
+            global_summary=sections["global_summary"],
+            character_state=sections["character_state"]
+        )
+
+    empty = dict.fromkeys(
+        ["user_guidance", "previous_excerpt", "short_summary", "filtered_context", "global_summary", "character_state"], ""
+    )
+    template_tokens = count_tokens(
+        "\n".join([next_chapter_draft_static_prompt, render_context_part(empty), render_chapter_part(empty)]),
+        model_name
+    )
+    # 优先级越低越先被压缩：知识库参考最先
+    budget = prompt_budget_for(template_tokens, interface_format, base_url, model_name, max_tokens)
+    budget.add("user_guidance", user_guidance if user_guidance else "无特殊指导", priority=6)
+    budget.add("character_state", ctx["character_state_text"], priority=5, floor=1000)
+    budget.add("previous_excerpt", previous_excerpt, priority=4, quota=PREVIOUS_EXCERPT_TOKENS, floor=200, keep="tail")
+    budget.add("short_summary", short_summary, priority=3, quota=SHORT_SUMMARY_TOKENS, floor=300)
+    budget.add("global_summary", ctx["global_summary_text"], priority=2, floor=500, keep="tail")
+    budget.add("filtered_context", filtered_context, priority=1, quota=FILTERED_CONTEXT_TOKENS)
+    sections = budget.fit()
+
+    return layered_prompt(
+        (STATIC, next_chapter_draft_static_prompt),
+        (NOVEL, render_context_part(sections)),
+        (CHAPTER, render_chapter_part(sections)),
+        separator="\n"
+    )
+
+def _build_chapter_prompt_steps(
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    filepath: str,
+    novel_number: int,
+    word_number: int,
+    temperature: float,
+    user_guidance: str,
+    characters_involved: str,
+    key_items: str,
+    scene_location: str,
+    time_constraint: str,
+    embedding_api_key: str,
+    embedding_url: str,
+    embedding_interface_format: str,
+    embedding_model_name: str,
+    embedding_retrieval_k: int,
+    interface_format: str,
+    max_tokens: int,
+    timeout: int
+):
+    """build_chapter_prompt 与其异步版本共用的流程（见 common.run_steps）"""
+    ctx = yield BlockingCall(_load_chapter_prompt_context, (filepath, novel_number))
+    # 提示词按实际写草稿的模型（stage_llms 中的 draft）计算 token 预算
+    draft_llm = resolve_stage_llm(
+        "draft", interface_format, base_url, model_name, api_key, temperature, max_tokens, timeout
+    )
+
+    # 第一章特殊处理
+    if novel_number == 1:
+        return _format_first_chapter_prompt(
+            ctx, novel_number, word_number, user_guidance,
+            characters_involved, key_items, scene_location, time_constraint,
+            interface_format=draft_llm["interface_format"], base_url=draft_llm["base_url"],
+            model_name=draft_llm["model_name"], max_tokens=draft_llm["max_tokens"]
         )
 
     # 获取前文内容和摘要
-    recent_texts = get_last_n_chapters_text(chapters_dir, novel_number, n=3)
+    recent_texts = yield BlockingCall(get_last_n_chapters_text, (ctx["chapters_dir"], novel_number, 3))
     
     try:
         logging.info("Attempting to generate summary")
-        short_summary = summarize_recent_chapters(
+        short_summary = yield from _summarize_recent_chapters_steps(
             interface_format=interface_format,
             api_key=api_key,
             base_url=base_url,
@@ -374,8 +661,8 @@ def build_chapter_prompt(
             max_tokens=max_tokens,
             chapters_text_list=recent_texts,
             novel_number=novel_number,
-            chapter_info=chapter_info,
-            next_chapter_info=next_chapter_info,
+            chapter_info=ctx["chapter_info"],
+            next_chapter_info=ctx["next_chapter_info"],
             timeout=timeout
         )
         logging.info("Summary generated successfully")
@@ -383,17 +670,14 @@ def build_chapter_prompt(
         logging.error(f"Error in summarize_recent_chapters: {str(e)}")
         short_summary = "（摘要生成失败）"
 
-    # 获取前一章结尾
-    previous_excerpt = ""
-    for text in reversed(recent_texts):
-        if text.strip():
-            previous_excerpt = text[-800:] if len(text) > 800 else text
-            break
+    previous_excerpt = _get_previous_excerpt(recent_texts)
+    check_cancelled()
 
     # 知识库检索和处理
     try:
         # 生成检索关键词
-        llm_adapter = create_llm_adapter(
+        llm_kwargs = resolve_stage_llm(
+            "keyword_search",
             interface_format=interface_format,
             base_url=base_url,
             model_name=model_name,
@@ -402,26 +686,15 @@ def build_chapter_prompt(
             max_tokens=max_tokens,
             timeout=timeout
         )
-        
-        search_prompt = knowledge_search_prompt.format(
-            chapter_number=novel_number,
-            chapter_title=chapter_title,
-            characters_involved=characters_involved,
-            key_items=key_items,
-            scene_location=scene_location,
-            chapter_role=chapter_role,
-            chapter_purpose=chapter_purpose,
-            foreshadowing=foreshadowing,
-            short_summary=short_summary,
-            user_guidance=user_guidance,
-            time_constraint=time_constraint
+        llm_adapter = create_llm_adapter(**llm_kwargs)
+        search_prompt = _build_knowledge_search_prompt(
+            ctx, novel_number, short_summary, user_guidance,
+            characters_involved, key_items, scene_location, time_constraint
         )
-        
-        search_response = invoke_with_cleaning(llm_adapter, search_prompt)
+        search_response = yield LLMCall(llm_adapter, search_prompt, "keyword_search")
         keyword_groups = parse_search_keywords(search_response)
 
         # 执行向量检索
-        all_contexts = []
         from embedding_adapters import create_embedding_adapter
         embedding_adapter = create_embedding_adapter(
             embedding_interface_format,
@@ -429,55 +702,20 @@ def build_chapter_prompt(
             embedding_url,
             embedding_model_name
         )
-        
-        store = load_vector_store(embedding_adapter, filepath)
-        if store:
-            collection_size = store._collection.count()
-            actual_k = min(embedding_retrieval_k, max(1, collection_size))
-            
-            for group in keyword_groups:
-                context = get_relevant_context_from_vector_store(
-                    embedding_adapter=embedding_adapter,
-                    query=group,
-                    filepath=filepath,
-                    k=actual_k
-                )
-                if context:
-                    if any(kw in group.lower() for kw in ["技法", "手法", "模板"]):
-                        all_contexts.append(f"[TECHNIQUE] {context}")
-                    elif any(kw in group.lower() for kw in ["设定", "技术", "世界观"]):
-                        all_contexts.append(f"[SETTING] {context}")
-                    else:
-                        all_contexts.append(f"[GENERAL] {context}")
-
-        # 应用内容规则
-        processed_contexts = apply_content_rules(all_contexts, novel_number)
-        
+        all_contexts = yield BlockingCall(
+            _retrieve_keyword_contexts, (embedding_adapter, filepath, keyword_groups, embedding_retrieval_k, novel_number)
+        )
+
         # 执行知识过滤
-        chapter_info_for_filter = {
-            "chapter_number": novel_number,
-            "chapter_title": chapter_title,
-            "chapter_role": chapter_role,
-            "chapter_purpose": chapter_purpose,
-            "characters_involved": characters_involved,
-            "key_items": key_items,
-            "scene_location": scene_location,
-            "foreshadowing": foreshadowing,  # 修复拼写错误
-            "suspense_level": suspense_level,
-            "plot_twist_level": plot_twist_level,
-            "chapter_summary": chapter_summary,
-            "time_constraint": time_constraint
-        }
-        
-        filtered_context = get_filtered_knowledge_context(
+        filtered_context = yield from _filtered_knowledge_context_steps(
             api_key=api_key,
             base_url=base_url,
             model_name=model_name,
             interface_format=interface_format,
-            embedding_adapter=embedding_adapter,
-            filepath=filepath,
-            chapter_info=chapter_info_for_filter,
-            retrieved_texts=processed_contexts,
+            chapter_info=_build_filter_chapter_info(
+                ctx, novel_number, characters_involved, key_items, scene_location, time_constraint
+            ),
+            retrieved_texts=all_contexts,
             max_tokens=max_tokens,
             timeout=timeout
         )
@@ -487,36 +725,167 @@ def build_chapter_prompt(
         filtered_context = "（知识库处理失败）"
 
     # 返回最终提示词
-    return next_chapter_draft_prompt.format(
-        user_guidance=user_guidance if user_guidance else "无特殊指导",
-        global_summary=global_summary_text,
-        previous_chapter_excerpt=previous_excerpt,
-        character_state=character_state_text,
+    return _format_next_chapter_prompt(
+        ctx, novel_number, word_number, user_guidance,
+        characters_involved, key_items, scene_location, time_constraint,
         short_summary=short_summary,
-        novel_number=novel_number,
-        chapter_title=chapter_title,
-        chapter_role=chapter_role,
-        chapter_purpose=chapter_purpose,
-        suspense_level=suspense_level,
-        foreshadowing=foreshadowing,
-        plot_twist_level=plot_twist_level,
-        chapter_summary=chapter_summary,
-        word_number=word_number,
-        characters_involved=characters_involved,
-        key_items=key_items,
-        scene_location=scene_location,
-        time_constraint=time_constraint,
-        next_chapter_number=next_chapter_number,
-        next_chapter_title=next_chapter_title,
-        next_chapter_role=next_chapter_role,
-        next_chapter_purpose=next_chapter_purpose,
-        next_chapter_suspense_level=next_chapter_suspense,
-        next_chapter_foreshadowing=next_chapter_foreshadow,
-        next_chapter_plot_twist_level=next_chapter_twist,
-        next_chapter_summary=next_chapter_summary,
-        filtered_context=filtered_context
+        previous_excerpt=previous_excerpt,
+        filtered_context=filtered_context,
+        interface_format=draft_llm["interface_format"],
+        base_url=draft_llm["base_url"],
+        model_name=draft_llm["model_name"],
+        max_tokens=draft_llm["max_tokens"]
     )
 
+@with_usage_scope(chapter_arg="novel_number")
+@with_cancellation()
+def build_chapter_prompt(
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    filepath: str,
+    novel_number: int,
+    word_number: int,
+    temperature: float,
+    user_guidance: str,
+    characters_involved: str,
+    key_items: str,
+    scene_location: str,
+    time_constraint: str,
+    embedding_api_key: str,
+    embedding_url: str,
+    embedding_interface_format: str,
+    embedding_model_name: str,
+    embedding_retrieval_k: int = 2,
+    interface_format: str = "openai",
+    max_tokens: int = 2048,
+    timeout: int = 600,
+    cancel_token=None
+) -> str:
+    """
+    构造当前章节的请求提示词（完整实现版）
+    修改重点：
+    1. 优化知识库检索流程
+    2. 新增内容重复检测机制
+    3. 集成提示词应用规则
+    """
+    return run_steps(_build_chapter_prompt_steps(
+        api_key, base_url, model_name, filepath, novel_number, word_number, temperature,
+        user_guidance, characters_involved, key_items, scene_location, time_constraint,
+        embedding_api_key, embedding_url, embedding_interface_format, embedding_model_name,
+        embedding_retrieval_k, interface_format, max_tokens, timeout
+    ))
+
+@with_usage_scope(chapter_arg="novel_number")
+@with_cancellation()
+async def build_chapter_prompt_async(
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    filepath: str,
+    novel_number: int,
+    word_number: int,
+    temperature: float,
+    user_guidance: str,
+    characters_involved: str,
+    key_items: str,
+    scene_location: str,
+    time_constraint: str,
+    embedding_api_key: str,
+    embedding_url: str,
+    embedding_interface_format: str,
+    embedding_model_name: str,
+    embedding_retrieval_k: int = 2,
+    interface_format: str = "openai",
+    max_tokens: int = 2048,
+    timeout: int = 600,
+    cancel_token=None
+) -> str:
+    """
+    build_chapter_prompt 的异步版本：LLM 调用走 ainvoke，
+    文件读取与向量检索等阻塞操作放到线程池执行，不占用事件循环。
+    """
+    return await arun_steps(_build_chapter_prompt_steps(
+        api_key, base_url, model_name, filepath, novel_number, word_number, temperature,
+        user_guidance, characters_involved, key_items, scene_location, time_constraint,
+        embedding_api_key, embedding_url, embedding_interface_format, embedding_model_name,
+        embedding_retrieval_k, interface_format, max_tokens, timeout
+    ))
+
+class _ContinuationStream:
+    """
+    续写的流式输出：先缓存开头，确定与已写内容的重叠后只转发新增部分；
+    续写重试时重新输出已写内容，保证界面与文件中的内容完整。
+    """
+    def __init__(self, draft: str, on_chunk, on_reset=None):
+        self.draft = draft
+        self.on_chunk = on_chunk
+        self.on_reset = on_reset
+        self.pending = ""
+        self.resolved = False
+
+    def _resolve(self):
+        self.resolved = True
+        delta = merge_continuation(self.draft, self.pending.lstrip(), max_overlap=CONTINUATION_OVERLAP_CHARS)
+        if delta:
+            self.on_chunk(delta)
+
+    def feed(self, chunk: str):
+        if self.resolved:
+            self.on_chunk(chunk)
+            return
+        self.pending += chunk
+        if len(self.pending) >= CONTINUATION_OVERLAP_CHARS:
+            self._resolve()
+
+    def reset(self):
+        if self.on_reset is not None:
+            self.on_reset()
+        self.on_chunk(self.draft)
+        self.pending = ""
+        self.resolved = False
+
+    def finish(self):
+        if not self.resolved:
+            self._resolve()
+
+def _continue_truncated_draft(llm_adapter, prompt_text: str, draft: str, word_number: int, on_chunk=None, on_reset=None) -> str:
+    """
+    草稿因 max_tokens 被截断（finish_reason 为 length）且未达到目标字数时，
+    把原提示词与已写结尾发给模型续写，去掉与已写内容重叠的部分后拼接，只为缺失的部分付费。
+    """
+    for _ in range(MAX_CONTINUATIONS):
+        record = last_usage()
+        if record is None or record.finish_reason != "length" or len(draft) >= word_number:
+            break
+        logging.info(f"[Draft] Output truncated at {len(draft)}/{word_number} chars, requesting continuation.")
+        continuation_prompt = layered_prompt(
+            (NOVEL, prompt_text),
+            (CHAPTER, chapter_continuation_prompt.format(
+                written_chars=len(draft),
+                word_number=word_number,
+                previous_tail=draft[-CONTINUATION_TAIL_CHARS:],
+                remaining_chars=word_number - len(draft)
+            ))
+        )
+        stream = _ContinuationStream(draft, on_chunk, on_reset) if on_chunk is not None else None
+        continuation = invoke_with_cleaning(
+            llm_adapter,
+            continuation_prompt,
+            on_chunk=stream.feed if stream else None,
+            on_reset=stream.reset if stream else None,
+            stage="draft"
+        )
+        if stream:
+            stream.finish()
+        delta = merge_continuation(draft, continuation, max_overlap=CONTINUATION_OVERLAP_CHARS)
+        if not delta.strip():
+            break
+        draft += delta
+    return draft
+
+@with_usage_scope(chapter_arg="novel_number")
+@with_cancellation()
 def generate_chapter_draft(
     api_key: str,
     base_url: str,
@@ -538,10 +907,17 @@ def generate_chapter_draft(
     interface_format: str = "openai",
     max_tokens: int = 2048,
     timeout: int = 600,
-    custom_prompt_text: str = None
+    custom_prompt_text: str = None,
+    stream_callback=None,
+    cancel_token=None
 ) -> str:
     """
-    生成章节草稿，支持自定义提示词
+    生成章节草稿，支持自定义提示词。
+    草稿以流式方式生成：每收到一段文本即追加写入 chapter_N.txt，
+    并回调 stream_callback(chunk)（如需在界面实时显示）；
+    stream_callback(None) 表示上一次输出作废、即将重试。
+    若输出因 max_tokens 被截断且未达到 word_number，会自动续写并拼接。
+    cancel_token（cancellation.CancellationToken）被取消或超过截止时间时中断生成并抛出 OperationCancelled。
     """
     if custom_prompt_text is None:
         prompt_text = build_chapter_prompt(
@@ -572,7 +948,8 @@ def generate_chapter_draft(
     chapters_dir = os.path.join(filepath, "chapters")
     os.makedirs(chapters_dir, exist_ok=True)
 
-    llm_adapter = create_llm_adapter(
+    llm_kwargs = resolve_stage_llm(
+        "draft",
         interface_format=interface_format,
         base_url=base_url,
         model_name=model_name,
@@ -581,11 +958,30 @@ def generate_chapter_draft(
         max_tokens=max_tokens,
         timeout=timeout
     )
+    llm_adapter = create_llm_adapter(**llm_kwargs)
+
+    chapter_file = os.path.join(chapters_dir, f"chapter_{novel_number}.txt")
+    clear_file_content(chapter_file)
+    with open(chapter_file, 'a', encoding='utf-8') as draft_file:
+        def on_chunk(chunk: str):
+            draft_file.write(chunk)
+            draft_file.flush()
+            if stream_callback:
+                stream_callback(chunk)
+
+        def on_reset():
+            draft_file.seek(0)
+            draft_file.truncate()
+            if stream_callback:
+                stream_callback(None)
 
-    chapter_content = invoke_with_cleaning(llm_adapter, prompt_text)
+        chapter_content = invoke_with_cleaning(llm_adapter, prompt_text, on_chunk=on_chunk, on_reset=on_reset, stage="draft")
+        chapter_content = _continue_truncated_draft(
+            llm_adapter, prompt_text, chapter_content, word_number, on_chunk=on_chunk, on_reset=on_reset
+        )
     if not chapter_content.strip():
         logging.warning("Generated chapter draft is empty.")
-    chapter_file = os.path.join(chapters_dir, f"chapter_{novel_number}.txt")
+    # 流式写入的是原始输出，最后用清理后的结果覆盖
     clear_file_content(chapter_file)
     save_string_to_txt(chapter_content, chapter_file)
     logging.info(f"[Draft] Chapter {novel_number} generated as a draft.")
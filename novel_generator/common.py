@@ -3,10 +3,17 @@
 """
 通用重试、清洗、日志工具
 """
+import asyncio
 import logging
+import random
 import re
+import threading
 import time
 import traceback
+from typing import Any, Callable, NamedTuple, Optional
+from novel_generator.llm_cache import get_llm_cache
+from usage_tracker import track_llm_call
+import cancellation
 logging.basicConfig(
     filename='app.log',      # 日志文件名
     filemode='a',            # 追加模式（'w' 会覆盖）
@@ -14,28 +21,172 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
 )
+
+# ============== 重试策略 ==============
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 520, 522, 524, 529}
+FATAL_STATUS_CODES = {400, 401, 402, 403, 404, 405, 413, 415, 422}
+
+class CircuitOpenError(RuntimeError):
+    """端点熔断期间直接失败，不再发出请求"""
+
+def _error_status_code(error: Exception):
+    """从各家 SDK 的异常中取出 HTTP 状态码（openai/azure 的 status_code、requests/httpx 的 response、google 的 code）"""
+    for attr in ("status_code", "code", "status"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    value = getattr(response, "status_code", None) or getattr(response, "status", None)
+    return value if isinstance(value, int) else None
+
+def _retry_after_seconds(error: Exception):
+    """读取响应头中的 Retry-After / retry-after-ms"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers.get("retry-after-ms")) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        # HTTP 日期格式的 Retry-After 不做解析，退回指数退避
+        return None
+    return None
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    区分可重试错误（超时、连接失败、429、5xx）与不可重试错误（鉴权失败、请求参数错误等）。
+    无法识别的异常按可重试处理，与原先的行为保持一致。
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    status_code = _error_status_code(error)
+    if status_code in FATAL_STATUS_CODES:
+        return False
+    if status_code in RETRYABLE_STATUS_CODES or (status_code is not None and status_code >= 500):
+        return True
+    name = type(error).__name__
+    if any(word in name for word in ("Authentication", "PermissionDenied", "BadRequest", "NotFound", "InvalidArgument", "Unprocessable")):
+        return False
+    return True
+
+def is_transient_error(error: Exception) -> bool:
+    """
+    明确属于端点暂时不可用的错误：超时、连接失败、429、5xx。
+    只有这些错误计入熔断；空响应、解析失败等无法识别的异常虽然仍会重试，但不说明端点有问题。
+    """
+    status_code = _error_status_code(error)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    name = type(error).__name__
+    return any(word in name for word in ("Timeout", "Connect", "RemoteProtocol", "ServerDisconnected"))
+
+class RetryPolicy:
+    """带上限的指数退避 + 抖动，优先遵循服务端返回的 Retry-After"""
+    def __init__(self, max_retries: int = 3, base_delay: float = 2.0, max_delay: float = 60.0, jitter: float = 0.5):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def should_retry(self, error: Exception, attempt: int) -> bool:
+        return attempt < self.max_retries and is_retryable_error(error)
+
+    def delay(self, attempt: int, error: Exception = None) -> float:
+        retry_after = _retry_after_seconds(error) if error is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        backoff = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return backoff * (1 - self.jitter + random.random() * self.jitter)
+
+class CircuitBreaker:
+    """
+    单个端点的熔断器：连续 failure_threshold 次暂时性错误（见 is_transient_error）后熔断 cooldown 秒，
+    冷却结束后放行一次试探请求，成功则恢复，失败则重新熔断。
+    """
+    def __init__(self, name: str, failure_threshold: int = 5, cooldown: float = 60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.cooldown - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpenError(f"Circuit for {self.name} is open, retry in {remaining:.0f}s.")
+            # 冷却结束：放行本次试探请求，其余请求继续等待其结果
+            self._opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logging.warning(f"Circuit opened for {self.name} after {self._failures} consecutive failures.")
+                self._opened_at = time.monotonic()
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(llm_adapter) -> CircuitBreaker:
+    """按端点（供应商适配器类型 + base_url + 模型）取得共享的熔断器"""
+    inner = llm_adapter.unwrap() if hasattr(llm_adapter, "unwrap") else llm_adapter
+    key = (type(inner).__name__, getattr(inner, "base_url", ""), getattr(inner, "model_name", ""))
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker("/".join(str(part) for part in key))
+            _circuit_breakers[key] = breaker
+        return breaker
+
 def call_with_retry(func, max_retries=3, sleep_time=2, fallback_return=None, **kwargs):
     """
     通用的重试机制封装。
     :param func: 要执行的函数
     :param max_retries: 最大重试次数
-    :param sleep_time: 重试前的等待秒数
-    :param fallback_return: 如果多次重试仍失败时的返回值
+    :param sleep_time: 首次重试前的基础等待秒数，之后按指数退避
+    :param fallback_return: 如果多次重试仍失败（或遇到不可重试错误）时的返回值
     :param kwargs: 传给func的命名参数
     :return: func的结果，若失败则返回 fallback_return
     """
+    policy = RetryPolicy(max_retries=max_retries, base_delay=sleep_time)
     for attempt in range(1, max_retries + 1):
         try:
             return func(**kwargs)
         except Exception as e:
             logging.warning(f"[call_with_retry] Attempt {attempt} failed with error: {e}")
             traceback.print_exc()
-            if attempt < max_retries:
-                time.sleep(sleep_time)
+            if policy.should_retry(e, attempt):
+                cancellation.sleep(policy.delay(attempt, e))
             else:
-                logging.error("Max retries reached, returning fallback_return.")
+                logging.error("Max retries reached or error is not retryable, returning fallback_return.")
                 return fallback_return
 
+def merge_continuation(text: str, continuation: str, max_overlap: int = 300, min_overlap: int = 6) -> str:
+    """
+    续写拼接：模型续写时常会先复述已写内容的结尾，
+    找出 text 的结尾与 continuation 开头的最长重叠并去掉，返回真正新增的部分。
+    """
+    limit = min(len(text), len(continuation), max_overlap)
+    for size in range(limit, min_overlap - 1, -1):
+        if text.endswith(continuation[:size]):
+            return continuation[size:]
+    return continuation
+
 def remove_think_tags(text: str) -> str:
     """移除 <think>...</think> 包裹的内容"""
     return re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
@@ -48,36 +199,165 @@ def debug_log(prompt: str, response_content: str):
         f"\n[######################################### Response #########################################]\n{response_content}\n"
     )
 
-def invoke_with_cleaning(llm_adapter, prompt: str, max_retries: int = 3) -> str:
-    """调用 LLM 并清理返回结果"""
+# ============== 同步 / 异步共用的流程 ==============
+# 需要同时提供同步与异步版本的流程写成生成器，只在 yield 处交出 I/O：
+#   yield LLMCall(...)          一次 LLM 调用，得到清理后的文本
+#   yield [LLMCall(...), ...]   多次互不依赖的调用，得到结果列表（异步驱动时并发）
+#   yield BlockingCall(...)     文件读取、向量检索等阻塞操作（异步驱动时放到线程池）
+# 由 run_steps / arun_steps 驱动，流程本身只写一份。
+
+class LLMCall(NamedTuple):
+    """流程中的一次 LLM 调用，参数同 invoke_with_cleaning"""
+    llm_adapter: Any
+    prompt: str
+    stage: Optional[str] = None
+
+class BlockingCall(NamedTuple):
+    """流程中的一次阻塞操作：func(*args, **kwargs)"""
+    func: Callable
+    args: tuple = ()
+    kwargs: dict = {}
+
+def _drive(steps, handle):
+    """把 handle(请求) 的结果 send 回生成器，handle 抛出的异常 throw 回生成器，返回生成器的返回值"""
+    reply, error = None, None
+    while True:
+        try:
+            request = steps.throw(error) if error is not None else steps.send(reply)
+        except StopIteration as stop:
+            return stop.value
+        reply, error = None, None
+        try:
+            reply = handle(request)
+        except Exception as e:
+            error = e
+
+async def _adrive(steps, handle):
+    """_drive 的异步版本，handle 返回可等待对象"""
+    reply, error = None, None
+    while True:
+        try:
+            request = steps.throw(error) if error is not None else steps.send(reply)
+        except StopIteration as stop:
+            return stop.value
+        reply, error = None, None
+        try:
+            reply = await handle(request)
+        except Exception as e:
+            error = e
+
+def _handle_step(request):
+    if isinstance(request, list):
+        return [_handle_step(item) for item in request]
+    if isinstance(request, LLMCall):
+        return invoke_with_cleaning(request.llm_adapter, request.prompt, stage=request.stage)
+    return request.func(*request.args, **request.kwargs)
+
+async def _ahandle_step(request):
+    if isinstance(request, list):
+        return list(await asyncio.gather(*(_ahandle_step(item) for item in request)))
+    if isinstance(request, LLMCall):
+        return await ainvoke_with_cleaning(request.llm_adapter, request.prompt, stage=request.stage)
+    return await asyncio.to_thread(request.func, *request.args, **request.kwargs)
+
+def run_steps(steps):
+    """同步执行流程生成器：LLM 调用走 invoke_with_cleaning，多个调用依次执行"""
+    return _drive(steps, _handle_step)
+
+async def arun_steps(steps):
+    """异步执行流程生成器：LLM 调用走 ainvoke_with_cleaning，多个调用并发，阻塞操作放到线程池"""
+    return await _adrive(steps, _ahandle_step)
+
+def _print_block(title: str, text: str):
     print("\n" + "="*50)
-    print("发送到 LLM 的提示词:")
+    print(title)
     print("-"*50)
-    print(prompt)
+    print(text)
     print("="*50 + "\n")
-    
+
+def _invocation_steps(llm_adapter, prompt: str, max_retries: int, stage: str, usage):
+    """
+    invoke_with_cleaning / ainvoke_with_cleaning 共用的调用流程：响应缓存、重试与熔断、结果清理。
+    yield ("call", 第几次尝试) 时由驱动方发起请求，yield ("sleep", 秒数) 时由驱动方等待。
+    """
+    _print_block("发送到 LLM 的提示词:", prompt)
+
+    cache = get_llm_cache()
+    if cache is not None:
+        cached = cache.get(llm_adapter, prompt, stage)
+        if cached is not None:
+            usage.cache_hit = True
+            usage.prompt_tokens = usage.completion_tokens = 0
+            return cached
+
+    policy = RetryPolicy(max_retries=max_retries)
+    breaker = get_circuit_breaker(llm_adapter)
     result = ""
-    retry_count = 0
-    
-    while retry_count < max_retries:
+
+    for attempt in range(1, max_retries + 1):
+        cancellation.check_cancelled()
         try:
-            result = llm_adapter.invoke(prompt)
-            print("\n" + "="*50)
-            print("LLM 返回的内容:")
-            print("-"*50)
-            print(result)
-            print("="*50 + "\n")
-            
-            # 清理结果中的特殊格式标记
-            result = result.replace("```", "").strip()
-            if result:
-                return result
-            retry_count += 1
+            usage.retries = attempt - 1
+            breaker.before_call()
+            result = (yield ("call", attempt)) or ""
         except Exception as e:
-            print(f"调用失败 ({retry_count + 1}/{max_retries}): {str(e)}")
-            retry_count += 1
-            if retry_count >= max_retries:
-                raise e
-    
+            print(f"调用失败 ({attempt}/{max_retries}): {str(e)}")
+            if is_transient_error(e):
+                breaker.record_failure()
+            if not policy.should_retry(e, attempt):
+                raise
+            yield ("sleep", policy.delay(attempt, e))
+            continue
+        breaker.record_success()
+        _print_block("LLM 返回的内容:", result)
+
+        # 清理结果中的特殊格式标记
+        result = result.replace("```", "").strip()
+        usage.output = result
+        if result:
+            if cache is not None:
+                cache.set(llm_adapter, prompt, stage, result)
+            return result
+        if attempt < max_retries:
+            yield ("sleep", policy.delay(attempt))
+
     return result
 
+def invoke_with_cleaning(llm_adapter, prompt: str, max_retries: int = 3, on_chunk=None, on_reset=None, stage: str = None) -> str:
+    """
+    调用 LLM 并清理返回结果。
+    若传入 on_chunk，则改用流式调用，每收到一段文本即回调 on_chunk(chunk)；
+    重试前会回调 on_reset()，便于调用方丢弃上一次不完整的输出。
+    stage 为调用所属阶段名，用于匹配 llm_cache 中按阶段开启的响应缓存，并作为用量统计（usage_tracker）的阶段。
+    """
+    with track_llm_call(stage, prompt) as usage:
+        def handle(request):
+            kind, value = request
+            if kind == "sleep":
+                return cancellation.sleep(value)
+            if on_chunk is None:
+                return llm_adapter.invoke(prompt)
+            if value > 1 and on_reset is not None:
+                on_reset()
+            chunks = []
+            for chunk in llm_adapter.invoke_stream(prompt):
+                usage.mark_first_token()
+                chunks.append(chunk)
+                on_chunk(chunk)
+            return "".join(chunks)
+
+        result = _drive(_invocation_steps(llm_adapter, prompt, max_retries, stage, usage), handle)
+        if usage.cache_hit and on_chunk is not None:
+            on_chunk(result)
+        return result
+
+async def ainvoke_with_cleaning(llm_adapter, prompt: str, max_retries: int = 3, stage: str = None) -> str:
+    """invoke_with_cleaning 的异步版本，使用适配器的 ainvoke"""
+    with track_llm_call(stage, prompt) as usage:
+        async def handle(request):
+            kind, value = request
+            if kind == "sleep":
+                return await cancellation.asleep(value)
+            return await llm_adapter.ainvoke(prompt)
+
+        return await _adrive(_invocation_steps(llm_adapter, prompt, max_retries, stage, usage), handle)
@@ -1,16 +1,22 @@
 #novel_generator/finalization.py
 # -*- coding: utf-8 -*-
 """
-定稿章节和扩写章节（finalize_chapter、enrich_chapter_text）
+定稿、扩写与删除章节（finalize_chapter、enrich_chapter_text、delete_chapter）
 """
 import os
 import logging
-from llm_adapters import create_llm_adapter
+from llm_adapters import create_llm_adapter, resolve_stage_llm
+from usage_tracker import with_usage_scope
+from cancellation import with_cancellation, check_cancelled
 from embedding_adapters import create_embedding_adapter
 from prompt_definitions import summary_prompt, update_character_state_prompt
-from novel_generator.common import invoke_with_cleaning
+from novel_generator.common import invoke_with_cleaning, LLMCall, BlockingCall, run_steps, arun_steps
 from utils import read_file, clear_file_content, save_string_to_txt
-from novel_generator.vectorstore_utils import update_vector_store
+from novel_generator.vectorstore_utils import (
+    update_vector_store,
+    delete_chapter_from_vector_store,
+    sync_chapters_with_vector_store
+)
 logging.basicConfig(
     filename='app.log',      # 日志文件名
     filemode='a',            # 追加模式（'w' 会覆盖）
@@ -18,9 +24,26 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
 )
-def finalize_chapter(
+def _read_finalize_inputs(filepath: str, novel_number: int) -> tuple:
+    """读取定稿所需的 (章节正文, 旧前文摘要, 旧角色状态)"""
+    chapter_file = os.path.join(filepath, "chapters", f"chapter_{novel_number}.txt")
+    return (
+        read_file(chapter_file).strip(),
+        read_file(os.path.join(filepath, "global_summary.txt")),
+        read_file(os.path.join(filepath, "character_state.txt"))
+    )
+
+def _save_finalize_outputs(filepath: str, global_summary: str, character_state: str):
+    """写入新的前文摘要与角色状态"""
+    global_summary_file = os.path.join(filepath, "global_summary.txt")
+    character_state_file = os.path.join(filepath, "character_state.txt")
+    clear_file_content(global_summary_file)
+    save_string_to_txt(global_summary, global_summary_file)
+    clear_file_content(character_state_file)
+    save_string_to_txt(character_state, character_state_file)
+
+def _finalize_steps(
     novel_number: int,
-    word_number: int,
     api_key: str,
     base_url: str,
     model_name: str,
@@ -32,56 +55,43 @@ def finalize_chapter(
     embedding_model_name: str,
     interface_format: str,
     max_tokens: int,
-    timeout: int = 600
+    timeout: int
 ):
-    """
-    对指定章节做最终处理：更新前文摘要、更新角色状态、插入向量库等。
-    默认无需再做扩写操作，若有需要可在外部调用 enrich_chapter_text 处理后再定稿。
-    """
-    chapters_dir = os.path.join(filepath, "chapters")
-    chapter_file = os.path.join(chapters_dir, f"chapter_{novel_number}.txt")
-    chapter_text = read_file(chapter_file).strip()
+    """finalize_chapter 与其异步版本共用的流程（见 common.run_steps）"""
+    chapter_text, old_global_summary, old_character_state = yield BlockingCall(
+        _read_finalize_inputs, (filepath, novel_number)
+    )
     if not chapter_text:
         logging.warning(f"Chapter {novel_number} is empty, cannot finalize.")
         return
 
-    global_summary_file = os.path.join(filepath, "global_summary.txt")
-    old_global_summary = read_file(global_summary_file)
-    character_state_file = os.path.join(filepath, "character_state.txt")
-    old_character_state = read_file(character_state_file)
-
-    llm_adapter = create_llm_adapter(
-        interface_format=interface_format,
-        base_url=base_url,
-        model_name=model_name,
-        api_key=api_key,
-        temperature=temperature,
-        max_tokens=max_tokens,
-        timeout=timeout
-    )
+    llm_args = (interface_format, base_url, model_name, api_key, temperature, max_tokens, timeout)
+    summary_adapter = create_llm_adapter(**resolve_stage_llm("global_summary", *llm_args))
+    character_state_adapter = create_llm_adapter(**resolve_stage_llm("character_state", *llm_args))
 
     prompt_summary = summary_prompt.format(
         chapter_text=chapter_text,
         global_summary=old_global_summary
     )
-    new_global_summary = invoke_with_cleaning(llm_adapter, prompt_summary)
-    if not new_global_summary.strip():
-        new_global_summary = old_global_summary
-
     prompt_char_state = update_character_state_prompt.format(
         chapter_text=chapter_text,
         old_state=old_character_state
     )
-    new_char_state = invoke_with_cleaning(llm_adapter, prompt_char_state)
+    # 前文摘要与角色状态的更新互不依赖，异步版本中并发请求
+    new_global_summary, new_char_state = yield [
+        LLMCall(summary_adapter, prompt_summary, "global_summary"),
+        LLMCall(character_state_adapter, prompt_char_state, "character_state")
+    ]
+    if not new_global_summary.strip():
+        new_global_summary = old_global_summary
     if not new_char_state.strip():
         new_char_state = old_character_state
 
-    clear_file_content(global_summary_file)
-    save_string_to_txt(new_global_summary, global_summary_file)
-    clear_file_content(character_state_file)
-    save_string_to_txt(new_char_state, character_state_file)
+    # 取消时不写入只完成了一半的摘要与角色状态
+    check_cancelled()
+    yield BlockingCall(_save_finalize_outputs, (filepath, new_global_summary, new_char_state))
 
-    update_vector_store(
+    yield BlockingCall(update_vector_store, kwargs=dict(
         embedding_adapter=create_embedding_adapter(
             embedding_interface_format,
             embedding_api_key,
@@ -89,11 +99,71 @@ def finalize_chapter(
             embedding_model_name
         ),
         new_chapter=chapter_text,
-        filepath=filepath
-    )
+        filepath=filepath,
+        chapter_number=novel_number
+    ))
 
     logging.info(f"Chapter {novel_number} has been finalized.")
 
+@with_usage_scope(chapter_arg="novel_number")
+@with_cancellation()
+def finalize_chapter(
+    novel_number: int,
+    word_number: int,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    temperature: float,
+    filepath: str,
+    embedding_api_key: str,
+    embedding_url: str,
+    embedding_interface_format: str,
+    embedding_model_name: str,
+    interface_format: str,
+    max_tokens: int,
+    timeout: int = 600,
+    cancel_token=None
+):
+    """
+    对指定章节做最终处理：更新前文摘要、更新角色状态、插入向量库等。
+    默认无需再做扩写操作，若有需要可在外部调用 enrich_chapter_text 处理后再定稿。
+    """
+    run_steps(_finalize_steps(
+        novel_number, api_key, base_url, model_name, temperature, filepath,
+        embedding_api_key, embedding_url, embedding_interface_format, embedding_model_name,
+        interface_format, max_tokens, timeout
+    ))
+
+@with_usage_scope(chapter_arg="novel_number")
+@with_cancellation()
+async def finalize_chapter_async(
+    novel_number: int,
+    word_number: int,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    temperature: float,
+    filepath: str,
+    embedding_api_key: str,
+    embedding_url: str,
+    embedding_interface_format: str,
+    embedding_model_name: str,
+    interface_format: str,
+    max_tokens: int,
+    timeout: int = 600,
+    cancel_token=None
+):
+    """
+    finalize_chapter 的异步版本。
+    前文摘要与角色状态在同一事件循环中并发请求；向量库写入为阻塞操作，放到线程池执行。
+    """
+    await arun_steps(_finalize_steps(
+        novel_number, api_key, base_url, model_name, temperature, filepath,
+        embedding_api_key, embedding_url, embedding_interface_format, embedding_model_name,
+        interface_format, max_tokens, timeout
+    ))
+
+@with_cancellation()
 def enrich_chapter_text(
     chapter_text: str,
     word_number: int,
@@ -103,23 +173,66 @@ def enrich_chapter_text(
     temperature: float,
     interface_format: str,
     max_tokens: int,
-    timeout: int=600
+    timeout: int=600,
+    cancel_token=None
 ) -> str:
     """
     对章节文本进行扩写，使其更接近 word_number 字数，保持剧情连贯。
     """
-    llm_adapter = create_llm_adapter(
-        interface_format=interface_format,
-        base_url=base_url,
-        model_name=model_name,
-        api_key=api_key,
-        temperature=temperature,
-        max_tokens=max_tokens,
-        timeout=timeout
-    )
+    llm_adapter = create_llm_adapter(**resolve_stage_llm(
+        "enrich", interface_format, base_url, model_name, api_key, temperature, max_tokens, timeout
+    ))
     prompt = f"""以下章节文本较短，请在保持剧情连贯的前提下进行扩写，使其更充实，接近 {word_number} 字左右，仅给出最终文本，不要解释任何内容。：
 原内容：
 {chapter_text}
 """
-    enriched_text = invoke_with_cleaning(llm_adapter, prompt)
+    enriched_text = invoke_with_cleaning(llm_adapter, prompt, stage="enrich")
     return enriched_text if enriched_text else chapter_text
+
+def delete_chapter(
+    novel_number: int,
+    filepath: str,
+    embedding_api_key: str,
+    embedding_url: str,
+    embedding_interface_format: str,
+    embedding_model_name: str
+) -> int:
+    """
+    删除第 novel_number 章：先从向量库移除该章片段（含内容相同的旧版本片段），再删除章节文件。
+    返回从向量库删除的片段数。
+    """
+    chapter_file = os.path.join(filepath, "chapters", f"chapter_{novel_number}.txt")
+    chapter_text = read_file(chapter_file) if os.path.exists(chapter_file) else ""
+    removed = delete_chapter_from_vector_store(
+        create_embedding_adapter(
+            embedding_interface_format,
+            embedding_api_key,
+            embedding_url,
+            embedding_model_name
+        ),
+        filepath,
+        novel_number,
+        chapter_text
+    )
+    if os.path.exists(chapter_file):
+        os.remove(chapter_file)
+    logging.info(f"Chapter {novel_number} has been deleted ({removed} vector store segments removed).")
+    return removed
+
+def sync_chapter_vectors(
+    filepath: str,
+    embedding_api_key: str,
+    embedding_url: str,
+    embedding_interface_format: str,
+    embedding_model_name: str
+) -> dict:
+    """使向量库与 chapters 目录一致（见 vectorstore_utils.sync_chapters_with_vector_store），用于在程序外增删章节文件之后"""
+    return sync_chapters_with_vector_store(
+        create_embedding_adapter(
+            embedding_interface_format,
+            embedding_api_key,
+            embedding_url,
+            embedding_model_name
+        ),
+        filepath
+    )
@@ -4,14 +4,13 @@
 知识文件导入至向量库（advanced_split_content、import_knowledge_file）
 """
 import os
+import hashlib
 import logging
 import re
 import traceback
-import nltk
 import warnings
 from utils import read_file
-from novel_generator.vectorstore_utils import load_vector_store, init_vector_store
-from langchain.docstore.document import Document
+from novel_generator.vectorstore_utils import add_texts_to_vector_store, knowledge_metadata, segment_id
 
 # 禁用特定的Torch警告
 warnings.filterwarnings('ignore', message='.*Torch was not compiled with flash attention.*')
@@ -25,6 +24,7 @@ logging.basicConfig(
 )
 def advanced_split_content(content: str, similarity_threshold: float = 0.7, max_length: int = 500) -> list:
     """使用基本分段策略"""
+    import nltk
     # nltk.download('punkt', quiet=True)
     # nltk.download('punkt_tab', quiet=True)
     sentences = nltk.sent_tokenize(content)
@@ -75,19 +75,17 @@ def import_knowledge_file(
         embedding_url if embedding_url else "http://localhost:11434/api",
         embedding_model_name
     )
-    store = load_vector_store(embedding_adapter, filepath)
-    if not store:
-        logging.info("Vector store does not exist or load failed. Initializing a new one for knowledge import...")
-        store = init_vector_store(embedding_adapter, paragraphs, filepath)
-        if store:
-            logging.info("知识库文件已成功导入至向量库(新初始化)。")
+    try:
+        knowledge_id = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+        source_file = os.path.basename(file_path)
+        metadatas = [knowledge_metadata(knowledge_id, source_file, i) for i in range(len(paragraphs))]
+        # 同一文件重复导入时 id 相同，覆盖而不是重复写入
+        ids = [segment_id(f"knowledge-{knowledge_id}", i, p) for i, p in enumerate(paragraphs)]
+        added = add_texts_to_vector_store(embedding_adapter, paragraphs, filepath, metadatas, ids)
+        if added:
+            logging.info(f"知识库文件已成功导入至向量库（{added}/{len(paragraphs)} 段）。")
         else:
             logging.warning("知识库导入失败，跳过。")
-    else:
-        try:
-            docs = [Document(page_content=str(p)) for p in paragraphs]
-            store.add_documents(docs)
-            logging.info("知识库文件已成功导入至向量库(追加模式)。")
-        except Exception as e:
-            logging.warning(f"知识库导入失败: {e}")
-            traceback.print_exc()
+    except Exception as e:
+        logging.warning(f"知识库导入失败: {e}")
+        traceback.print_exc()
@@ -0,0 +1,184 @@
+#novel_generator/llm_cache.py
+# -*- coding: utf-8 -*-
+"""
+LLM 响应持久化缓存（按 适配器配置 + 提示词 的哈希寻址，SQLite 存储，LRU 淘汰）
+默认关闭，需在 config.json 的 llm_cache 中开启，并按阶段（stage）单独启用。
+"""
+import os
+import json
+import time
+import logging
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+# 低温度、输出确定的阶段默认开启缓存，其余阶段需在配置中显式开启
+DEFAULT_CACHE_STAGES = {
+    "summary": True,
+    "keyword_search": True,
+    "knowledge_filter": True,
+}
+
+class LLMResponseCache:
+    """
+    基于 SQLite 的内容寻址响应缓存。
+    - 键：sha256(适配器类型、base_url、模型、温度、max_tokens、提示词)
+    - 总大小超过 max_bytes 时按最近访问时间淘汰
+    - 每个阶段可单独开关并设置 TTL（秒，None 表示不过期）
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = 200 * 1024 * 1024,
+                 default_ttl: Optional[float] = None, stages: dict = None):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, "llm_responses.sqlite3")
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.stages = stages if stages is not None else {
+            name: {"enabled": enabled} for name, enabled in DEFAULT_CACHE_STAGES.items()
+        }
+        self._lock = threading.Lock()
+        self._stats = {}
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, stage TEXT, value TEXT, size INTEGER, "
+                "created_at REAL, last_access REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def is_enabled(self, stage: str) -> bool:
+        return bool(stage) and bool(self.stages.get(stage, {}).get("enabled", False))
+
+    def _ttl(self, stage: str) -> Optional[float]:
+        return self.stages.get(stage, {}).get("ttl", self.default_ttl)
+
+    @staticmethod
+    def make_key(llm_adapter, prompt: str) -> str:
+        inner = llm_adapter.unwrap() if hasattr(llm_adapter, "unwrap") else llm_adapter
+        identity = [
+            type(inner).__name__,
+            getattr(llm_adapter, "base_url", ""),
+            getattr(llm_adapter, "model_name", ""),
+            getattr(llm_adapter, "temperature", None),
+            getattr(llm_adapter, "max_tokens", None),
+            prompt,
+        ]
+        return hashlib.sha256(json.dumps(identity, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _count(self, stage: str, field: str):
+        with self._lock:
+            stage_stats = self._stats.setdefault(stage, {"hits": 0, "misses": 0, "writes": 0})
+            stage_stats[field] += 1
+
+    def get(self, llm_adapter, prompt: str, stage: str) -> Optional[str]:
+        """命中则返回缓存内容并刷新访问时间；未命中或已过期返回 None。"""
+        if not self.is_enabled(stage):
+            return None
+        key = self.make_key(llm_adapter, prompt)
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    ttl = self._ttl(stage)
+                    if ttl is not None and now - row[1] > ttl:
+                        conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                        row = None
+                    else:
+                        conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            logging.warning(f"LLM cache read failed: {e}")
+            return None
+        if row is None:
+            self._count(stage, "misses")
+            return None
+        self._count(stage, "hits")
+        logging.info(f"[llm_cache] Hit for stage '{stage}'.")
+        return row[0]
+
+    def set(self, llm_adapter, prompt: str, stage: str, value: str):
+        if not self.is_enabled(stage) or not value:
+            return
+        key = self.make_key(llm_adapter, prompt)
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, stage, value, size, created_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, stage, value, size, now, now)
+                )
+                self._evict(conn)
+        except sqlite3.Error as e:
+            logging.warning(f"LLM cache write failed: {e}")
+            return
+        self._count(stage, "writes")
+
+    def _evict(self, conn):
+        """总大小超出上限时，按最近访问时间从旧到新淘汰"""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall():
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+    def stats(self) -> dict:
+        """按阶段返回命中/未命中/写入次数"""
+        with self._lock:
+            return {stage: dict(values) for stage, values in self._stats.items()}
+
+
+_llm_cache: Optional[LLMResponseCache] = None
+
+def configure_llm_cache(cache_config: dict) -> Optional[LLMResponseCache]:
+    """
+    根据 config.json 中的 llm_cache 配置启用/关闭全局缓存，例如：
+    {"enabled": true, "cache_dir": ".llm_cache", "max_size_mb": 200, "ttl_hours": 168,
+     "stages": {"keyword_search": {"enabled": true, "ttl_hours": 24}, "draft": {"enabled": false}}}
+    """
+    global _llm_cache
+    cache_config = cache_config or {}
+    if not cache_config.get("enabled", False):
+        _llm_cache = None
+        return None
+
+    def hours_to_seconds(value):
+        return None if value is None else float(value) * 3600
+
+    stages = {name: {"enabled": enabled} for name, enabled in DEFAULT_CACHE_STAGES.items()}
+    for name, stage_conf in cache_config.get("stages", {}).items():
+        stage = stages.setdefault(name, {"enabled": False})
+        stage["enabled"] = bool(stage_conf.get("enabled", stage["enabled"]))
+        if "ttl_hours" in stage_conf:
+            stage["ttl"] = hours_to_seconds(stage_conf["ttl_hours"])
+
+    _llm_cache = LLMResponseCache(
+        cache_dir=cache_config.get("cache_dir", ".llm_cache"),
+        max_bytes=int(float(cache_config.get("max_size_mb", 200)) * 1024 * 1024),
+        default_ttl=hours_to_seconds(cache_config.get("ttl_hours")),
+        stages=stages
+    )
+    logging.info(f"LLM response cache enabled at {_llm_cache.db_path}.")
+    return _llm_cache
+
+def get_llm_cache() -> Optional[LLMResponseCache]:
+    """返回当前启用的全局缓存；未启用时为 None"""
+    return _llm_cache
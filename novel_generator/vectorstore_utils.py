@@ -6,13 +6,10 @@
 import os
 import logging
 import traceback
-import nltk
-import numpy as np
 import re
-import ssl
-import requests
+import hashlib
+import threading
 import warnings
-from langchain_chroma import Chroma
 logging.basicConfig(
     filename='app.log',      # 日志文件名
     filemode='a',            # 追加模式（'w' 会覆盖）
@@ -24,19 +21,123 @@ logging.basicConfig(
 warnings.filterwarnings('ignore', message='.*Torch was not compiled with flash attention.*')
 os.environ["TOKENIZERS_PARALLELISM"] = "false"  # 禁用tokenizer并行警告
 
-from chromadb.config import Settings
-from langchain.docstore.document import Document
-from sklearn.metrics.pairwise import cosine_similarity
-from .common import call_with_retry
+# nltk、chromadb、langchain 等依赖较重，在首次使用向量库时才在函数内导入
+from .common import RetryPolicy, is_retryable_error
+from embedding_adapters import EmbeddingBatchError
+import cancellation
+from token_budget import truncate_to_tokens
+from utils import read_file
+
+# 旧版本写入、没有来源元数据的片段，打开向量库时标记为此来源
+LEGACY_SOURCE = "legacy"
+# 分页读取/更新 collection 时每页的条数
+_COLLECTION_PAGE_SIZE = 1000
 
 def get_vectorstore_dir(filepath: str) -> str:
     """获取 vectorstore 路径"""
     return os.path.join(filepath, "vectorstore")
 
+def _embed_batch(embed_func, texts):
+    """
+    调用一次 embed_func（如 embed_documents），返回 (按条的结果, 异常)；失败、空向量或条数对不上的条目记为 None。
+    部分批次失败（EmbeddingBatchError）时保留成功的条目，异常取原始错误，便于判断能否重试。
+    """
+    try:
+        vectors = embed_func(texts)
+    except EmbeddingBatchError as e:
+        logging.warning(f"Embedding batch of {len(texts)} texts partially failed: {e}")
+        vectors = e.vectors if len(e.vectors) == len(texts) else [None] * len(texts)
+        return [list(v) if v else None for v in vectors], e.cause
+    except Exception as e:
+        logging.warning(f"Embedding batch of {len(texts)} texts failed: {e}")
+        return [None] * len(texts), e
+    if vectors is None or len(vectors) != len(texts):
+        logging.warning(f"Embedding returned {0 if vectors is None else len(vectors)} vectors for {len(texts)} texts, discarding batch.")
+        return [None] * len(texts), None
+    return [list(v) if v is not None and len(v) else None for v in vectors], None
+
+def _embed_queries(embedding_adapter, queries):
+    """一次请求 embedding 全部查询；整批失败的条目再逐条用 embed_query 重试一次"""
+    vectors, _ = _embed_batch(embedding_adapter.embed_queries, queries)
+    for i, vector in enumerate(vectors):
+        if vector is None:
+            try:
+                vectors[i] = list(embedding_adapter.embed_query(queries[i])) or None
+            except Exception as e:
+                logging.warning(f"Embedding query '{queries[i]}' failed: {e}")
+    return vectors
+
+def embed_documents_per_item(embedding_adapter, texts, max_retries: int = 3, sleep_time: float = 2):
+    """
+    按条报告成败的 embedding：返回与 texts 等长的列表，失败的条目为 None。
+    重试时只重新请求失败的条目，且每轮把它们拆成更小的批次，使个别坏条目不会连累整批反复失败。
+    遇到不可重试的错误（如鉴权失败）时不再重试。
+    """
+    results = [None] * len(texts)
+    pending = [i for i, text in enumerate(texts) if text and str(text).strip()]
+    policy = RetryPolicy(max_retries=max_retries, base_delay=sleep_time)
+    for attempt in range(1, max_retries + 1):
+        groups = 2 ** (attempt - 1)
+        size = max(1, -(-len(pending) // groups))
+        last_error = None
+        for start in range(0, len(pending), size):
+            group = pending[start:start + size]
+            vectors, error = _embed_batch(embedding_adapter.embed_documents, [texts[i] for i in group])
+            last_error = error or last_error
+            for index, vector in zip(group, vectors):
+                results[index] = vector
+        pending = [i for i in pending if results[i] is None]
+        if not pending:
+            break
+        if attempt == max_retries or (last_error is not None and not is_retryable_error(last_error)):
+            break
+        logging.info(f"[embedding] Retrying {len(pending)} failed texts (attempt {attempt + 1}/{max_retries}).")
+        cancellation.sleep(policy.delay(attempt, last_error))
+    if pending:
+        logging.warning(f"{len(pending)} of {len(texts)} texts failed to embed and will not be stored.")
+    return results
+
+def _embed_query_with_retry(embedding_adapter, query: str, max_retries: int = 3):
+    """embedding 单个查询，按错误类型重试；最终失败时抛出异常，而不是返回会令检索静默失效的空向量"""
+    policy = RetryPolicy(max_retries=max_retries)
+    for attempt in range(1, max_retries + 1):
+        try:
+            vector = embedding_adapter.embed_query(text=query)
+            if vector is not None and len(vector):
+                return list(vector)
+            error = ValueError("Embedding API returned an empty vector for the query.")
+        except Exception as e:
+            error = e
+        logging.warning(f"Embedding query attempt {attempt} failed: {error}")
+        if not policy.should_retry(error, attempt):
+            raise error
+        cancellation.sleep(policy.delay(attempt, error))
+
+def _lc_embeddings(embedding_adapter):
+    """把 embedding 适配器包装为 LangChain 的 Embeddings，供 Chroma 使用"""
+    from langchain.embeddings.base import Embeddings as LCEmbeddings
+
+    class LCEmbeddingWrapper(LCEmbeddings):
+        # 固定为打开句柄时的适配器；检索由调用方用自己的适配器计算查询向量，不经过这里
+        adapter = embedding_adapter
+
+        def embed_documents(self, texts):
+            vectors = embed_documents_per_item(self.adapter, texts)
+            if any(v is None for v in vectors):
+                # Chroma 要求每条文本都有向量，宁可整体失败也不写入缺失或错位的向量
+                raise ValueError(f"{sum(v is None for v in vectors)} of {len(texts)} texts failed to embed.")
+            return vectors
+        def embed_query(self, query: str):
+            return _embed_query_with_retry(self.adapter, query)
+
+    return LCEmbeddingWrapper()
+
 def clear_vector_store(filepath: str) -> bool:
     """清空 清空向量库"""
     import shutil
     store_dir = get_vectorstore_dir(filepath)
+    # 先关闭缓存的句柄，否则 Windows 上 Chroma 占用的文件无法删除
+    _store_manager.invalidate(filepath)
     if not os.path.exists(store_dir):
         logging.info("No vector store found to clear.")
         return False
@@ -52,86 +153,149 @@ def clear_vector_store(filepath: str) -> bool:
 def init_vector_store(embedding_adapter, texts, filepath: str):
     """
     在 filepath 下创建/加载一个 Chroma 向量库并插入 texts。
-    如果Embedding失败，则返回 None，不中断任务。
+    只插入 embedding 成功的文本；全部失败则返回 None，不中断任务。
     """
-    from langchain.embeddings.base import Embeddings as LCEmbeddings
-
-    store_dir = get_vectorstore_dir(filepath)
-    os.makedirs(store_dir, exist_ok=True)
-    documents = [Document(page_content=str(t)) for t in texts]
-
     try:
-        class LCEmbeddingWrapper(LCEmbeddings):
-            def embed_documents(self, texts):
-                return call_with_retry(
-                    func=embedding_adapter.embed_documents,
-                    max_retries=3,
-                    fallback_return=[],
-                    texts=texts
-                )
-            def embed_query(self, query: str):
-                res = call_with_retry(
-                    func=embedding_adapter.embed_query,
-                    max_retries=3,
-                    fallback_return=[],
-                    query=query
-                )
-                return res
-
-        chroma_embedding = LCEmbeddingWrapper()
-        vectorstore = Chroma.from_documents(
-            documents,
-            embedding=chroma_embedding,
-            persist_directory=store_dir,
-            client_settings=Settings(anonymized_telemetry=False),
-            collection_name="novel_collection"
-        )
-        return vectorstore
+        if not add_texts_to_vector_store(embedding_adapter, texts, filepath):
+            return None
+        return load_vector_store(embedding_adapter, filepath)
     except Exception as e:
         logging.warning(f"Init vector store failed: {e}")
         traceback.print_exc()
         return None
 
+def _open_vector_store(embedding_adapter, filepath: str):
+    """打开 filepath 下的 Chroma 向量库"""
+    from langchain_chroma import Chroma
+    from chromadb.config import Settings
+    return Chroma(
+        persist_directory=get_vectorstore_dir(filepath),
+        embedding_function=_lc_embeddings(embedding_adapter),
+        client_settings=Settings(anonymized_telemetry=False),
+        collection_name="novel_collection"
+    )
+
+
+class VectorStoreManager:
+    """
+    按 (项目路径, embedding 配置) 缓存已打开的 Chroma 向量库，检索时不再每次重新打开数据库。
+    UI 线程与后台生成线程共用；clear_vector_store 删除目录前调用 invalidate 关闭对应句柄。
+    全局锁只保护缓存表，打开与元数据回填在各自 key 的锁内进行，打开一个项目不阻塞其他项目的检索。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stores = {}
+        self._loading = {}
+        self._generations = {}
+
+    @staticmethod
+    def _key(embedding_adapter, filepath: str) -> tuple:
+        store_dir = os.path.abspath(get_vectorstore_dir(filepath))
+        provider = getattr(embedding_adapter, "provider_key", None) or (
+            type(embedding_adapter).__name__, getattr(embedding_adapter, "model_name", "")
+        )
+        return store_dir, provider
+
+    def _cached(self, key: tuple):
+        store = self._stores.get(key)
+        return store if store is not None and os.path.exists(key[0]) else None
+
+    def get(self, embedding_adapter, filepath: str, create: bool = False):
+        """返回缓存的向量库；未打开过则打开（create 为 True 时目录不存在也新建），不存在或打开失败返回 None"""
+        key = self._key(embedding_adapter, filepath)
+        with self._lock:
+            store = self._cached(key)
+            if store is not None:
+                return store
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        # 同一 key 只打开一次，后到的线程等待后直接取缓存
+        with key_lock:
+            with self._lock:
+                store = self._cached(key)
+                generation = self._generations.get(key[0], 0)
+            if store is not None:
+                return store
+            if not os.path.exists(key[0]):
+                if not create:
+                    logging.info("Vector store not found. Will return None.")
+                    return None
+                os.makedirs(key[0], exist_ok=True)
+            try:
+                store = _open_vector_store(embedding_adapter, filepath)
+            except Exception as e:
+                logging.warning(f"Failed to load vector store: {e}")
+                traceback.print_exc()
+                return None
+            # 每个句柄打开时检查一次，之后的检索不再额外查询
+            try:
+                _backfill_segment_metadata(store)
+            except Exception as e:
+                logging.warning(f"Failed to tag legacy vector store segments: {e}")
+            with self._lock:
+                # 打开期间被 invalidate（如清空向量库）则不缓存这个句柄
+                if self._generations.get(key[0], 0) == generation:
+                    self._stores[key] = store
+            return store
+
+    def invalidate(self, filepath: str):
+        """丢弃该项目的所有缓存句柄，并清除 chromadb 内部按路径缓存的客户端"""
+        store_dir = os.path.abspath(get_vectorstore_dir(filepath))
+        with self._lock:
+            self._generations[store_dir] = self._generations.get(store_dir, 0) + 1
+            for key in [k for k in self._stores if k[0] == store_dir]:
+                del self._stores[key]
+        try:
+            from chromadb.api.client import SharedSystemClient
+            SharedSystemClient.clear_system_cache()
+        except Exception as e:
+            logging.warning(f"Failed to clear chromadb client cache: {e}")
+
+
+_store_manager = VectorStoreManager()
+
+def get_vector_store_manager() -> VectorStoreManager:
+    return _store_manager
+
 def load_vector_store(embedding_adapter, filepath: str):
     """
-    读取已存在的 Chroma 向量库。若不存在则返回 None。
+    读取已存在的 Chroma 向量库（经 VectorStoreManager 缓存）。若不存在则返回 None。
     如果加载失败（embedding 或IO问题），则返回 None。
     """
-    from langchain.embeddings.base import Embeddings as LCEmbeddings
-    store_dir = get_vectorstore_dir(filepath)
-    if not os.path.exists(store_dir):
-        logging.info("Vector store not found. Will return None.")
-        return None
+    return _store_manager.get(embedding_adapter, filepath)
 
-    try:
-        class LCEmbeddingWrapper(LCEmbeddings):
-            def embed_documents(self, texts):
-                return call_with_retry(
-                    func=embedding_adapter.embed_documents,
-                    max_retries=3,
-                    fallback_return=[],
-                    texts=texts
-                )
-            def embed_query(self, query: str):
-                res = call_with_retry(
-                    func=embedding_adapter.embed_query,
-                    max_retries=3,
-                    fallback_return=[],
-                    query=query
-                )
-                return res
-
-        chroma_embedding = LCEmbeddingWrapper()
-        return Chroma(
-            persist_directory=store_dir,
-            embedding_function=chroma_embedding,
-            client_settings=Settings(anonymized_telemetry=False),
-            collection_name="novel_collection"
+def add_texts_to_vector_store(embedding_adapter, texts, filepath: str, metadatas: list = None, ids: list = None) -> int:
+    """
+    并发 embedding texts，并按完成顺序逐批写入向量库（不存在则新建），返回成功写入的条数。
+    用于大文件导入：墙钟时间随并发数缩短，内存中只保留在途批次的向量。
+    embedding 失败的条目不写入。metadatas 与 texts 一一对应（见 chapter_metadata / knowledge_metadata）；
+    ids 为确定性的片段 id（见 segment_id），相同 id 再次写入时覆盖而不是重复添加，不传则随机生成。
+    """
+    import uuid
+    from embedding_adapters import iter_embedding_batches
+    store = _store_manager.get(embedding_adapter, filepath, create=True)
+    if not store:
+        return 0
+
+    def embed(batch):
+        return embed_documents_per_item(embedding_adapter, batch)
+
+    added = 0
+    for start, batch, vectors in iter_embedding_batches(embedding_adapter, [str(t) for t in texts], embed_func=embed):
+        kept = [i for i, vector in enumerate(vectors or []) if vector]
+        if len(kept) < len(batch):
+            logging.warning(f"{len(batch) - len(kept)} segments starting at #{start} failed to embed, skipped.")
+        if not kept:
+            continue
+        # 向量已算好，直接写入底层 collection，避免 add_texts 再次 embedding
+        store._collection.upsert(
+            ids=[ids[start + i] for i in kept] if ids else [str(uuid.uuid4()) for _ in kept],
+            embeddings=[vectors[i] for i in kept],
+            documents=[batch[i] for i in kept],
+            metadatas=[metadatas[start + i] for i in kept] if metadatas else None
         )
-    except Exception as e:
-        logging.warning(f"Failed to load vector store: {e}")
-        traceback.print_exc()
-        return None
+        added += len(kept)
+        logging.info(f"Vector store: {added}/{len(texts)} segments written.")
+    return added
 
 def split_by_length(text: str, max_length: int = 500):
     """按照 max_length 切分文本"""
@@ -151,7 +315,8 @@ def split_text_for_vectorstore(chapter_text: str, max_length: int = 500, similar
     """
     if not chapter_text.strip():
         return []
-    
+
+    import nltk
     # nltk.download('punkt', quiet=True)
     # nltk.download('punkt_tab', quiet=True)
     sentences = nltk.sent_tokenize(chapter_text)
@@ -179,40 +344,217 @@ def split_text_for_vectorstore(chapter_text: str, max_length: int = 500, similar
     
     return final_segments
 
-def update_vector_store(embedding_adapter, new_chapter: str, filepath: str):
+def chapter_metadata(chapter_number: int = None, segment: int = 0) -> dict:
+    """章节片段的元数据：来源、章节号、段序号"""
+    metadata = {"source": "chapter", "segment": segment}
+    if chapter_number is not None:
+        metadata["chapter"] = int(chapter_number)
+    return metadata
+
+def knowledge_metadata(knowledge_id: str, source_file: str, segment: int = 0) -> dict:
+    """知识库片段的元数据：来源、知识文件 id 与文件名、段序号"""
+    return {"source": "knowledge", "knowledge_id": knowledge_id, "source_file": source_file, "segment": segment}
+
+def segment_id(prefix: str, segment: int, text: str) -> str:
+    """由 来源前缀、段序号、内容哈希 组成的确定性片段 id，如 chapter-12-3-<hash>"""
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+    return f"{prefix}-{segment}-{digest}"
+
+def _chapter_where(chapter_number: int) -> dict:
+    return {"$and": [{"source": "chapter"}, {"chapter": int(chapter_number)}]}
+
+def build_retrieval_filter(current_chapter: int = None, exclude_recent: int = 0, source: str = None):
+    """
+    构造检索时的 Chroma where 条件：
+    - source 为 "chapter" 或 "knowledge" 时只检索该来源（如只查知识库）
+    - 给定 current_chapter 与 exclude_recent 时排除第 current_chapter - exclude_recent 章及之后的章节片段
+    旧版本写入的片段（source 为 legacy）无法判断来源与章节，始终保留。无条件时返回 None。
+    """
+    conditions = []
+    if source:
+        conditions.append({"source": {"$in": [source, LEGACY_SOURCE]}})
+    if current_chapter is not None and exclude_recent > 0 and source != "knowledge":
+        conditions.append({"$or": [
+            {"source": {"$in": ["knowledge", LEGACY_SOURCE]}},
+            {"chapter": {"$lt": int(current_chapter) - exclude_recent}}
+        ]})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+def _backfill_segment_metadata(store) -> int:
+    """
+    旧版本写入的片段没有来源元数据，按元数据过滤会把它们全部排除；
+    逐页找出这些片段并补上 source=legacy，返回补写的条数。升级后新旧片段混存的向量库也能正确过滤。
     """
-    将最新章节文本插入到向量库中。
+    collection = store._collection
+    tagged = 0
+    offset = 0
+    while True:
+        page = collection.get(limit=_COLLECTION_PAGE_SIZE, offset=offset, include=["metadatas"])
+        ids = page.get("ids") or []
+        if not ids:
+            break
+        legacy = [(doc_id, dict(m or {})) for doc_id, m in zip(ids, page.get("metadatas") or []) if not m or "source" not in m]
+        if legacy:
+            collection.update(
+                ids=[doc_id for doc_id, _ in legacy],
+                metadatas=[{**m, "source": LEGACY_SOURCE} for _, m in legacy]
+            )
+            tagged += len(legacy)
+        offset += len(ids)
+    if tagged:
+        logging.info(f"Vector store: tagged {tagged} segments without metadata as '{LEGACY_SOURCE}'.")
+    return tagged
+
+def update_vector_store(embedding_adapter, new_chapter: str, filepath: str, chapter_number: int = None):
+    """
+    将最新章节文本插入到向量库中，每段带上章节号与段序号元数据。
+    给定 chapter_number 时替换该章已有的片段（重复定稿不会重复写入）。
     若库不存在则初始化；若初始化/更新失败，则跳过。
     """
-    from utils import read_file, clear_file_content, save_string_to_txt
     splitted_texts = split_text_for_vectorstore(new_chapter)
     if not splitted_texts:
         logging.warning("No valid text to insert into vector store. Skipping.")
         return
 
-    store = load_vector_store(embedding_adapter, filepath)
-    if not store:
-        logging.info("Vector store does not exist or failed to load. Initializing a new one for new chapter...")
-        store = init_vector_store(embedding_adapter, splitted_texts, filepath)
-        if not store:
-            logging.warning("Init vector store failed, skip embedding.")
-        else:
-            logging.info("New vector store created successfully.")
-        return
-
     try:
-        docs = [Document(page_content=str(t)) for t in splitted_texts]
-        store.add_documents(docs)
-        logging.info("Vector store updated with the new chapter splitted segments.")
+        if chapter_number is not None:
+            replace_chapter_segments(embedding_adapter, splitted_texts, filepath, chapter_number)
+            return
+        metadatas = [chapter_metadata(None, i) for i in range(len(splitted_texts))]
+        added = add_texts_to_vector_store(embedding_adapter, splitted_texts, filepath, metadatas)
+        if added:
+            logging.info(f"Vector store updated with {added}/{len(splitted_texts)} new chapter segments.")
+        else:
+            logging.warning("Failed to embed the new chapter, skip updating vector store.")
     except Exception as e:
         logging.warning(f"Failed to update vector store: {e}")
         traceback.print_exc()
 
-def get_relevant_context_from_vector_store(embedding_adapter, query: str, filepath: str, k: int = 2) -> str:
+def replace_chapter_segments(embedding_adapter, texts: list, filepath: str, chapter_number: int) -> bool:
+    """
+    用 texts 替换第 chapter_number 章在向量库中的片段：
+    内容未变的片段（id 相同）保留不再 embedding，新片段写入后再删除旧片段，检索期间该章不会缺失。
+    有片段 embedding 失败时保留旧片段并返回 False。
+    """
+    store = _store_manager.get(embedding_adapter, filepath, create=True)
+    if not store:
+        return False
+    ids = [segment_id(f"chapter-{chapter_number}", i, text) for i, text in enumerate(texts)]
+    existing = set(store._collection.get(where=_chapter_where(chapter_number), include=[])["ids"])
+    missing = [i for i, doc_id in enumerate(ids) if doc_id not in existing]
+    if missing:
+        added = add_texts_to_vector_store(
+            embedding_adapter,
+            [texts[i] for i in missing],
+            filepath,
+            [chapter_metadata(chapter_number, i) for i in missing],
+            [ids[i] for i in missing]
+        )
+        if added < len(missing):
+            logging.warning(f"Only {added}/{len(missing)} new segments of chapter {chapter_number} were embedded, keeping old segments.")
+            return False
+    stale = list(existing - set(ids))
+    if stale:
+        store._collection.delete(ids=stale)
+    logging.info(f"Vector store: chapter {chapter_number} now has {len(ids)} segments ({len(missing)} new, {len(stale)} removed).")
+    return True
+
+def _iter_collection(collection, where: dict = None, include: list = None):
+    """分页读取 collection，逐页产出 get 的结果"""
+    offset = 0
+    while True:
+        page = collection.get(where=where, limit=_COLLECTION_PAGE_SIZE, offset=offset, include=include or [])
+        ids = page.get("ids") or []
+        if not ids:
+            return
+        yield page
+        offset += len(ids)
+
+def _match_legacy_segments(collection, segments: dict) -> dict:
+    """segments 为 {片段文本: 元数据}；返回内容与之逐字相同的 legacy 片段 {id: 元数据}"""
+    matched = {}
+    for page in _iter_collection(collection, where={"source": LEGACY_SOURCE}, include=["documents"]):
+        for doc_id, document in zip(page["ids"], page.get("documents") or []):
+            if document in segments:
+                matched[doc_id] = segments[document]
+    return matched
+
+def delete_chapter_from_vector_store(embedding_adapter, filepath: str, chapter_number: int, chapter_text: str = None) -> int:
+    """
+    删除第 chapter_number 章的全部片段，返回删除的条数。
+    传入 chapter_text（删除前的章节正文）时，内容与该章分段逐字相同的 legacy 片段一并删除。
+    """
+    store = load_vector_store(embedding_adapter, filepath)
+    if not store:
+        return 0
+    collection = store._collection
+    stale = list(collection.get(where=_chapter_where(chapter_number), include=[])["ids"])
+    if chapter_text:
+        segments = {text: None for text in split_text_for_vectorstore(chapter_text)}
+        stale.extend(_match_legacy_segments(collection, segments))
+    if stale:
+        collection.delete(ids=stale)
+        logging.info(f"Vector store: removed {len(stale)} segments of deleted chapter {chapter_number}.")
+    return len(stale)
+
+def prune_deleted_chapters(embedding_adapter, filepath: str) -> list:
+    """移除 chapters 目录下已不存在对应 chapter_N.txt 的章节片段，返回被移除的章节号"""
+    store = load_vector_store(embedding_adapter, filepath)
+    if not store:
+        return []
+    stored = set()
+    for page in _iter_collection(store._collection, where={"source": "chapter"}, include=["metadatas"]):
+        stored.update(m["chapter"] for m in page.get("metadatas") or [] if m and "chapter" in m)
+    chapters_dir = os.path.join(filepath, "chapters")
+    removed = [n for n in sorted(stored) if not os.path.exists(os.path.join(chapters_dir, f"chapter_{n}.txt"))]
+    for chapter_number in removed:
+        delete_chapter_from_vector_store(embedding_adapter, filepath, chapter_number)
+    return removed
+
+def sync_chapters_with_vector_store(embedding_adapter, filepath: str) -> dict:
+    """
+    使向量库与 chapters 目录一致：
+    1. legacy 片段（旧版本写入、随机 id）中与现有章节分段逐字相同的，补上章节号与段序号，
+       之后重新定稿或删除该章时随之替换/删除，不再与新片段重复；
+    2. 移除章节文件已被删除的章节片段。
+    无法归属到任何章节的 legacy 片段（旧的知识库导入或之后改动过的章节）保留，数量计入返回值的 "legacy"，
+    需要时清空向量库后重新导入。
+    """
+    result = {"tagged": 0, "removed_chapters": [], "legacy": 0}
+    store = load_vector_store(embedding_adapter, filepath)
+    if not store:
+        return result
+    collection = store._collection
+
+    chapters_dir = os.path.join(filepath, "chapters")
+    segments = {}
+    for name in (os.listdir(chapters_dir) if os.path.isdir(chapters_dir) else []):
+        number = name[len("chapter_"):-len(".txt")]
+        if not (name.startswith("chapter_") and name.endswith(".txt") and number.isdigit()):
+            continue
+        for i, text in enumerate(split_text_for_vectorstore(read_file(os.path.join(chapters_dir, name)))):
+            segments.setdefault(text, chapter_metadata(int(number), i))
+    matched = list(_match_legacy_segments(collection, segments).items())
+    for start in range(0, len(matched), _COLLECTION_PAGE_SIZE):
+        batch = matched[start:start + _COLLECTION_PAGE_SIZE]
+        collection.update(ids=[doc_id for doc_id, _ in batch], metadatas=[m for _, m in batch])
+    result["tagged"] = len(matched)
+
+    result["removed_chapters"] = prune_deleted_chapters(embedding_adapter, filepath)
+    result["legacy"] = sum(len(page["ids"]) for page in _iter_collection(collection, where={"source": LEGACY_SOURCE}))
+    logging.info(
+        f"Vector store synced with chapters: {result['tagged']} legacy segments attributed, "
+        f"chapters removed {result['removed_chapters']}, {result['legacy']} legacy segments left."
+    )
+    return result
+
+def get_relevant_context_from_vector_store(embedding_adapter, query: str, filepath: str, k: int = 2, max_tokens: int = 1500) -> str:
     """
     从向量库中检索与 query 最相关的 k 条文本，拼接后返回。
     如果向量库加载/检索失败，则返回空字符串。
-    最终只返回最多2000字符的检索片段。
+    最终只返回最多 max_tokens 个 token 的检索片段。
     """
     store = load_vector_store(embedding_adapter, filepath)
     if not store:
@@ -220,31 +562,67 @@ def get_relevant_context_from_vector_store(embedding_adapter, query: str, filepa
         return ""
 
     try:
-        docs = store.similarity_search(query, k=k)
+        # 用调用方的适配器计算查询向量，而不是缓存句柄里打开时的适配器
+        docs = store.similarity_search_by_vector(_embed_query_with_retry(embedding_adapter, query), k=k)
         if not docs:
             logging.info(f"No relevant documents found for query '{query}'. Returning empty context.")
             return ""
         combined = "\n".join([d.page_content for d in docs])
-        if len(combined) > 2000:
-            combined = combined[:2000]
-        return combined
+        return truncate_to_tokens(combined, max_tokens)
     except Exception as e:
         logging.warning(f"Similarity search failed: {e}")
         traceback.print_exc()
         return ""
 
-def _get_sentence_transformer(model_name: str = 'paraphrase-MiniLM-L6-v2'):
-    """获取sentence transformer模型，处理SSL问题"""
+def get_relevant_hits_for_queries(embedding_adapter, queries: list, filepath: str, k: int = 2, where: dict = None) -> list:
+    """
+    批量检索：一次 embedding 全部查询，再以一次 collection.query 取回每个查询的前 k 条，
+    按片段 id 去重（同一片段只归入最先命中它的查询）。返回与 queries 等长的列表，
+    每项为 [(片段文本, 元数据), ...]，无结果或检索失败的查询为空列表。
+    where 为元数据过滤条件（见 build_retrieval_filter），被排除的片段不占用 top-k 名额。
+    """
+    hits = [[] for _ in queries]
+    if not queries:
+        return hits
+    store = load_vector_store(embedding_adapter, filepath)
+    if not store:
+        logging.info("No vector store found or load failed. Returning empty context.")
+        return hits
+
     try:
-        # 设置torch环境变量
-        os.environ["TORCH_ALLOW_TF32_CUBLAS_OVERRIDE"] = "0"
-        os.environ["TORCH_CUDNN_V8_API_ENABLED"] = "0"
-        
-        # 禁用SSL验证
-        ssl._create_default_https_context = ssl._create_unverified_context
-        
-        # ...existing code...
+        vectors = _embed_queries(embedding_adapter, queries)
+        valid = [i for i, vector in enumerate(vectors) if vector]
+        if not valid:
+            return hits
+        n_results = min(k, store._collection.count())
+        if n_results <= 0:
+            return hits
+        result = store._collection.query(
+            query_embeddings=[vectors[i] for i in valid],
+            n_results=n_results,
+            where=where,
+            include=["documents", "metadatas"]
+        )
+        seen = set()
+        for index, ids, documents, metadatas in zip(valid, result["ids"], result["documents"], result["metadatas"]):
+            for doc_id, document, metadata in zip(ids, documents, metadatas):
+                if doc_id in seen or not document:
+                    continue
+                seen.add(doc_id)
+                hits[index].append((document, metadata or {}))
+        return hits
     except Exception as e:
-        logging.error(f"Failed to load sentence transformer model: {e}")
+        logging.warning(f"Batched similarity search failed: {e}")
         traceback.print_exc()
-        return None
+        return hits
+
+def get_relevant_contexts_for_queries(embedding_adapter, queries: list, filepath: str, k: int = 2, max_tokens: int = 1500, where: dict = None) -> list:
+    """
+    同 get_relevant_hits_for_queries，但每个查询的片段拼接为一个字符串，最多 max_tokens 个 token；
+    无结果或检索失败的查询为空字符串。
+    """
+    hits = get_relevant_hits_for_queries(embedding_adapter, queries, filepath, k=k, where=where)
+    return [
+        truncate_to_tokens("\n".join(document for document, _ in query_hits), max_tokens) if query_hits else ""
+        for query_hits in hits
+    ]
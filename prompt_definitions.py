@@ -489,6 +489,13 @@ update_character_state_prompt = """\
 
 # =============== 8. 章节正文写作 ===================
 
+# 后续章节草稿提示按稳定程度分为三部分（见 prompt_layout）：
+#   *_static_prompt   所有章节相同的写作规则
+#   *_context_prompt  随定稿缓慢变化的摘要/角色状态
+#   *_chapter_prompt  每章不同的内容
+# 稳定部分放在最前面，使同一章的重试、续写与重新生成共享相同前缀，命中供应商的上下文缓存。
+# 第一章草稿每部小说只生成一次，没有可跨章节共享的前缀，保持原有的单一模板。
+
 # 8.1 第一章草稿提示
 first_chapter_draft_prompt = """\
 即将创作：第 {novel_number} 章《{chapter_title}》
@@ -538,20 +545,52 @@ first_chapter_draft_prompt = """\
 """
 
 # 8.2 后续章节草稿提示
-next_chapter_draft_prompt = """\
+next_chapter_draft_static_prompt = """\
+🎯 知识库应用规则：
+1. 内容分级：
+   - 写作技法类（优先）：
+     ▸ 场景构建模板
+     ▸ 对话写作技巧
+     ▸ 悬念营造手法
+   - 设定资料类（选择性）：
+     ▸ 独特世界观元素
+     ▸ 未使用过的技术细节
+   - 禁忌项类（必须规避）：
+     ▸ 已在前文出现过的特定情节
+     ▸ 重复的人物关系发展
+
+2. 使用限制：
+   ● 禁止直接复制已有章节的情节模式
+   ● 历史章节内容仅允许：
+     → 参照叙事节奏（不超过20%相似度）
+     → 延续必要的人物反应模式（需改编30%以上）
+   ● 第三方写作知识优先用于：
+     → 增强场景表现力（占知识应用的60%以上）
+     → 创新悬念设计（至少1处新技巧）
+
+3. 冲突检测：
+   ⚠️ 若检测到与历史章节重复：
+     - 相似度>40%：必须重构叙事角度
+     - 相似度20-40%：替换至少3个关键要素
+     - 相似度<20%：允许保留核心概念但改变表现形式
+"""
+
+next_chapter_draft_context_prompt = """\
 参考文档：
 └── 前文摘要：
     {global_summary}
 
+└── 角色状态：
+    {character_state}
+"""
+
+next_chapter_draft_chapter_prompt = """\
 └── 前章结尾段：
     {previous_chapter_excerpt}
 
 └── 用户指导：
     {user_guidance}
 
-└── 角色状态：
-    {character_state}
-
 └── 当前章节摘要：
     {short_summary}
 
@@ -581,34 +620,6 @@ next_chapter_draft_prompt = """\
 知识库参考：（按优先级应用）
 {filtered_context}
 
-🎯 知识库应用规则：
-1. 内容分级：
-   - 写作技法类（优先）：
-     ▸ 场景构建模板
-     ▸ 对话写作技巧
-     ▸ 悬念营造手法
-   - 设定资料类（选择性）：
-     ▸ 独特世界观元素
-     ▸ 未使用过的技术细节
-   - 禁忌项类（必须规避）：
-     ▸ 已在前文出现过的特定情节
-     ▸ 重复的人物关系发展
-
-2. 使用限制：
-   ● 禁止直接复制已有章节的情节模式
-   ● 历史章节内容仅允许：
-     → 参照叙事节奏（不超过20%相似度）
-     → 延续必要的人物反应模式（需改编30%以上）
-   ● 第三方写作知识优先用于：
-     → 增强场景表现力（占知识应用的60%以上）
-     → 创新悬念设计（至少1处新技巧）
-
-3. 冲突检测：
-   ⚠️ 若检测到与历史章节重复：
-     - 相似度>40%：必须重构叙事角度
-     - 相似度20-40%：替换至少3个关键要素
-     - 相似度<20%：允许保留核心概念但改变表现形式
-
 依据前面所有设定，开始完成第 {novel_number} 章的正文，字数要求{word_number}字，
 内容生成严格遵循：
 -用户指导
@@ -623,6 +634,20 @@ next_chapter_draft_prompt = """\
 - 不要使用markdown格式。
 """
 
+# 草稿因输出长度上限被截断时的续写提示词，接在原章节提示词之后发送（原提示词可命中前缀缓存）
+chapter_continuation_prompt = """\
+上面要求的章节正文因长度限制被截断，目前已写约{written_chars}字，目标为{word_number}字。
+已写正文的结尾如下：
+<<已写结尾开始>>
+{previous_tail}
+<<已写结尾结束>>
+
+请从上述结尾中断处的下一个字开始继续写作：
+- 不要重复已写内容，不要添加标题、说明或总结；
+- 还需约{remaining_chars}字，保持人物、情节与文风一致，并按章节信息自然收束本章；
+- 仅返回续写的正文文本，不要使用markdown格式。
+"""
+
 Character_Import_Prompt = """\
 根据以下文本内容，分析出所有角色及其属性信息，严格按照以下格式要求：
 
@@ -0,0 +1,54 @@
+# prompt_layout.py
+# -*- coding: utf-8 -*-
+"""
+面向供应商前缀缓存（DeepSeek / OpenAI 等的自动上下文缓存）的提示词排布：
+按稳定程度把提示词分块，越稳定的块越靠前，使多次请求共享尽可能长的相同前缀。
+- STATIC：所有章节都相同的规则说明
+- NOVEL：随定稿缓慢变化的内容（前文摘要、角色状态）
+- CHAPTER：每章都不同的内容（章节信息、前章结尾、检索结果等）
+固定规则本身只有几百 token，低于 OpenAI 等供应商 1024 token 的缓存下限；
+加上前文摘要与角色状态后，同一章的重试、对冲请求、续写与重新生成之间才有足够长的相同前缀。
+"""
+from typing import List, Optional
+
+STATIC = 0
+NOVEL = 1
+CHAPTER = 2
+
+
+class LayeredPrompt(str):
+    """
+    分层排布后的提示词，本身就是完整的提示词字符串；
+    额外记录稳定前缀（STATIC + NOVEL 层）的内容，用于估算可命中缓存的 token 数。
+    """
+    def __new__(cls, sections: list, separator: str = "\n\n"):
+        ordered = sorted(
+            ((stability, text) for stability, text in sections if text),
+            key=lambda item: item[0]
+        )
+        full_text = separator.join(text for _, text in ordered)
+        obj = super().__new__(cls, full_text)
+        stable = [text for stability, text in ordered if stability < CHAPTER]
+        obj.prefix = separator.join(stable) + (separator if stable else "")
+        return obj
+
+
+def layered_prompt(*sections, separator: str = "\n\n") -> LayeredPrompt:
+    """
+    组合提示词：sections 为 (稳定程度, 文本) 元组，按稳定程度排序（同级保持原顺序）后拼接。
+    例：layered_prompt((CHAPTER, chapter_part), (STATIC, rules), (NOVEL, summary))
+    """
+    return LayeredPrompt(list(sections), separator)
+
+
+def build_chat_messages(prompt: str, system_prompt: Optional[str] = None) -> List[dict]:
+    """
+    构造 OpenAI 兼容接口的 messages：固定的系统提示在前，提示词整体作为一条用户消息。
+    分层提示词也不拆成多条消息——前缀缓存只要求请求开头逐字相同，
+    而连续的同角色消息、system 角色在部分模型上并不被支持。
+    """
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": str(prompt)})
+    return messages
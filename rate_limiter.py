@@ -0,0 +1,167 @@
+# rate_limiter.py
+# -*- coding: utf-8 -*-
+"""
+按 LLM 配置（接口格式 + base_url + 模型）共享的本地限流器：
+令牌桶限制每分钟请求数（rpm）与每分钟 token 数（tpm），信号量限制同时在途请求数（max_concurrency）。
+并记录本地排队等待时间，用于区分"被本地限流"与"被服务端限流"。
+"""
+import re
+import time
+import logging
+import threading
+from typing import Optional
+
+import cancellation
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符约 1 token/字，其余约 4 字符/token"""
+    if not text:
+        return 0
+    cjk = len(re.findall(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]', text))
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+class TokenBucket:
+    """容量为 capacity、每秒补充 rate 个令牌的令牌桶"""
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_take(self, amount: float, now: float) -> float:
+        """尝试取出 amount 个令牌；成功返回 0，否则返回还需等待的秒数（不扣减）"""
+        self._refill(now)
+        # 单次请求超过桶容量时按满桶计，避免永远等不到
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class ProviderRateLimiter:
+    """单个 LLM 配置的限流器，rpm / tpm / max_concurrency 为空或 0 表示不限制"""
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None, max_concurrency: Optional[int] = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self._request_bucket = TokenBucket(rpm, rpm / 60.0) if rpm else None
+        self._token_bucket = TokenBucket(tpm, tpm / 60.0) if tpm else None
+        self._semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "throttled": 0,
+            "in_flight": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "last_wait_seconds": 0.0
+        }
+
+    def _wait_for_buckets(self, tokens: int):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait_req = self._request_bucket.try_take(1, now) if self._request_bucket else 0.0
+                if wait_req == 0.0:
+                    wait_tok = self._token_bucket.try_take(tokens, now) if self._token_bucket else 0.0
+                    if wait_tok == 0.0:
+                        return
+                    # token 桶不够时退还已取出的请求令牌
+                    if self._request_bucket:
+                        self._request_bucket.tokens += 1
+                    delay = wait_tok
+                else:
+                    delay = wait_req
+            cancellation.sleep(min(delay, 1.0))
+
+    def acquire(self, tokens: int = 0) -> float:
+        """阻塞直到允许发出请求，返回本地排队等待的秒数；排队期间生成被取消时抛出 OperationCancelled"""
+        start = time.monotonic()
+        if self._semaphore:
+            while not self._semaphore.acquire(timeout=0.5):
+                cancellation.check_cancelled()
+        try:
+            self._wait_for_buckets(tokens)
+        except BaseException:
+            if self._semaphore:
+                self._semaphore.release()
+            raise
+        waited = time.monotonic() - start
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["in_flight"] += 1
+            self._stats["total_wait_seconds"] += waited
+            self._stats["last_wait_seconds"] = waited
+            self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], waited)
+            if waited > 0.05:
+                self._stats["throttled"] += 1
+        if waited > 1.0:
+            logging.info(f"[rate_limiter] Request queued locally for {waited:.2f}s.")
+        return waited
+
+    def record_completion(self, tokens: int):
+        """
+        调用结束后把输出 token 计入 tpm 令牌桶：排队时只能按提示词预估，不补记则 tpm 被低估。
+        桶最多扣到负的一个容量，之后的请求相应多等待。
+        """
+        if not self._token_bucket or tokens <= 0:
+            return
+        with self._lock:
+            bucket = self._token_bucket
+            bucket._refill(time.monotonic())
+            bucket.tokens = max(-bucket.capacity, bucket.tokens - tokens)
+
+    def release(self):
+        with self._lock:
+            self._stats["in_flight"] -= 1
+        if self._semaphore:
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["avg_wait_seconds"] = stats["total_wait_seconds"] / stats["requests"] if stats["requests"] else 0.0
+        return stats
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def rate_limit_key(interface_format: str, base_url: str, model_name: str) -> tuple:
+    return (interface_format.strip().lower(), (base_url or "").strip(), model_name)
+
+def configure_rate_limits(llm_configs: dict):
+    """
+    根据 config.json 的 llm_configs 为每个配置建立限流器。
+    每个配置可选填 rpm、tpm、max_concurrency，均未填写则该配置不限流。
+    """
+    limiters = {}
+    for name, conf in (llm_configs or {}).items():
+        rpm = conf.get("rpm")
+        tpm = conf.get("tpm")
+        max_concurrency = conf.get("max_concurrency")
+        if not (rpm or tpm or max_concurrency):
+            continue
+        key = rate_limit_key(conf.get("interface_format", ""), conf.get("base_url", ""), conf.get("model_name", ""))
+        limiters[key] = ProviderRateLimiter(rpm=rpm, tpm=tpm, max_concurrency=max_concurrency)
+        logging.info(f"Rate limit for '{name}': rpm={rpm}, tpm={tpm}, max_concurrency={max_concurrency}")
+    with _limiters_lock:
+        _limiters.clear()
+        _limiters.update(limiters)
+
+def get_rate_limiter(interface_format: str, base_url: str, model_name: str) -> Optional[ProviderRateLimiter]:
+    with _limiters_lock:
+        return _limiters.get(rate_limit_key(interface_format, base_url, model_name))
+
+def get_rate_limiter_stats() -> dict:
+    """返回各配置限流器的统计：请求数、本地排队次数、在途数、排队等待时间等"""
+    with _limiters_lock:
+        items = list(_limiters.items())
+    return {"|".join(str(part) for part in key): limiter.stats() for key, limiter in items}
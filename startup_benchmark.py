@@ -0,0 +1,113 @@
+# startup_benchmark.py
+# -*- coding: utf-8 -*-
+"""
+启动耗时基准：在全新的子进程中以 python -X importtime 导入入口模块，
+报告冷启动耗时，以及按顶层包汇总的导入耗时和耗时最多的模块。
+同时检查供应商 SDK / 向量库依赖是否在启动阶段被提前导入。
+
+用法：
+    python startup_benchmark.py                 # 导入 ui（窗口出现前的全部导入）
+    python startup_benchmark.py --window        # 额外创建并销毁主窗口（需要图形环境）
+    python startup_benchmark.py --runs 5 --max-seconds 3.0
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# 这些依赖应在首次使用对应适配器或向量库时才导入
+LAZY_PACKAGES = (
+    "langchain_openai", "openai", "google.generativeai", "azure.ai.inference",
+    "langchain_chroma", "chromadb", "nltk", "sklearn", "langchain_community"
+)
+
+_IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def _startup_code(module: str, window: bool) -> str:
+    if not window:
+        return f"import {module}"
+    return (
+        "import customtkinter as ctk\n"
+        "from ui import NovelGeneratorGUI\n"
+        "app = ctk.CTk()\n"
+        "NovelGeneratorGUI(app)\n"
+        "app.update()\n"
+        "app.destroy()\n"
+    )
+
+
+def run_once(module: str, window: bool):
+    """在新进程中执行一次启动，返回 (耗时秒数, importtime 行列表)"""
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _startup_code(module, window)],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        tail = "\n".join(proc.stderr.strip().splitlines()[-10:])
+        raise RuntimeError(f"Startup failed (exit {proc.returncode}):\n{tail}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((int(self_us), int(cumulative_us), len(indent) // 2, name))
+    return elapsed, rows
+
+
+def summarize_packages(rows: list) -> list:
+    """按顶层包汇总各模块自身的导入耗时（微秒），从高到低排序"""
+    totals = {}
+    for self_us, _, _, name in rows:
+        package = name.split(".")[0]
+        totals[package] = totals.get(package, 0) + self_us
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI_NovelGenerator 启动耗时基准")
+    parser.add_argument("--module", default="ui", help="要导入的入口模块，默认 ui")
+    parser.add_argument("--window", action="store_true", help="额外创建并销毁主窗口")
+    parser.add_argument("--runs", type=int, default=3, help="重复次数，取中位数")
+    parser.add_argument("--top", type=int, default=15, help="列出耗时最多的前 N 项")
+    parser.add_argument("--max-seconds", type=float, default=None, help="冷启动中位耗时超过该值时以非零状态退出")
+    args = parser.parse_args()
+
+    timings = []
+    rows = []
+    for _ in range(max(1, args.runs)):
+        elapsed, rows = run_once(args.module, args.window)
+        timings.append(elapsed)
+    median = statistics.median(timings)
+
+    print(f"冷启动耗时（{len(timings)} 次中位数）: {median:.3f}s  "
+          f"[min {min(timings):.3f}s, max {max(timings):.3f}s]")
+    print(f"导入模块数: {len(rows)}")
+
+    print(f"\n按顶层包汇总的导入耗时（前 {args.top}）:")
+    for package, self_us in summarize_packages(rows)[:args.top]:
+        print(f"  {self_us / 1000:9.1f} ms  {package}")
+
+    print(f"\n累计导入耗时最多的模块（前 {args.top}）:")
+    for self_us, cumulative_us, depth, name in sorted(rows, key=lambda row: row[1], reverse=True)[:args.top]:
+        print(f"  {cumulative_us / 1000:9.1f} ms  (self {self_us / 1000:7.1f} ms)  {name}")
+
+    imported = {name for _, _, _, name in rows}
+    eager = [pkg for pkg in LAZY_PACKAGES if pkg in imported]
+    if eager:
+        print(f"\n警告：以下依赖在启动时被导入，应改为按需导入: {', '.join(eager)}")
+
+    if args.max_seconds is not None and median > args.max_seconds:
+        print(f"\n冷启动耗时 {median:.3f}s 超过阈值 {args.max_seconds:.3f}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# tests/conftest.py
+# -*- coding: utf-8 -*-
+"""
+测试共用的夹具：基于模拟后端（mock_backend，interface_format 为 "mock"）的适配器，不发出网络请求。
+"""
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_backend import configure_mock_backend
+from llm_adapters import MockAdapter
+
+
+class CountingMockAdapter(MockAdapter):
+    """记录上游调用次数的模拟适配器"""
+    def __init__(self, base_url: str = "mock://test", model_name: str = "mock", max_tokens: int = 0):
+        super().__init__("", base_url, model_name, max_tokens)
+        self.calls = 0
+        self._calls_lock = threading.Lock()
+
+    def _count(self):
+        with self._calls_lock:
+            self.calls += 1
+
+    def invoke(self, prompt: str) -> str:
+        self._count()
+        return super().invoke(prompt)
+
+    def invoke_stream(self, prompt: str):
+        self._count()
+        yield from super().invoke_stream(prompt)
+
+
+@pytest.fixture
+def mock_backend():
+    """按测试需要配置模拟后端参数，结束后恢复默认值；返回配置函数"""
+    def configure(**options):
+        defaults = {"latency": 0.0, "tokens_per_second": 0, "error_rate": 0.0, "response_chars": 40}
+        defaults.update(options)
+        configure_mock_backend(defaults)
+    configure()
+    yield configure
+    configure_mock_backend(None)
+
+
+@pytest.fixture
+def counting_adapter(mock_backend):
+    """返回创建 CountingMockAdapter 的函数"""
+    return CountingMockAdapter
@@ -0,0 +1,101 @@
+# tests/test_cancellation.py
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+
+import pytest
+
+from cancellation import CancellationToken, DeadlineExceeded, OperationCancelled, cancellation_scope
+from conftest import CountingMockAdapter
+from llm_adapters import CancellableAdapter, RateLimitedAdapter
+from rate_limiter import configure_rate_limits, get_rate_limiter
+
+
+def _cancel_after(token: CancellationToken, seconds: float):
+    threading.Timer(seconds, token.cancel).start()
+
+
+def test_token_cancels_children_and_runs_callbacks():
+    parent = CancellationToken()
+    child = CancellationToken(parent=parent)
+    called = []
+    child.add_callback(lambda: called.append(True))
+    parent.cancel()
+    assert child.cancelled and called == [True]
+    # 已取消的令牌上注册回调时立即调用
+    child.add_callback(lambda: called.append(True))
+    assert called == [True, True]
+
+
+def test_child_inherits_parent_deadline():
+    parent = CancellationToken(deadline=0.1)
+    child = CancellationToken(parent=parent)
+    time.sleep(0.15)
+    with pytest.raises(DeadlineExceeded):
+        child.check()
+
+
+def test_cancelled_invoke_returns_immediately_and_interrupts_the_call(mock_backend):
+    mock_backend(latency=5.0)
+    adapter = CancellableAdapter(CountingMockAdapter(base_url="mock://cancel-invoke"))
+    token = CancellationToken()
+    _cancel_after(token, 0.2)
+
+    start = time.monotonic()
+    with cancellation_scope(token):
+        with pytest.raises(OperationCancelled):
+            adapter.invoke("取消的请求")
+    assert time.monotonic() - start < 1.0
+
+    # 被中断的请求不影响之后的调用
+    mock_backend(latency=0.0)
+    assert adapter.invoke("下一个请求")
+
+
+def test_deadline_ends_stream(mock_backend):
+    mock_backend(latency=0.0, tokens_per_second=100, response_chars=400)
+    adapter = CancellableAdapter(CountingMockAdapter(base_url="mock://cancel-stream"))
+    chunks = []
+
+    start = time.monotonic()
+    with cancellation_scope(CancellationToken(deadline=0.3)):
+        with pytest.raises(DeadlineExceeded):
+            for chunk in adapter.invoke_stream("超时的流式请求"):
+                chunks.append(chunk)
+    assert time.monotonic() - start < 1.0
+    assert chunks
+
+
+def test_cancel_releases_limiter_slot_at_once(mock_backend):
+    mock_backend(latency=5.0)
+    configure_rate_limits({"mock": {"interface_format": "mock", "base_url": "mock://cancel-slot", "model_name": "mock", "max_concurrency": 1}})
+    try:
+        adapter = CancellableAdapter(RateLimitedAdapter(
+            CountingMockAdapter(base_url="mock://cancel-slot"), "mock", "mock://cancel-slot", "mock"
+        ))
+        limiter = get_rate_limiter("mock", "mock://cancel-slot", "mock")
+        token = CancellationToken()
+        _cancel_after(token, 0.2)
+        with cancellation_scope(token):
+            with pytest.raises(OperationCancelled):
+                adapter.invoke("占用名额的请求")
+        assert limiter.stats()["in_flight"] == 0
+    finally:
+        configure_rate_limits({})
+
+
+def test_async_invoke_is_cancelled(mock_backend):
+    mock_backend(latency=5.0)
+    adapter = CancellableAdapter(CountingMockAdapter(base_url="mock://cancel-async"))
+
+    async def run():
+        token = CancellationToken()
+        asyncio.get_running_loop().call_later(0.2, token.cancel)
+        with cancellation_scope(token):
+            await adapter.ainvoke("异步取消")
+
+    start = time.monotonic()
+    with pytest.raises((OperationCancelled, asyncio.CancelledError)):
+        asyncio.run(run())
+    assert time.monotonic() - start < 1.0
@@ -0,0 +1,69 @@
+# tests/test_continuation.py
+# -*- coding: utf-8 -*-
+import pytest
+
+pytest.importorskip("requests")
+
+from conftest import CountingMockAdapter
+from novel_generator.chapter import MAX_CONTINUATIONS, _continue_truncated_draft
+from novel_generator.common import invoke_with_cleaning, merge_continuation
+
+
+def test_overlap_with_written_tail_is_removed():
+    text = "夜色渐深，他推开了那扇门。"
+    continuation = "他推开了那扇门。屋里一片寂静。"
+    assert merge_continuation(text, continuation) == "屋里一片寂静。"
+
+
+def test_continuation_without_overlap_is_kept_whole():
+    assert merge_continuation("第一段结束。", "第二段开始。") == "第二段开始。"
+
+
+def test_overlap_shorter_than_min_overlap_is_ignored():
+    # 只重叠一个 "。"，视为巧合，不去掉
+    assert merge_continuation("他停下了。", "。然后离开", min_overlap=2) == "。然后离开"
+    assert merge_continuation("他停下了。", "停下了。然后离开", min_overlap=2) == "然后离开"
+
+
+def test_overlap_longer_than_max_overlap_is_not_searched():
+    text = "甲乙丙丁戊己庚辛"
+    continuation = "甲乙丙丁戊己庚辛壬癸"
+    assert merge_continuation(text, continuation, max_overlap=4, min_overlap=2) == continuation
+    assert merge_continuation(text, continuation, max_overlap=8, min_overlap=2) == "壬癸"
+
+
+def test_truncated_draft_is_continued_until_target(mock_backend):
+    mock_backend(response_chars=600)
+    adapter = CountingMockAdapter(base_url="mock://continuation", max_tokens=150)
+    prompt = "请写本章正文，字数要求：600字"
+
+    draft = invoke_with_cleaning(adapter, prompt, stage="draft")
+    assert 0 < len(draft) < 600
+
+    result = _continue_truncated_draft(adapter, prompt, draft, 600)
+    assert result.startswith(draft)
+    assert len(result) > len(draft)
+    assert adapter.calls <= 1 + MAX_CONTINUATIONS
+
+
+def test_complete_draft_is_not_continued(mock_backend):
+    mock_backend(response_chars=100)
+    adapter = CountingMockAdapter(base_url="mock://continuation-complete")
+    prompt = "请写本章正文，字数要求：600字"
+
+    draft = invoke_with_cleaning(adapter, prompt, stage="draft")
+    # 输出正常结束（finish_reason 为 stop），即使不足目标字数也不续写
+    assert _continue_truncated_draft(adapter, prompt, draft, 600) == draft
+    assert adapter.calls == 1
+
+
+def test_streamed_continuation_matches_merged_draft(mock_backend):
+    mock_backend(response_chars=600)
+    adapter = CountingMockAdapter(base_url="mock://continuation-stream", max_tokens=150)
+    prompt = "请写本章正文，字数要求：600字"
+
+    draft = invoke_with_cleaning(adapter, prompt, stage="draft")
+    chunks = [draft]
+    result = _continue_truncated_draft(adapter, prompt, draft, 600, on_chunk=chunks.append)
+    # 界面收到的内容与拼接后的草稿一致，重叠部分没有重复输出
+    assert "".join(chunks) == result
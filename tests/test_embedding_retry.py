@@ -0,0 +1,90 @@
+# tests/test_embedding_retry.py
+# -*- coding: utf-8 -*-
+import pytest
+
+pytest.importorskip("requests")
+
+from embedding_adapters import EmbeddingBatchError, MockEmbeddingAdapter
+from mock_backend import MockBackendError
+from novel_generator.vectorstore_utils import embed_documents_per_item
+
+
+class AuthError(Exception):
+    status_code = 401
+
+
+class FlakyEmbeddingAdapter(MockEmbeddingAdapter):
+    """
+    含 "坏" 字的文本所在批次整批失败（bad_attempts 次后恢复，None 表示一直失败）；
+    记录每次请求的文本，用于检查只重试失败的条目。
+    """
+    def __init__(self, bad_attempts=None, error=MockBackendError):
+        super().__init__("mock-embedding")
+        self.bad_attempts = bad_attempts
+        self.error = error
+        self.requests = []
+
+    def embed_documents(self, texts):
+        self.requests.append(list(texts))
+        failing = self.bad_attempts is None or len(self.requests) <= self.bad_attempts
+        if failing and any("坏" in text for text in texts):
+            raise self.error("injected")
+        return super().embed_documents(texts)
+
+
+class PartialBatchAdapter(MockEmbeddingAdapter):
+    """第一次请求时含 "坏" 字的条目失败，以 EmbeddingBatchError 返回其余条目的向量"""
+    def __init__(self):
+        super().__init__("mock-embedding")
+        self.requests = []
+
+    def embed_documents(self, texts):
+        self.requests.append(list(texts))
+        vectors = super().embed_documents(texts)
+        if len(self.requests) == 1:
+            vectors = [[] if "坏" in text else vector for text, vector in zip(texts, vectors)]
+            raise EmbeddingBatchError(vectors, MockBackendError("injected"))
+        return vectors
+
+
+def test_bad_item_does_not_sink_the_batch(mock_backend):
+    texts = [f"片段{i}" for i in range(7)] + ["坏片段"]
+    adapter = FlakyEmbeddingAdapter()
+
+    results = embed_documents_per_item(adapter, texts, sleep_time=0)
+    assert results[-1] is None
+    assert all(results[:-1])
+
+
+def test_transient_failure_recovers_on_retry(mock_backend):
+    texts = ["片段甲", "坏片段", "片段乙"]
+    adapter = FlakyEmbeddingAdapter(bad_attempts=1)
+
+    results = embed_documents_per_item(adapter, texts, sleep_time=0)
+    assert all(results)
+    assert len(adapter.requests) > 1
+
+
+def test_only_failed_items_are_requested_again(mock_backend):
+    texts = ["片段甲", "坏片段", "片段乙"]
+    adapter = PartialBatchAdapter()
+
+    results = embed_documents_per_item(adapter, texts, sleep_time=0)
+    assert all(results)
+    assert adapter.requests[1:] == [["坏片段"]]
+
+
+def test_fatal_error_is_not_retried(mock_backend):
+    adapter = FlakyEmbeddingAdapter(error=AuthError)
+
+    results = embed_documents_per_item(adapter, ["坏片段"], sleep_time=0)
+    assert results == [None]
+    assert len(adapter.requests) == 1
+
+
+def test_blank_texts_are_skipped(mock_backend):
+    adapter = FlakyEmbeddingAdapter()
+
+    results = embed_documents_per_item(adapter, ["片段", "", "   "], sleep_time=0)
+    assert results[0] and results[1:] == [None, None]
+    assert adapter.requests == [["片段"]]
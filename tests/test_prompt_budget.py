@@ -0,0 +1,64 @@
+# tests/test_prompt_budget.py
+# -*- coding: utf-8 -*-
+from token_budget import PromptBudget, count_tokens, truncate_to_tokens
+
+TEXT = "夜色渐深，城中的灯火一盏盏熄灭，只剩巡夜人的脚步声回荡在长街上。" * 20
+
+
+def _tokens(text: str) -> int:
+    return count_tokens(text)
+
+
+def test_sections_within_budget_are_untouched():
+    budget = PromptBudget(10000)
+    budget.add("summary", TEXT, priority=1).add("setting", TEXT, priority=2)
+    result = budget.fit()
+    assert result == {"summary": TEXT, "setting": TEXT}
+    assert budget.cuts == []
+
+
+def test_quota_caps_section_even_when_budget_allows():
+    budget = PromptBudget(10000)
+    budget.add("summary", TEXT, priority=1, quota=50)
+    result = budget.fit()
+    assert _tokens(result["summary"]) <= 50
+    assert budget.cuts == [{"section": "summary", "original_tokens": _tokens(TEXT), "kept_tokens": 50}]
+
+
+def test_lowest_priority_is_trimmed_first():
+    total = _tokens(TEXT)
+    budget = PromptBudget(total + 100)
+    budget.add("important", TEXT, priority=3).add("minor", TEXT, priority=1)
+    result = budget.fit()
+    assert result["important"] == TEXT
+    assert _tokens(result["minor"]) <= 100
+    assert [cut["section"] for cut in budget.cuts] == ["minor"]
+
+
+def test_floor_is_kept_and_next_section_is_trimmed():
+    total = _tokens(TEXT)
+    budget = PromptBudget(total)
+    budget.add("important", TEXT, priority=3).add("minor", TEXT, priority=1, floor=80)
+    result = budget.fit()
+    # 低优先级片段只压缩到保底，剩余的超出量由更高优先级的片段承担
+    assert budget.cuts == [
+        {"section": "important", "original_tokens": total, "kept_tokens": total - 80},
+        {"section": "minor", "original_tokens": total, "kept_tokens": 80}
+    ]
+    assert _tokens(result["important"]) + _tokens(result["minor"]) <= total
+
+
+def test_floors_are_never_cut_even_when_over_budget():
+    budget = PromptBudget(10)
+    budget.add("a", TEXT, priority=1, floor=40).add("b", TEXT, priority=2, floor=60)
+    budget.fit()
+    assert {cut["section"]: cut["kept_tokens"] for cut in budget.cuts} == {"a": 40, "b": 60}
+
+
+def test_keep_tail_preserves_the_end():
+    text = "开头的内容。" * 50 + "最新的结尾"
+    budget = PromptBudget(10)
+    budget.add("recent", text, priority=1, keep="tail")
+    result = budget.fit()
+    assert result["recent"].endswith("最新的结尾")
+    assert result["recent"] == truncate_to_tokens(text, 10, keep="tail")
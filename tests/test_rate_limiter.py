@@ -0,0 +1,93 @@
+# tests/test_rate_limiter.py
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+from cancellation import CancellationToken, DeadlineExceeded, cancellation_scope
+from conftest import CountingMockAdapter
+from llm_adapters import RateLimitedAdapter
+from rate_limiter import ProviderRateLimiter, TokenBucket, configure_rate_limits, estimate_tokens, get_rate_limiter
+
+
+@pytest.fixture
+def rate_limits():
+    """按 llm_configs 配置限流，结束后清除"""
+    yield configure_rate_limits
+    configure_rate_limits({})
+
+
+def test_token_bucket_reports_wait_without_taking():
+    bucket = TokenBucket(capacity=10, rate=1.0)
+    now = bucket.updated_at
+    assert bucket.try_take(8, now) == 0.0
+    assert bucket.try_take(5, now) == pytest.approx(3.0)
+    # 等待期间没有扣减，补足后可以取出
+    assert bucket.try_take(5, now + 3.0) == 0.0
+
+
+def test_token_bucket_caps_oversized_requests_at_capacity():
+    bucket = TokenBucket(capacity=10, rate=1.0)
+    assert bucket.try_take(50, bucket.updated_at) == 0.0
+    assert bucket.tokens == 0
+
+
+def test_rpm_throttles_until_deadline():
+    limiter = ProviderRateLimiter(rpm=2)
+    limiter.acquire()
+    limiter.release()
+    limiter.acquire()
+    limiter.release()
+    # 第三个请求要等约 30 秒才有令牌，截止时间先到
+    with cancellation_scope(CancellationToken(deadline=0.3)):
+        with pytest.raises(DeadlineExceeded):
+            limiter.acquire()
+    assert limiter.stats()["in_flight"] == 0
+
+
+def test_completion_tokens_count_against_tpm():
+    limiter = ProviderRateLimiter(tpm=1000)
+    limiter.acquire(100)
+    limiter.release()
+    limiter.record_completion(2000)
+    # 输出 token 补记后桶被扣到负的一个容量，下一个请求需要排队
+    assert limiter._token_bucket.tokens == pytest.approx(-1000, abs=1)
+    with cancellation_scope(CancellationToken(deadline=0.3)):
+        with pytest.raises(DeadlineExceeded):
+            limiter.acquire(10)
+
+
+def test_max_concurrency_limits_in_flight_requests():
+    limiter = ProviderRateLimiter(max_concurrency=1)
+    limiter.acquire()
+    acquired = threading.Event()
+
+    def second():
+        limiter.acquire()
+        acquired.set()
+        limiter.release()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not acquired.wait(0.3)
+    limiter.release()
+    assert acquired.wait(2.0)
+    thread.join()
+
+
+def test_rate_limited_adapter_records_prompt_and_completion_tokens(mock_backend, rate_limits):
+    mock_backend(response_chars=300)
+    rate_limits({"mock": {"interface_format": "mock", "base_url": "mock://limited", "model_name": "mock", "tpm": 100000}})
+    adapter = RateLimitedAdapter(CountingMockAdapter(base_url="mock://limited"), "mock", "mock://limited", "mock")
+    limiter = get_rate_limiter("mock", "mock://limited", "mock")
+    # 停止补充令牌，使扣除量可以精确比较
+    limiter._token_bucket.rate = 0.0
+
+    prompt = "限流测试提示词"
+    result = adapter.invoke(prompt)
+    used = limiter._token_bucket.capacity - limiter._token_bucket.tokens
+    # 排队时扣除提示词估算，结束后补记输出
+    assert used == estimate_tokens(prompt) + estimate_tokens(result)
+    assert limiter.stats()["requests"] == 1
+    assert limiter.stats()["in_flight"] == 0
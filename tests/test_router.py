@@ -0,0 +1,116 @@
+# tests/test_router.py
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+import pytest
+
+from conftest import CountingMockAdapter
+from llm_adapters import CancellableAdapter, RouterAdapter
+from mock_backend import MockBackendError
+
+
+class FailingMockAdapter(CountingMockAdapter):
+    """每次调用都返回 503 的端点"""
+    def invoke(self, prompt: str) -> str:
+        self._count()
+        raise MockBackendError("injected")
+
+    def invoke_stream(self, prompt: str):
+        self._count()
+        raise MockBackendError("injected")
+        yield
+
+    async def ainvoke(self, prompt: str) -> str:
+        self._count()
+        raise MockBackendError("injected")
+
+
+class EmptyMockAdapter(CountingMockAdapter):
+    """返回空内容的端点"""
+    def invoke(self, prompt: str) -> str:
+        self._count()
+        return ""
+
+
+class SlowMockAdapter(CountingMockAdapter):
+    """在模拟后端的延迟之外再等待 delay 秒；连接被断开时立即以连接错误结束"""
+    def __init__(self, delay: float, **kwargs):
+        super().__init__(**kwargs)
+        self.delay = delay
+        self.interrupted = False
+
+    def invoke(self, prompt: str) -> str:
+        self._count()
+        try:
+            self._call_client().sleep(self.delay)
+        except ConnectionError:
+            self.interrupted = True
+            raise
+        return super(CountingMockAdapter, self).invoke(prompt)
+
+
+def test_failover_on_error(mock_backend):
+    primary = FailingMockAdapter(base_url="mock://router-error-primary")
+    backup = CountingMockAdapter(base_url="mock://router-error-backup")
+    router = RouterAdapter([("primary", primary), ("backup", backup)])
+
+    assert router.invoke("故障切换")
+    assert router.last_backend == "backup"
+    assert (primary.calls, backup.calls) == (1, 1)
+
+
+def test_failover_on_empty_response(mock_backend):
+    primary = EmptyMockAdapter(base_url="mock://router-empty-primary")
+    backup = CountingMockAdapter(base_url="mock://router-empty-backup")
+    router = RouterAdapter([("primary", primary), ("backup", backup)])
+
+    assert router.invoke("空响应切换")
+    assert router.last_backend == "backup"
+
+
+def test_all_backends_failing_raises_last_error(mock_backend):
+    router = RouterAdapter([
+        ("first", FailingMockAdapter(base_url="mock://router-all-1")),
+        ("second", FailingMockAdapter(base_url="mock://router-all-2"))
+    ])
+    with pytest.raises(MockBackendError):
+        router.invoke("全部失败")
+
+
+def test_hedges_slow_primary_and_cancels_the_loser(mock_backend):
+    primary = SlowMockAdapter(5.0, base_url="mock://router-hedge-primary")
+    backup = CountingMockAdapter(base_url="mock://router-hedge-backup")
+    router = RouterAdapter(
+        [("primary", CancellableAdapter(primary)), ("backup", CancellableAdapter(backup))],
+        initial_hedge_delay=0.2,
+        min_hedge_delay=0.05
+    )
+
+    start = time.monotonic()
+    result = router.invoke("对冲请求")
+    assert time.monotonic() - start < 2.0
+    assert result and router.last_backend == "backup"
+    # 落败的主端点请求被取消，其连接随即断开
+    deadline = time.monotonic() + 2.0
+    while not primary.interrupted and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert primary.interrupted
+
+
+def test_stream_fails_over_before_first_chunk(mock_backend):
+    primary = FailingMockAdapter(base_url="mock://router-stream-primary")
+    backup = CountingMockAdapter(base_url="mock://router-stream-backup")
+    router = RouterAdapter([("primary", primary), ("backup", backup)])
+
+    assert "".join(router.invoke_stream("流式切换"))
+    assert router.last_backend == "backup"
+
+
+def test_async_failover_on_error(mock_backend):
+    primary = FailingMockAdapter(base_url="mock://router-async-primary")
+    backup = CountingMockAdapter(base_url="mock://router-async-backup")
+    router = RouterAdapter([("primary", primary), ("backup", backup)])
+
+    assert asyncio.run(router.ainvoke("异步故障切换"))
+    assert router.last_backend == "backup"
@@ -0,0 +1,85 @@
+# tests/test_single_flight.py
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from cancellation import CancellationToken, OperationCancelled, cancellation_scope
+from llm_adapters import CancellableAdapter, SingleFlightAdapter
+from usage_tracker import track_llm_call
+
+
+def _run_in_threads(*targets):
+    threads = [threading.Thread(target=target) for target in targets]
+    for thread in threads:
+        thread.start()
+        # 保证第一个线程先成为领头者
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join(timeout=10)
+    return threads
+
+
+def test_concurrent_identical_prompts_make_one_upstream_call(mock_backend, counting_adapter):
+    mock_backend(latency=0.3)
+    inner = counting_adapter(base_url="mock://single-flight")
+    adapter = SingleFlightAdapter(inner, ("mock", "mock://single-flight", "mock"))
+    results = []
+
+    def call():
+        results.append(adapter.invoke("同一个提示词"))
+
+    _run_in_threads(call, call)
+    assert inner.calls == 1
+    assert len(results) == 2 and results[0] == results[1] and results[0]
+
+
+def test_different_prompts_are_not_merged(mock_backend, counting_adapter):
+    mock_backend(latency=0.2)
+    inner = counting_adapter(base_url="mock://single-flight-distinct")
+    adapter = SingleFlightAdapter(inner, ("mock", "mock://single-flight-distinct", "mock"))
+
+    _run_in_threads(lambda: adapter.invoke("提示词甲"), lambda: adapter.invoke("提示词乙"))
+    assert inner.calls == 2
+
+
+def test_abandoned_leader_hands_off_to_follower(mock_backend, counting_adapter):
+    mock_backend(latency=0.5)
+    inner = counting_adapter(base_url="mock://single-flight-handoff")
+    adapter = SingleFlightAdapter(CancellableAdapter(inner), ("mock", "mock://single-flight-handoff", "mock"))
+    leader_token = CancellationToken()
+    outcome = {}
+
+    def leader():
+        try:
+            with cancellation_scope(leader_token):
+                adapter.invoke("交接的提示词")
+        except OperationCancelled:
+            outcome["leader"] = "cancelled"
+
+    def follower():
+        outcome["follower"] = adapter.invoke("交接的提示词")
+
+    threading.Timer(0.2, leader_token.cancel).start()
+    _run_in_threads(leader, follower)
+    assert outcome["leader"] == "cancelled"
+    # 领头者被取消后，跟随者自行重新发起请求并拿到结果
+    assert outcome["follower"]
+    assert inner.calls == 2
+
+
+def test_follower_reports_leader_finish_reason(mock_backend, counting_adapter):
+    mock_backend(latency=0.3, response_chars=400)
+    inner = counting_adapter(base_url="mock://single-flight-usage", max_tokens=50)
+    adapter = SingleFlightAdapter(inner, ("mock", "mock://single-flight-usage", "mock"))
+    records = []
+
+    def call():
+        with track_llm_call("draft", "被截断的提示词") as record:
+            adapter.invoke("被截断的提示词")
+        records.append(record)
+
+    _run_in_threads(call, call)
+    assert inner.calls == 1
+    assert [record.finish_reason for record in records] == ["length", "length"]
+    follower = next(record for record in records if record.shared)
+    assert follower.completion_tokens == 0
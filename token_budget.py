@@ -0,0 +1,186 @@
+# token_budget.py
+# -*- coding: utf-8 -*-
+"""
+基于 tokenizer 的提示词预算：
+用 tiktoken 计数与截断（未安装时退回 rate_limiter.estimate_tokens 的估算），
+为提示词的各个片段设定优先级与配额，整体压缩到 模型上下文窗口 - max_tokens 以内，并报告裁剪了哪些内容。
+"""
+import logging
+import threading
+from functools import lru_cache
+from typing import Optional
+
+from rate_limiter import estimate_tokens, rate_limit_key
+
+DEFAULT_CONTEXT_WINDOW = 32768
+# 提示词之外为消息格式、系统提示等预留的 token
+SAFETY_MARGIN = 256
+
+# 按模型名前缀匹配的常见上下文窗口（取最长匹配），可在 llm_configs 中以 context_window 覆盖
+KNOWN_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+    "o1": 200000,
+    "o3": 200000,
+    "o4": 200000,
+    "deepseek": 65536,
+    "gemini": 1048576,
+    "claude": 200000,
+    "grok": 131072,
+    "qwen": 131072,
+    "glm": 128000,
+    "moonshot-v1-8k": 8192,
+    "moonshot-v1-32k": 32768,
+    "moonshot-v1-128k": 131072,
+    "mock": 65536,
+}
+
+_context_windows = {}
+_context_windows_lock = threading.Lock()
+
+def configure_context_windows(llm_configs: dict):
+    """根据 config.json 的 llm_configs 读取可选的 context_window（模型上下文窗口 token 数）"""
+    windows = {}
+    for name, conf in (llm_configs or {}).items():
+        window = conf.get("context_window")
+        if not window:
+            continue
+        key = rate_limit_key(conf.get("interface_format", ""), conf.get("base_url", ""), conf.get("model_name", ""))
+        windows[key] = int(window)
+        logging.info(f"Context window for '{name}': {window}")
+    with _context_windows_lock:
+        _context_windows.clear()
+        _context_windows.update(windows)
+
+def get_context_window(interface_format: str, base_url: str, model_name: str) -> int:
+    """返回该配置的上下文窗口：优先用户配置，其次按模型名匹配，最后使用默认值"""
+    with _context_windows_lock:
+        window = _context_windows.get(rate_limit_key(interface_format or "", base_url, model_name))
+    if window:
+        return window
+    name = (model_name or "").lower().split("/")[-1]
+    matches = [prefix for prefix in KNOWN_CONTEXT_WINDOWS if name.startswith(prefix)]
+    if matches:
+        return KNOWN_CONTEXT_WINDOWS[max(matches, key=len)]
+    return DEFAULT_CONTEXT_WINDOW
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model_name: str):
+    try:
+        import tiktoken
+    except ImportError:
+        logging.warning("tiktoken is not installed, falling back to estimated token counts.")
+        return None
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        # 非 OpenAI 模型没有对应的分词器，用 cl100k_base 近似
+        return tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(text: str, model_name: str = "") -> int:
+    if not text:
+        return 0
+    encoding = _get_encoding(model_name or "")
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text: str, max_tokens: int, keep: str = "head", model_name: str = "") -> str:
+    """把 text 截断到不超过 max_tokens；keep="head" 保留开头，keep="tail" 保留结尾"""
+    if not text or count_tokens(text, model_name) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding(model_name or "")
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        kept = tokens[:max_tokens] if keep == "head" else tokens[-max_tokens:]
+        # 截断处可能切开多字节字符，去掉解码出的替换字符
+        return encoding.decode(kept).strip("\ufffd")
+    # 无分词器时按估算值二分查找保留的字符数
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        part = text[:mid] if keep == "head" else text[len(text) - mid:]
+        if estimate_tokens(part) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] if keep == "head" else text[len(text) - low:]
+
+
+class PromptBudget:
+    """
+    提示词片段预算：
+    每个片段有优先级（数值越大越重要）、配额上限 quota 与保底 floor。
+    fit() 先把各片段截到配额以内；总量仍超出预算时，从优先级最低的片段开始继续压缩（不低于保底），
+    直到放得下为止。返回裁剪后的文本，并在 cuts 中记录每个被裁剪片段的原始与保留 token 数。
+    """
+    def __init__(self, budget: int, model_name: str = ""):
+        self.budget = max(0, budget)
+        self.model_name = model_name
+        self.sections = []
+        self.cuts = []
+
+    def add(self, name: str, text: str, priority: int, quota: Optional[int] = None, floor: int = 0, keep: str = "head"):
+        self.sections.append({
+            "name": name,
+            "text": text or "",
+            "priority": priority,
+            "quota": quota,
+            "floor": floor,
+            "keep": keep
+        })
+        return self
+
+    def fit(self) -> dict:
+        for section in self.sections:
+            section["original"] = count_tokens(section["text"], self.model_name)
+            section["limit"] = section["original"]
+            if section["quota"] is not None:
+                section["limit"] = min(section["limit"], section["quota"])
+
+        overflow = sum(s["limit"] for s in self.sections) - self.budget
+        for section in sorted(self.sections, key=lambda s: s["priority"]):
+            if overflow <= 0:
+                break
+            reducible = max(0, section["limit"] - section["floor"])
+            reduction = min(reducible, overflow)
+            section["limit"] -= reduction
+            overflow -= reduction
+        if overflow > 0:
+            logging.warning(f"[budget] Prompt still exceeds budget of {self.budget} tokens by {overflow} after trimming to floors.")
+
+        result = {}
+        self.cuts = []
+        for section in self.sections:
+            text = section["text"]
+            if section["limit"] < section["original"]:
+                text = truncate_to_tokens(text, section["limit"], section["keep"], self.model_name)
+                self.cuts.append({
+                    "section": section["name"],
+                    "original_tokens": section["original"],
+                    "kept_tokens": section["limit"]
+                })
+            result[section["name"]] = text
+        if self.cuts:
+            details = ", ".join(f"{c['section']} {c['original_tokens']}->{c['kept_tokens']}" for c in self.cuts)
+            logging.info(f"[budget] Trimmed prompt sections to fit {self.budget} tokens: {details}")
+        return result
+
+
+def prompt_budget_for(
+    template_tokens: int,
+    interface_format: str,
+    base_url: str,
+    model_name: str,
+    max_tokens: int
+) -> PromptBudget:
+    """可变片段的预算 = 上下文窗口 - 输出 max_tokens - 模板固定部分 - 预留"""
+    window = get_context_window(interface_format, base_url, model_name)
+    budget = window - (max_tokens or 0) - template_tokens - SAFETY_MARGIN
+    return PromptBudget(budget, model_name)
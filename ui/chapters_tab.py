@@ -1,10 +1,12 @@
 # ui/chapters_tab.py
 # -*- coding: utf-8 -*-
 import os
+import threading
 import customtkinter as ctk
 from tkinter import messagebox
 from ui.context_menu import TextWidgetContextMenu
 from utils import read_file, save_string_to_txt, clear_file_content
+from novel_generator import delete_chapter
 
 def build_chapters_tab(self):
     self.chapters_view_tab = self.tabview.add("章节管理")
@@ -36,6 +38,9 @@ def build_chapters_tab(self):
     refresh_btn = ctk.CTkButton(top_frame, text="刷新章节列表", command=self.refresh_chapters_list, font=("Microsoft YaHei", 12))
     refresh_btn.grid(row=0, column=5, padx=5, pady=5, sticky="e")
 
+    self.btn_delete_chapter = ctk.CTkButton(top_frame, text="删除本章", fg_color="red", command=self.delete_current_chapter, font=("Microsoft YaHei", 12))
+    self.btn_delete_chapter.grid(row=0, column=6, padx=5, pady=5, sticky="e")
+
     self.chapters_word_count_label = ctk.CTkLabel(top_frame, text="字数：0", font=("Microsoft YaHei", 12))
     self.chapters_word_count_label.grid(row=0, column=4, padx=(0,10), sticky="e")
 
@@ -49,7 +54,7 @@ def build_chapters_tab(self):
     self.chapter_view_text.bind("<KeyRelease>", update_word_count)
     self.chapter_view_text.bind("<ButtonRelease>", update_word_count)
     TextWidgetContextMenu(self.chapter_view_text)
-    self.chapter_view_text.grid(row=1, column=0, sticky="nsew", padx=5, pady=5, columnspan=6)
+    self.chapter_view_text.grid(row=1, column=0, sticky="nsew", padx=5, pady=5, columnspan=7)
 
     self.chapters_list = []
     refresh_chapters_list(self)
@@ -111,6 +116,37 @@ def save_current_chapter(self):
     save_string_to_txt(content, chapter_file)
     self.safe_log(f"已保存对第 {chapter_number_str} 章的修改。")
 
+def delete_current_chapter(self):
+    chapter_number_str = self.chapter_select_var.get()
+    if not chapter_number_str:
+        messagebox.showwarning("警告", "尚未选择章节，无法删除。")
+        return
+    filepath = self.filepath_var.get().strip()
+    if not filepath:
+        messagebox.showwarning("警告", "请先配置保存文件路径")
+        return
+    if not messagebox.askyesno("确认", f"确定要删除第 {chapter_number_str} 章吗？章节文件及其在向量库中的片段都将被删除，此操作不可恢复！"):
+        return
+
+    def task():
+        self.disable_button_safe(self.btn_delete_chapter)
+        try:
+            removed = delete_chapter(
+                novel_number=int(chapter_number_str),
+                filepath=filepath,
+                embedding_api_key=self.embedding_api_key_var.get().strip(),
+                embedding_url=self.embedding_url_var.get().strip(),
+                embedding_interface_format=self.embedding_interface_format_var.get().strip(),
+                embedding_model_name=self.embedding_model_name_var.get().strip()
+            )
+            self.safe_log(f"已删除第 {chapter_number_str} 章（向量库中移除 {removed} 个片段）。")
+            self.master.after(0, lambda: refresh_chapters_list(self))
+        except Exception:
+            self.handle_exception(f"删除第 {chapter_number_str} 章时出错")
+        finally:
+            self.enable_button_safe(self.btn_delete_chapter)
+    threading.Thread(target=task, daemon=True).start()
+
 def prev_chapter(self):
     if not self.chapters_list:
         return
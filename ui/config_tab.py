@@ -7,6 +7,10 @@ import datetime
 import customtkinter as ctk
 
 from config_manager import load_config, save_config
+from rate_limiter import configure_rate_limits
+from token_budget import configure_context_windows
+from llm_adapters import configure_llm_routes, configure_stage_llms
+from embedding_adapters import configure_embedding_limits
 from tooltips import tooltips
 
 import os
@@ -199,6 +203,11 @@ def build_ai_config_tab(self):
         # 保存到JSON文件
         try:
             save_config(self.loaded_config, self.config_file)
+            configure_rate_limits(self.loaded_config.get("llm_configs", {}))
+            configure_llm_routes(self.loaded_config.get("llm_configs", {}))
+            configure_stage_llms(self.loaded_config.get("stage_llms", {}), self.loaded_config.get("llm_configs", {}))
+            configure_context_windows(self.loaded_config.get("llm_configs", {}))
+            configure_embedding_limits(self.loaded_config.get("embedding_configs", {}))
             messagebox.showinfo("提示", f"配置 {new_name} 已保存并持久化到文件")
         except Exception as e:
             messagebox.showerror("错误", f"保存配置文件失败: {str(e)}")
@@ -346,7 +355,7 @@ def build_ai_config_tab(self):
     # 3) 接口格式
     create_label_with_help(self, self.ai_config_tab, "接口格式:", "interface_format", row_start+2, 0)
     self.interface_format_var = ctk.StringVar(value="OpenAI")
-    interface_options = ["OpenAI", "Azure OpenAI", "Ollama", "DeepSeek", "Gemini", "ML Studio"]
+    interface_options = ["OpenAI", "Azure OpenAI", "Ollama", "DeepSeek", "Gemini", "ML Studio", "Mock"]
     interface_dropdown = ctk.CTkOptionMenu(
         self.ai_config_tab,
         values=interface_options,
@@ -507,6 +516,9 @@ def build_embeddings_config_tab(self):
             elif new_value == "SiliconFlow":
                 self.embedding_url_var.set("https://api.siliconflow.cn/v1/embeddings")
                 self.embedding_model_name_var.set("BAAI/bge-m3")
+            elif new_value == "Local":
+                self.embedding_url_var.set("")
+                self.embedding_model_name_var.set("sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
 
     for i in range(5):
         self.embeddings_config_tab.grid_rowconfigure(i, weight=0)
@@ -522,7 +534,7 @@ def build_embeddings_config_tab(self):
     # 2) Embedding 接口格式
     create_label_with_help(self, parent=self.embeddings_config_tab, label_text="嵌入接口格式:", tooltip_key="embedding_intexrface_format", row=1, column=0, font=("Microsoft YaHei", 12))
 
-    emb_interface_options = ["DeepSeek", "OpenAI", "Azure OpenAI", "Gemini", "Ollama", "ML Studio","SiliconFlow"]
+    emb_interface_options = ["DeepSeek", "OpenAI", "Azure OpenAI", "Gemini", "Ollama", "ML Studio","SiliconFlow", "Local", "Mock"]
 
     emb_interface_dropdown = ctk.CTkOptionMenu(self.embeddings_config_tab, values=emb_interface_options, variable=self.embedding_interface_format_var, command=on_embedding_interface_changed, font=("Microsoft YaHei", 12))
     emb_interface_dropdown.grid(row=1, column=1, padx=5, pady=5, sticky="nsew")
@@ -15,10 +15,35 @@ from novel_generator import (
     finalize_chapter,
     import_knowledge_file,
     clear_vector_store,
+    sync_chapter_vectors,
     enrich_chapter_text,
     build_chapter_prompt
 )
 from consistency_checker import check_consistency
+from cancellation import CancellationToken, OperationCancelled, DeadlineExceeded
+
+def new_cancel_token(self, parent=None) -> CancellationToken:
+    """创建一次生成任务的取消令牌；config.json 中 chapter_deadline_minutes 大于 0 时作为该任务的整体截止时间"""
+    minutes = float(self.loaded_config.get("chapter_deadline_minutes") or 0)
+    token = CancellationToken(deadline=minutes * 60 if minutes > 0 else None, parent=parent)
+    self.active_cancel_tokens.add(token)
+    return token
+
+def log_cancelled(self, error: OperationCancelled, context: str):
+    if isinstance(error, DeadlineExceeded):
+        self.safe_log(f"⏱ {context}超过截止时间，已中止。")
+    else:
+        self.safe_log(f"⏹ {context}已取消。")
+
+def cancel_generation_ui(self):
+    """取消所有进行中的生成任务：中断正在进行的模型请求并释放工作线程"""
+    tokens = list(self.active_cancel_tokens)
+    if not tokens:
+        self.log("当前没有正在进行的生成任务。")
+        return
+    for token in tokens:
+        token.cancel()
+    self.log("正在停止当前生成任务...")
 
 def generate_novel_architecture_ui(self):
     filepath = self.filepath_var.get().strip()
@@ -130,6 +155,7 @@ def generate_chapter_draft_ui(self):
 
     def task():
         self.disable_button_safe(self.btn_generate_chapter)
+        prompt_token = draft_token = None
         try:
 
             interface_format = self.loaded_config["llm_configs"][self.prompt_draft_llm_var.get()]["interface_format"]
@@ -159,6 +185,7 @@ def generate_chapter_draft_ui(self):
             self.safe_log(f"生成第{chap_num}章草稿：准备生成请求提示词...")
 
             # 调用新添加的 build_chapter_prompt 函数构造初始提示词
+            prompt_token = self.new_cancel_token()
             prompt_text = build_chapter_prompt(
                 api_key=api_key,
                 base_url=base_url,
@@ -179,8 +206,11 @@ def generate_chapter_draft_ui(self):
                 embedding_retrieval_k=embedding_k,
                 interface_format=interface_format,
                 max_tokens=max_tokens,
-                timeout=timeout_val
+                timeout=timeout_val,
+                cancel_token=prompt_token
             )
+            # 截止时间不计入用户编辑提示词的时间，正文生成另用一个令牌
+            self.active_cancel_tokens.discard(prompt_token)
 
             # 弹出可编辑提示词对话框，等待用户确认或取消
             result = {"prompt": None}
@@ -275,7 +305,9 @@ def generate_chapter_draft_ui(self):
                 return
 
             self.safe_log("开始生成章节草稿...")
+            self.master.after(0, lambda: self.show_chapter_in_textbox(""))
             from novel_generator.chapter import generate_chapter_draft
+            draft_token = self.new_cancel_token()
             draft_text = generate_chapter_draft(
                 api_key=api_key,
                 base_url=base_url,
@@ -297,16 +329,22 @@ def generate_chapter_draft_ui(self):
                 interface_format=interface_format,
                 max_tokens=max_tokens,
                 timeout=timeout_val,
-                custom_prompt_text=edited_prompt  # 使用用户编辑后的提示词
+                custom_prompt_text=edited_prompt,  # 使用用户编辑后的提示词
+                stream_callback=lambda chunk: self.master.after(0, lambda: self.append_chapter_in_textbox(chunk)),
+                cancel_token=draft_token
             )
             if draft_text:
                 self.safe_log(f"✅ 第{chap_num}章草稿生成完成。请在左侧查看或编辑。")
                 self.master.after(0, lambda: self.show_chapter_in_textbox(draft_text))
             else:
                 self.safe_log("⚠️ 本章草稿生成失败或无内容。")
+        except OperationCancelled as e:
+            self.log_cancelled(e, "章节草稿生成")
         except Exception:
             self.handle_exception("生成章节草稿时出错")
         finally:
+            self.active_cancel_tokens.discard(prompt_token)
+            self.active_cancel_tokens.discard(draft_token)
             self.enable_button_safe(self.btn_generate_chapter)
     threading.Thread(target=task, daemon=True).start()
 
@@ -322,6 +360,7 @@ def finalize_chapter_ui(self):
             return
 
         self.disable_button_safe(self.btn_finalize_chapter)
+        cancel_token = self.new_cancel_token()
         try:
 
             interface_format = self.loaded_config["llm_configs"][self.final_chapter_llm_var.get()]["interface_format"]
@@ -362,7 +401,8 @@ def finalize_chapter_ui(self):
                         temperature=temperature,
                         interface_format=interface_format,
                         max_tokens=max_tokens,
-                        timeout=timeout_val
+                        timeout=timeout_val,
+                        cancel_token=cancel_token
                     )
                     edited_text = enriched
                     self.master.after(0, lambda: self.chapter_result.delete("0.0", "end"))
@@ -384,15 +424,19 @@ def finalize_chapter_ui(self):
                 embedding_model_name=embedding_model_name,
                 interface_format=interface_format,
                 max_tokens=max_tokens,
-                timeout=timeout_val
+                timeout=timeout_val,
+                cancel_token=cancel_token
             )
             self.safe_log(f"✅ 第{chap_num}章定稿完成（已更新前文摘要、角色状态、向量库）。")
 
             final_text = read_file(chapter_file)
             self.master.after(0, lambda: self.show_chapter_in_textbox(final_text))
+        except OperationCancelled as e:
+            self.log_cancelled(e, "章节定稿")
         except Exception:
             self.handle_exception("定稿章节时出错")
         finally:
+            self.active_cancel_tokens.discard(cancel_token)
             self.enable_button_safe(self.btn_finalize_chapter)
     threading.Thread(target=task, daemon=True).start()
 
@@ -533,7 +577,7 @@ def generate_batch_ui(self):
         dialog.wait_window(dialog)
         return result
     
-    def generate_chapter_batch(self ,i ,word, min, auto_enrich):
+    def generate_chapter_batch(self ,i ,word, min, auto_enrich, cancel_token=None):
         draft_interface_format = self.loaded_config["llm_configs"][self.prompt_draft_llm_var.get()]["interface_format"]
         draft_api_key = self.loaded_config["llm_configs"][self.prompt_draft_llm_var.get()]["api_key"]
         draft_base_url = self.loaded_config["llm_configs"][self.prompt_draft_llm_var.get()]["base_url"]
@@ -575,6 +619,7 @@ def generate_batch_ui(self):
             interface_format=draft_interface_format,
             max_tokens=draft_max_tokens,
             timeout=draft_timeout,
+            cancel_token=cancel_token
         )
         final_prompt = prompt_text
         role_names = [name.strip() for name in self.char_inv_text.get("0.0", "end").split("\n")]
@@ -635,7 +680,8 @@ def generate_batch_ui(self):
             interface_format=draft_interface_format,
             max_tokens=draft_max_tokens,
             timeout=draft_timeout,
-            custom_prompt_text=final_prompt  
+            custom_prompt_text=final_prompt,
+            cancel_token=cancel_token
         )
 
         finalize_interface_format = self.loaded_config["llm_configs"][self.final_chapter_llm_var.get()]["interface_format"]
@@ -660,7 +706,8 @@ def generate_batch_ui(self):
                 temperature=draft_temperature,
                 interface_format=draft_interface_format,
                 max_tokens=draft_max_tokens,
-                timeout=draft_timeout
+                timeout=draft_timeout,
+                cancel_token=cancel_token
             )
             draft_text = enriched
         clear_file_content(chapter_path)
@@ -679,7 +726,8 @@ def generate_batch_ui(self):
             embedding_model_name=embedding_model_name,
             interface_format=finalize_interface_format,
             max_tokens=finalize_max_tokens,
-            timeout=finalize_timeout
+            timeout=finalize_timeout,
+            cancel_token=cancel_token
         )
 
 
@@ -687,8 +735,30 @@ def generate_batch_ui(self):
     if result["close"]:
         return
 
-    for i in range(int(result["start"]), int(result["end"]) + 1):
-        generate_chapter_batch(self, i, int(result["word"]), int(result["min"]), result["auto_enrich"])
+    def task():
+        # 整批共用一个令牌，便于一次停止；每章再派生子令牌，使截止时间按章计算
+        batch_token = CancellationToken()
+        self.active_cancel_tokens.add(batch_token)
+        i = result["start"]
+        try:
+            for i in range(int(result["start"]), int(result["end"]) + 1):
+                chapter_token = self.new_cancel_token(parent=batch_token)
+                try:
+                    generate_chapter_batch(self, i, int(result["word"]), int(result["min"]), result["auto_enrich"], chapter_token)
+                finally:
+                    chapter_token.detach()
+                    self.active_cancel_tokens.discard(chapter_token)
+        except OperationCancelled as e:
+            self.log_cancelled(e, f"批量生成（第{i}章）")
+        except Exception:
+            self.handle_exception("批量生成章节时出错")
+        finally:
+            self.active_cancel_tokens.discard(batch_token)
+            self.enable_button_safe(self.btn_batch_generate)
+
+    # 在界面线程中先禁用按钮，避免同时启动多个批量任务
+    self.disable_button_safe(self.btn_batch_generate)
+    threading.Thread(target=task, daemon=True).start()
 
 
 def import_knowledge_handler(self):
@@ -774,6 +844,33 @@ def clear_vectorstore_handler(self):
             else:
                 self.log(f"未能清空向量库，请关闭程序后手动删除 {filepath} 下的 vectorstore 文件夹。")
 
+def sync_vectorstore_handler(self):
+    """在程序外增删章节文件后，使向量库与 chapters 目录一致"""
+    filepath = self.filepath_var.get().strip()
+    if not filepath:
+        messagebox.showwarning("警告", "请先配置保存文件路径。")
+        return
+
+    def task():
+        self.disable_button_safe(self.btn_sync_vectorstore)
+        try:
+            result = sync_chapter_vectors(
+                filepath=filepath,
+                embedding_api_key=self.embedding_api_key_var.get().strip(),
+                embedding_url=self.embedding_url_var.get().strip(),
+                embedding_interface_format=self.embedding_interface_format_var.get().strip(),
+                embedding_model_name=self.embedding_model_name_var.get().strip()
+            )
+            removed = "、".join(str(n) for n in result["removed_chapters"]) or "无"
+            self.safe_log(f"向量库已同步：移除已删除章节 {removed}，旧版本片段归入章节 {result['tagged']} 个。")
+            if result["legacy"]:
+                self.safe_log(f"仍有 {result['legacy']} 个旧版本片段无法对应到现有章节，如需去除请清空向量库后重新导入与定稿。")
+        except Exception:
+            self.handle_exception("同步向量库时出错")
+        finally:
+            self.enable_button_safe(self.btn_sync_vectorstore)
+    threading.Thread(target=task, daemon=True).start()
+
 def show_plot_arcs_ui(self):
     filepath = self.filepath_var.get().strip()
     if not filepath:
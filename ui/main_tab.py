@@ -54,7 +54,7 @@ def build_left_layout(self):
     # Step 按钮区域
     self.step_buttons_frame = ctk.CTkFrame(self.left_frame)
     self.step_buttons_frame.grid(row=2, column=0, sticky="ew", padx=5, pady=5)
-    self.step_buttons_frame.columnconfigure((0, 1, 2, 3, 4), weight=1)
+    self.step_buttons_frame.columnconfigure((0, 1, 2, 3, 4, 5), weight=1)
 
 
     self.btn_generate_architecture = ctk.CTkButton(
@@ -97,6 +97,14 @@ def build_left_layout(self):
     )
     self.btn_batch_generate.grid(row=0, column=4, padx=5, pady=2, sticky="ew")
 
+    self.btn_stop_generation = ctk.CTkButton(
+        self.step_buttons_frame,
+        text="停止生成",
+        command=self.cancel_generation_ui,
+        font=("Microsoft YaHei", 12)
+    )
+    self.btn_stop_generation.grid(row=0, column=5, padx=5, pady=2, sticky="ew")
+
 
     # 日志文本框
     log_label = ctk.CTkLabel(self.left_frame, text="输出日志 (只读)", font=("Microsoft YaHei", 12))
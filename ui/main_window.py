@@ -8,7 +8,13 @@ import customtkinter as ctk
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from .role_library import RoleLibrary
-from llm_adapters import create_llm_adapter
+from llm_adapters import create_llm_adapter, configure_llm_routes, configure_stage_llms
+from novel_generator.llm_cache import configure_llm_cache
+from embedding_cache import configure_embedding_cache
+from embedding_adapters import configure_embedding_limits
+from rate_limiter import configure_rate_limits
+from token_budget import configure_context_windows
+from mock_backend import configure_mock_backend
 
 from config_manager import load_config, save_config, test_llm_config, test_embedding_config
 from utils import read_file, save_string_to_txt, clear_file_content
@@ -26,14 +32,18 @@ from ui.generation_handlers import (
     do_consistency_check,
     import_knowledge_handler,
     clear_vectorstore_handler,
+    sync_vectorstore_handler,
     show_plot_arcs_ui,
-    generate_batch_ui
+    generate_batch_ui,
+    new_cancel_token,
+    log_cancelled,
+    cancel_generation_ui
 )
 from ui.setting_tab import build_setting_tab, load_novel_architecture, save_novel_architecture
 from ui.directory_tab import build_directory_tab, load_chapter_blueprint, save_chapter_blueprint
 from ui.character_tab import build_character_tab, load_character_state, save_character_state
 from ui.summary_tab import build_summary_tab, load_global_summary, save_global_summary
-from ui.chapters_tab import build_chapters_tab, refresh_chapters_list, on_chapter_selected, load_chapter_content, save_current_chapter, prev_chapter, next_chapter
+from ui.chapters_tab import build_chapters_tab, refresh_chapters_list, on_chapter_selected, load_chapter_content, save_current_chapter, delete_current_chapter, prev_chapter, next_chapter
 from ui.other_settings import build_other_settings_tab
 
 
@@ -54,6 +64,8 @@ class NovelGeneratorGUI:
         # --------------- 配置文件路径 ---------------
         self.config_file = "config.json"
         self.loaded_config = load_config(self.config_file)
+        # 进行中的生成任务的取消令牌，"停止生成"按钮会全部取消
+        self.active_cancel_tokens = set()
 
         if self.loaded_config:
             last_llm = next(iter(self.loaded_config["llm_configs"].values())).get("interface_format", "OpenAI")
@@ -98,6 +110,18 @@ class NovelGeneratorGUI:
             os.environ.pop('HTTP_PROXY', None)  
             os.environ.pop('HTTPS_PROXY', None)
 
+        # LLM 响应缓存（默认关闭）
+        configure_llm_cache(self.loaded_config.get("llm_cache", {}))
+        # Embedding 向量缓存（默认开启），相同文本不重复请求 embedding 接口
+        configure_embedding_cache(self.loaded_config.get("embedding_cache", {}))
+        configure_embedding_limits(self.loaded_config.get("embedding_configs", {}))
+        # 按 llm_configs 中的 rpm / tpm / max_concurrency 建立本地限流
+        configure_rate_limits(self.loaded_config.get("llm_configs", {}))
+        configure_llm_routes(self.loaded_config.get("llm_configs", {}))
+        configure_stage_llms(self.loaded_config.get("stage_llms", {}), self.loaded_config.get("llm_configs", {}))
+        configure_context_windows(self.loaded_config.get("llm_configs", {}))
+        # 接口格式为 Mock 时使用的离线模拟后端参数
+        configure_mock_backend(self.loaded_config.get("mock_backend", {}))
 
 
         # -- LLM通用参数 --
@@ -217,6 +241,14 @@ class NovelGeneratorGUI:
         self.chapter_result.delete("0.0", "end")
         self.chapter_result.insert("0.0", text)
         self.chapter_result.see("end")
+
+    def append_chapter_in_textbox(self, chunk):
+        """流式生成时追加显示；chunk 为 None 表示上一次输出作废，清空重来。"""
+        if chunk is None:
+            self.chapter_result.delete("0.0", "end")
+            return
+        self.chapter_result.insert("end", chunk)
+        self.chapter_result.see("end")
     
     def test_llm_config(self):
         """
@@ -386,8 +418,12 @@ class NovelGeneratorGUI:
     finalize_chapter_ui = finalize_chapter_ui
     do_consistency_check = do_consistency_check
     generate_batch_ui = generate_batch_ui
+    new_cancel_token = new_cancel_token
+    log_cancelled = log_cancelled
+    cancel_generation_ui = cancel_generation_ui
     import_knowledge_handler = import_knowledge_handler
     clear_vectorstore_handler = clear_vectorstore_handler
+    sync_vectorstore_handler = sync_vectorstore_handler
     show_plot_arcs_ui = show_plot_arcs_ui
     load_config_btn = load_config_btn
     save_config_btn = save_config_btn
@@ -402,6 +438,7 @@ class NovelGeneratorGUI:
     refresh_chapters_list = refresh_chapters_list
     on_chapter_selected = on_chapter_selected
     save_current_chapter = save_current_chapter
+    delete_current_chapter = delete_current_chapter
     prev_chapter = prev_chapter
     next_chapter = next_chapter
     test_llm_config = test_llm_config
@@ -134,6 +134,12 @@ def build_optional_buttons_area(self, start_row=2):
     )
     self.role_library_btn.grid(row=0, column=4, padx=5, pady=5, sticky="ew")
 
+    self.btn_sync_vectorstore = ctk.CTkButton(
+        self.optional_btn_frame, text="同步向量库", command=self.sync_vectorstore_handler,
+        font=("Microsoft YaHei", 12), width=100
+    )
+    self.btn_sync_vectorstore.grid(row=1, column=2, padx=5, pady=5, sticky="ew")
+
 def create_label_with_help_for_novel_params(self, parent, label_text, tooltip_key, row, column, font=None, sticky="e", padx=5, pady=5):
     frame = ctk.CTkFrame(parent)
     frame.grid(row=row, column=column, padx=padx, pady=pady, sticky=sticky)
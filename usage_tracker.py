@@ -0,0 +1,292 @@
+# usage_tracker.py
+# -*- coding: utf-8 -*-
+"""
+LLM 调用的用量与耗时统计：
+每次 invoke_with_cleaning 调用生成一条记录（提示词/输出 token、命中供应商前缀缓存的 token、总耗时、首 token 耗时、本地限流排队时间、结束原因、重试次数），
+按 章节 + 阶段 汇总，先在内存中累计，每个章节/阶段的函数结束时（见 with_usage_scope）与进程退出时
+合并写入项目目录下的 llm_metrics.json（先写临时文件再替换，中途崩溃不会留下残缺的文件）。
+适配器通过 report_usage 把供应商返回的用量填入当前调用的记录；供应商未返回时按文本长度估算。
+"""
+import os
+import json
+import time
+import atexit
+import tempfile
+import asyncio
+import inspect
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from rate_limiter import estimate_tokens
+
+METRICS_FILE_NAME = "llm_metrics.json"
+
+_current_call = ContextVar("llm_usage_call", default=None)
+_current_scope = ContextVar("llm_usage_scope", default=None)
+_last_call = ContextVar("llm_usage_last_call", default=None)
+
+
+class UsageRecord:
+    """单次 LLM 调用（含其内部重试）的用量记录"""
+    def __init__(self, stage: Optional[str], chapter: Optional[int]):
+        self.stage = stage or "unknown"
+        self.chapter = chapter
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.cached_tokens = 0
+        self.prefix_tokens = 0
+        self.estimated = False
+        self.finish_reason = None
+        self.retries = 0
+        self.latency = 0.0
+        self.ttft = None
+        self.queue_wait = 0.0
+        self.cache_hit = False
+        self.shared = False
+        self.output = ""
+        self._start = time.monotonic()
+
+    def mark_first_token(self):
+        if self.ttft is None:
+            self.ttft = time.monotonic() - self._start
+
+    def to_dict(self) -> dict:
+        return {
+            "stage": self.stage,
+            "chapter": self.chapter,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "prefix_tokens": self.prefix_tokens,
+            "estimated": self.estimated,
+            "finish_reason": self.finish_reason,
+            "retries": self.retries,
+            "latency_seconds": round(self.latency, 3),
+            "ttft_seconds": None if self.ttft is None else round(self.ttft, 3),
+            "queue_wait_seconds": round(self.queue_wait, 3),
+            "cache_hit": self.cache_hit,
+            "shared": self.shared
+        }
+
+
+def _normalize_finish_reason(reason) -> Optional[str]:
+    """统一各家的结束原因：OpenAI 的 length、Gemini 的 MAX_TOKENS、Azure 的枚举值都归为小写字符串"""
+    if reason is None:
+        return None
+    value = getattr(reason, "value", None)
+    if isinstance(value, str):
+        reason = value
+    elif getattr(reason, "name", None):
+        reason = reason.name
+    reason = str(reason).lower()
+    if reason == "max_tokens":
+        return "length"
+    return reason or None
+
+
+def report_usage(prompt_tokens=None, completion_tokens=None, finish_reason=None, cached_tokens=None):
+    """
+    由适配器调用，把供应商返回的用量写入当前调用的记录（不在 track_llm_call 内时忽略）。
+    参数为 None 表示本次未提供该项；流式调用可多次上报，后值覆盖前值。
+    cached_tokens 为提示词中命中供应商前缀缓存（无需重新预填充）的 token 数。
+    """
+    record = _current_call.get()
+    if record is None:
+        return
+    if prompt_tokens is not None:
+        record.prompt_tokens = int(prompt_tokens)
+    if completion_tokens is not None:
+        record.completion_tokens = int(completion_tokens)
+    if cached_tokens is not None:
+        record.cached_tokens = int(cached_tokens)
+    finish_reason = _normalize_finish_reason(finish_reason)
+    if finish_reason:
+        record.finish_reason = finish_reason
+
+
+def current_usage() -> Optional[UsageRecord]:
+    """返回当前正在进行的调用记录"""
+    return _current_call.get()
+
+
+def last_usage() -> Optional[UsageRecord]:
+    """返回当前上下文中最近一次已结束的调用记录（如用于读取其 finish_reason 判断是否被截断）"""
+    return _last_call.get()
+
+
+@contextmanager
+def track_llm_call(stage: Optional[str], prompt: str):
+    """包住一次 LLM 调用：记录耗时，结束后补全估算值并计入所在章节/阶段的汇总"""
+    scope = _current_scope.get() or {}
+    record = UsageRecord(stage, scope.get("chapter"))
+    # prompt_layout.LayeredPrompt 带有稳定前缀，记录其长度以对照实际命中的缓存量
+    record.prefix_tokens = estimate_tokens(getattr(prompt, "prefix", ""))
+    token = _current_call.set(record)
+    try:
+        yield record
+    finally:
+        _current_call.reset(token)
+        _last_call.set(record)
+        record.latency = time.monotonic() - record._start
+        if record.ttft is None:
+            record.ttft = record.latency
+        if record.prompt_tokens is None:
+            record.prompt_tokens = estimate_tokens(prompt)
+            record.estimated = True
+        if record.completion_tokens is None:
+            record.completion_tokens = estimate_tokens(record.output)
+            record.estimated = True
+        _recorder.add(record, scope.get("project_dir"))
+
+
+@contextmanager
+def usage_scope(project_dir: Optional[str], chapter: Optional[int] = None, flush: bool = True):
+    """在此范围内发起的 LLM 调用都归属到该项目目录与章节；退出时把累计的用量写入 llm_metrics.json"""
+    token = _current_scope.set({"project_dir": project_dir, "chapter": chapter})
+    try:
+        yield
+    finally:
+        _current_scope.reset(token)
+        if flush and project_dir:
+            _recorder.flush(project_dir)
+
+
+def with_usage_scope(chapter_arg: Optional[str] = None, path_arg: str = "filepath"):
+    """
+    装饰器：按被装饰函数的参数（默认 filepath 与 chapter_arg 指定的章节号）建立 usage_scope，
+    同步与异步函数均可使用。
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def resolve(args, kwargs):
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            chapter = arguments.get(chapter_arg) if chapter_arg else None
+            return arguments.get(path_arg), chapter
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                project_dir, chapter = resolve(args, kwargs)
+                try:
+                    with usage_scope(project_dir, chapter, flush=False):
+                        return await func(*args, **kwargs)
+                finally:
+                    if project_dir:
+                        # 文件读写放到线程中，不阻塞事件循环
+                        await asyncio.to_thread(_recorder.flush, project_dir)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with usage_scope(*resolve(args, kwargs)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class UsageRecorder:
+    """
+    进程内汇总全部调用；有项目目录的记录先在内存中按目录累计，flush 时合并进该目录的 llm_metrics.json。
+    记录调用只更新内存，文件读写不在全局锁内进行。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._totals = {}
+        self._pending = {}
+
+    @staticmethod
+    def _accumulate(bucket: dict, record: UsageRecord):
+        bucket["calls"] = bucket.get("calls", 0) + 1
+        bucket["prompt_tokens"] = bucket.get("prompt_tokens", 0) + record.prompt_tokens
+        bucket["completion_tokens"] = bucket.get("completion_tokens", 0) + record.completion_tokens
+        bucket["cached_tokens"] = bucket.get("cached_tokens", 0) + record.cached_tokens
+        bucket["prefix_tokens"] = bucket.get("prefix_tokens", 0) + record.prefix_tokens
+        bucket["latency_seconds"] = round(bucket.get("latency_seconds", 0.0) + record.latency, 3)
+        bucket["ttft_seconds"] = round(bucket.get("ttft_seconds", 0.0) + record.ttft, 3)
+        bucket["queue_wait_seconds"] = round(bucket.get("queue_wait_seconds", 0.0) + record.queue_wait, 3)
+        bucket["retries"] = bucket.get("retries", 0) + record.retries
+        if record.estimated:
+            bucket["estimated_calls"] = bucket.get("estimated_calls", 0) + 1
+        if record.cache_hit:
+            bucket["cache_hits"] = bucket.get("cache_hits", 0) + 1
+        if record.shared:
+            bucket["shared_calls"] = bucket.get("shared_calls", 0) + 1
+        if record.finish_reason:
+            reasons = bucket.setdefault("finish_reasons", {})
+            reasons[record.finish_reason] = reasons.get(record.finish_reason, 0) + 1
+
+    @classmethod
+    def _merge(cls, target: dict, delta: dict):
+        """把 delta 中的计数逐项加到 target 上（嵌套的 章节/阶段/结束原因 递归合并）"""
+        for key, value in delta.items():
+            if isinstance(value, dict):
+                cls._merge(target.setdefault(key, {}), value)
+            elif isinstance(value, float):
+                target[key] = round(target.get(key, 0.0) + value, 3)
+            else:
+                target[key] = target.get(key, 0) + value
+
+    def add(self, record: UsageRecord, project_dir: Optional[str] = None):
+        chapter_key = str(record.chapter) if record.chapter is not None else "global"
+        logging.info(f"[usage] {json.dumps(record.to_dict(), ensure_ascii=False)}")
+        with self._lock:
+            self._accumulate(self._totals.setdefault(chapter_key, {}).setdefault(record.stage, {}), record)
+            if project_dir:
+                pending = self._pending.setdefault(os.path.abspath(project_dir), {})
+                self._accumulate(pending.setdefault("chapters", {}).setdefault(chapter_key, {}).setdefault(record.stage, {}), record)
+                self._accumulate(pending.setdefault("stages", {}).setdefault(record.stage, {}), record)
+
+    def flush(self, project_dir: Optional[str] = None):
+        """把累计的用量合并写入 llm_metrics.json；project_dir 为 None 时写入全部项目"""
+        with self._flush_lock:
+            with self._lock:
+                if project_dir is None:
+                    pending, self._pending = self._pending, {}
+                else:
+                    key = os.path.abspath(project_dir)
+                    pending = {key: self._pending.pop(key)} if key in self._pending else {}
+            for directory, delta in pending.items():
+                if not self._write(directory, delta):
+                    # 写入失败时放回内存，下次 flush 再试
+                    with self._lock:
+                        self._merge(self._pending.setdefault(directory, {}), delta)
+
+    def _write(self, project_dir: str, delta: dict) -> bool:
+        path = os.path.join(project_dir, METRICS_FILE_NAME)
+        try:
+            metrics = {}
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    metrics = json.load(f)
+            self._merge(metrics, delta)
+            os.makedirs(project_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=project_dir, prefix=".llm_metrics.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(metrics, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            return True
+        except (OSError, ValueError) as e:
+            logging.warning(f"Failed to write LLM metrics to {path}: {e}")
+            return False
+
+    def summary(self) -> dict:
+        with self._lock:
+            return json.loads(json.dumps(self._totals))
+
+
+_recorder = UsageRecorder()
+atexit.register(_recorder.flush)
+
+def get_usage_summary() -> dict:
+    """返回本进程内按 章节 -> 阶段 汇总的用量"""
+    return _recorder.summary()